@@ -0,0 +1,170 @@
+# AdmissionControl.py
+# Token bucket rate limits on the control commands of each client address, so one client flooding
+# the central node can't crowd out everybody else.  Commands are limited per class, a client that
+# sends too many keep alives can still register a publisher.
+
+import time
+from Command import Command
+
+class AdmissionControl(object):
+    """A token bucket per client address and command class.  Each class has a rate in commands per second
+       and a burst, the most commands a quiet client can send at once.  Admit() is a couple of dictionary
+       lookups and some arithmetic, and looks at nothing but the first byte of the packet so it can run
+       before the packet is decoded.
+
+       Buckets live in two generations that are swapped every IDLE_TIME seconds.  A bucket that is used gets
+       moved to the current generation, so the buckets of clients that went away are dropped with the old
+       generation two swaps later without ever being looked at.  A full bucket is the same as no bucket, so
+       dropping them is free.
+
+       Handlers on many threads may use the same bucket at once.  The worst a race does is let a command
+       through that should have waited, so nothing is locked."""
+
+    # The command classes and the commands in them.
+    CLASS_KEEP_ALIVE = "keepalive"
+    CLASS_REGISTER = "register"
+    CLASS_RESPONSE = "response"
+    CLASS_QUERY = "query"
+    CLASS_BATCH = "batch"
+    CLASS_OTHER = "other"
+
+    CLASSES = {
+        Command.KEEP_ALIVE: CLASS_KEEP_ALIVE,
+        Command.ADD_PUBLISHER: CLASS_REGISTER,
+        Command.REMOVE_PUBLISHER: CLASS_REGISTER,
+        Command.ADD_SUBSCRIBER: CLASS_REGISTER,
+        Command.REMOVE_SUBSCRIBER: CLASS_REGISTER,
+        Command.SUCCESS: CLASS_RESPONSE,
+        Command.FAILURE: CLASS_RESPONSE,
+        Command.STATS: CLASS_QUERY,
+        Command.DISCOVER: CLASS_QUERY,
+        Command.BATCH: CLASS_BATCH,
+    }
+
+    # Only clients that wait for an answer to these are told they were throttled.  Answering keep alives or
+    # responses would only start a conversation, and garbage gets no answer anyway.
+    NOTIFY_CLASSES = (CLASS_REGISTER, CLASS_QUERY, CLASS_BATCH)
+
+    # (rate, burst) of each class.  A client sends a keep alive every 5 seconds and answers our commands,
+    # so these leave plenty of room.  A batch only pays for the datagram here, every command in it is charged to
+    # its own class as well.  Anything we don't know, including garbage, is "other".
+    DEFAULT_RATES = {
+        CLASS_KEEP_ALIVE: (10.0, 20.0),
+        CLASS_REGISTER: (20.0, 50.0),
+        CLASS_RESPONSE: (50.0, 100.0),
+        CLASS_QUERY: (20.0, 50.0),
+        CLASS_BATCH: (10.0, 20.0),
+        CLASS_OTHER: (5.0, 10.0),
+    }
+
+    # What Admit() says to do with a packet: handle it, drop it, or drop it and tell the client it was throttled.
+    ADMIT = 0
+    DROP = 1
+    NOTIFY = 2
+
+    # Seconds between generation swaps, a bucket refills completely well before this.
+    IDLE_TIME = 30.0
+
+    # Most buckets in a generation, a flood from many addresses swaps early instead of using up memory.
+    MAX_BUCKETS = 100000
+
+    def __init__(self, rates=None, clock=time.time):
+        """Public constructor.  rates maps a class name to (rate, burst), classes that are left out get the
+           default."""
+        self.Rates = dict(self.DEFAULT_RATES)
+        if rates:
+            self.Rates.update(rates)
+
+        # The class of every command code and the (rate, burst) of every class by number, so Admit() only
+        # indexes lists.  Codes we don't know are "other".
+        self.ClassNames = sorted(self.Rates)
+        self.CodeClasses = [self.ClassNames.index(self.CLASSES.get(code, self.CLASS_OTHER)) for code in range(256)]
+        self.Limits = [self.Rates[name] for name in self.ClassNames]
+        self.Notify = [name in self.NOTIFY_CLASSES for name in self.ClassNames]
+
+        self.Clock = clock
+        self.Current = dict()
+        self.Previous = dict()
+        self.NextSwap = clock() + self.IDLE_TIME
+
+
+    @classmethod
+    def FromString(cls, text):
+        """Creates the limits from text like "keepalive=20/40,register=5".  Each class gets rate/burst, or the
+           rate alone for a burst of twice the rate.  Unknown class names are an error."""
+        rates = dict()
+        for part in text.split(","):
+            part = part.strip()
+            if not part:
+                continue
+
+            name, equals, limit = part.partition("=")
+            name = name.strip().lower()
+            if not equals or name not in cls.DEFAULT_RATES:
+                raise ValueError("Unknown rate limit " + repr(part) + ", the classes are " +
+                                 ", ".join(sorted(cls.DEFAULT_RATES)))
+
+            rate, slash, burst = limit.partition("/")
+            rate = float(rate)
+            burst = float(burst) if slash else 2 * rate
+            if rate <= 0 or burst < 1:
+                raise ValueError("Invalid rate limit " + repr(part))
+            rates[name] = (rate, burst)
+
+        return cls(rates)
+
+
+    def GetClass(self, data):
+        """Returns the class name of a packet."""
+        return self.ClassNames[self.CodeClasses[ord(data[0]) if data else 255]]
+
+
+    def Admit(self, data, client_address, now=None):
+        """Takes a token for a packet from a client.  Returns ADMIT if the packet may go on, otherwise DROP if
+           it should be dropped quietly or NOTIFY if the client should also be told it was throttled.  Each
+           client is only told once until it slows down."""
+        if now is None:
+            now = self.Clock()
+
+        if now >= self.NextSwap or len(self.Current) >= self.MAX_BUCKETS:
+            self.Swap(now)
+
+        command_class = self.CodeClasses[ord(data[0]) if data else 255]
+        rate, burst = self.Limits[command_class]
+
+        key = (client_address, command_class)
+        bucket = self.Current.get(key)
+        if bucket is None:
+            bucket = self.Previous.pop(key, None)
+            if bucket is None:
+                # A new client starts with a full bucket.
+                bucket = [burst, now, False]
+            self.Current[key] = bucket
+
+        tokens = bucket[0] + (now - bucket[1]) * rate
+        if tokens > burst:
+            tokens = burst
+        bucket[1] = now
+
+        if tokens >= 1.0:
+            bucket[0] = tokens - 1.0
+            bucket[2] = False
+            return self.ADMIT
+
+        bucket[0] = tokens
+        if bucket[2] or not self.Notify[command_class]:
+            return self.DROP
+
+        bucket[2] = True
+        return self.NOTIFY
+
+
+    def Swap(self, now):
+        """Starts a new generation of buckets, the ones nobody used for a whole generation are dropped."""
+        self.Previous = self.Current
+        self.Current = dict()
+        self.NextSwap = now + self.IDLE_TIME
+
+
+    def __len__(self):
+        return len(self.Current) + len(self.Previous)
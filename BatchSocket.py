@@ -0,0 +1,294 @@
+# BatchSocket.py
+# Reads and writes bursts of UDP datagrams with one system call each, using recvmmsg and sendmmsg
+# through ctypes on Linux.  Everywhere else, or if libc does not have them, the same classes fall
+# back to one recvfrom or sendto per datagram.
+
+import ctypes
+import ctypes.util
+import errno
+import socket
+import struct
+import sys
+import Log
+
+MSG_DONTWAIT = 0x40
+MSG_TRUNC = 0x20
+
+# Errors that only mean the socket has nothing more for us right now.
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Setting ctypes fields one at a time costs more than the system calls we save, so the headers are packed
+# and unpacked with struct in the native layout instead.  LoadLibc() checks they agree with the C structs.
+
+# struct iovec: base pointer and length.
+IOVEC = struct.Struct("@PL")
+
+# struct mmsghdr: struct msghdr (name, name length, iovec, iovec count, control, control length and flags)
+# followed by the length of the datagram.
+MMSGHDR = struct.Struct("@PIPLPLi4xI4x")
+
+# The flags and the length of a received datagram, read straight out of its mmsghdr.
+MMSGHDR_RESULT = struct.Struct("@i4xI")
+MMSGHDR_RESULT_OFFSET = 48
+
+# struct sockaddr_in, the family is in host order and the port and address in network order.
+SOCKADDR_IN = struct.Struct("=H2s4s8x")
+PORT = struct.Struct(">H")
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def LoadLibc():
+    """Returns libc if it has recvmmsg and sendmmsg and our packed headers match its structs, otherwise None."""
+    if not sys.platform.startswith("linux"):
+        return None
+
+    if (IOVEC.size != ctypes.sizeof(iovec) or MMSGHDR.size != ctypes.sizeof(mmsghdr)
+            or MMSGHDR_RESULT_OFFSET != msghdr.msg_flags.offset
+            or MMSGHDR_RESULT_OFFSET + MMSGHDR_RESULT.size != mmsghdr.msg_len.offset + 4):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+Libc = LoadLibc()
+
+# True if bursts really take one system call, False if we fall back to one call per datagram.
+HAVE_MMSG = Libc is not None
+
+
+def PackAddress(address):
+    """Returns the sockaddr_in bytes of an (ip, port) address."""
+    return SOCKADDR_IN.pack(socket.AF_INET, PORT.pack(address[1]), socket.inet_aton(address[0]))
+
+
+def UnpackAddress(data):
+    """Returns the (ip, port) address in sockaddr_in bytes."""
+    family, port, ip = SOCKADDR_IN.unpack_from(data)
+    return (socket.inet_ntoa(ip), PORT.unpack(port)[0])
+
+
+class BatchReceiver(object):
+    """Reads every datagram waiting on a non-blocking IPv4 UDP socket, up to count of them per call.
+       Datagrams longer than size are cut short by the kernel and dropped, so size has to fit the biggest
+       datagram we care about."""
+
+    # Most client addresses we keep the (ip, port) of.
+    MAX_ADDRESSES = 4096
+
+    def __init__(self, sock, count, size, use_mmsg=HAVE_MMSG):
+        """Public constructor.  With use_mmsg False it always falls back to recvfrom."""
+        self.Socket = sock
+        self.Count = count
+        self.Size = size
+        self.Truncated = 0
+        self.UseMMsg = use_mmsg and Libc is not None
+
+        # The (ip, port) of the sockaddr_in we received from, clients send again and again from the same one.
+        self.Addresses = dict()
+
+        if self.UseMMsg:
+            # One slot per datagram in each buffer, set up once and reused for every call.  The buffer
+            # objects are read only views that see what the kernel writes.
+            self.Data = ctypes.create_string_buffer(count * size)
+            self.Names = ctypes.create_string_buffer(count * SOCKADDR_IN.size)
+            self.Vectors = ctypes.create_string_buffer(b"".join(
+                IOVEC.pack(ctypes.addressof(self.Data) + n * size, size) for n in range(count)))
+            # IPv4 addresses always fill the whole sockaddr_in, so the name lengths never need resetting.
+            self.Headers = ctypes.create_string_buffer(b"".join(
+                MMSGHDR.pack(ctypes.addressof(self.Names) + n * SOCKADDR_IN.size, SOCKADDR_IN.size,
+                             ctypes.addressof(self.Vectors) + n * IOVEC.size, 1, 0, 0, 0, 0) for n in range(count)))
+            self.DataView = buffer(self.Data)
+            self.NameView = buffer(self.Names)
+            self.HeaderView = buffer(self.Headers)
+
+
+    def Receive(self):
+        """Returns a list of (data, client_address) for the datagrams waiting on the socket, empty if there
+           are none."""
+        if not self.UseMMsg:
+            return self.ReceiveEach()
+
+        received = Libc.recvmmsg(self.Socket.fileno(), ctypes.addressof(self.Headers), self.Count, MSG_DONTWAIT, None)
+        if received < 0:
+            error = ctypes.get_errno()
+            if error in WOULD_BLOCK:
+                return []
+            raise socket.error(error, "recvmmsg failed")
+
+        datagrams = []
+        result = MMSGHDR_RESULT.unpack_from
+        headers = self.HeaderView
+        data = self.DataView
+        names = self.NameView
+        size = self.Size
+        name_size = SOCKADDR_IN.size
+        header_size = MMSGHDR.size
+
+        addresses = self.Addresses
+        if len(addresses) > self.MAX_ADDRESSES:
+            addresses.clear()
+
+        for n in range(received):
+            flags, length = result(headers, n * header_size + MMSGHDR_RESULT_OFFSET)
+            if flags & MSG_TRUNC:
+                self.Truncated = self.Truncated + 1
+                Log.Debug("Dropped a datagram longer than %d bytes", size)
+                continue
+
+            name = names[n * name_size:(n + 1) * name_size]
+            address = addresses.get(name)
+            if address is None:
+                address = addresses[name] = UnpackAddress(name)
+
+            datagrams.append((data[n * size:n * size + length], address))
+
+        return datagrams
+
+
+    def ReceiveEach(self):
+        """Receive() with one recvfrom per datagram."""
+        datagrams = []
+        for n in range(self.Count):
+            try:
+                datagrams.append(self.Socket.recvfrom(self.Size))
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    break
+                raise
+
+        return datagrams
+
+
+class BatchSender(object):
+    """Stands in for a UDP socket anywhere code only calls sendto.  Between Begin() and Flush() datagrams
+       are held back and sent in one burst, the rest of the time sendto goes straight to the socket, so
+       it is safe to keep around and use later."""
+
+    # Most datagrams held back before they are flushed anyway.
+    MAX_PENDING = 1024
+
+    # Most client addresses we keep the sockaddr_in of.
+    MAX_NAMES = 4096
+
+    def __init__(self, sock, use_mmsg=HAVE_MMSG):
+        """Public constructor.  With use_mmsg False a burst is sent with one sendto per datagram."""
+        self.Socket = sock
+        self.UseMMsg = use_mmsg and Libc is not None
+        self.Pending = None
+        self.Bursts = 0
+        self.Sent = 0
+
+        # The sockaddr_in of the addresses we send to.
+        self.Names = dict()
+
+
+    def fileno(self):
+        return self.Socket.fileno()
+
+
+    def Begin(self):
+        """Starts holding back datagrams."""
+        if self.Pending is None:
+            self.Pending = []
+
+
+    def sendto(self, data, address):
+        """Sends a datagram, or queues it if a burst is open."""
+        pending = self.Pending
+        if pending is None:
+            return self.Socket.sendto(data, address)
+
+        pending.append((data, address))
+        if len(pending) >= self.MAX_PENDING:
+            self.Send(pending)
+            self.Pending = []
+
+        return len(data)
+
+
+    def Flush(self):
+        """Sends every datagram held back since Begin() and stops holding them back."""
+        pending = self.Pending
+        self.Pending = None
+        if pending:
+            self.Send(pending)
+
+
+    def Send(self, datagrams):
+        """Sends a list of (data, address) datagrams.  A datagram that cannot be sent is logged and dropped,
+           just like the network could have dropped it."""
+        self.Bursts = self.Bursts + 1
+        count = len(datagrams)
+        if not self.UseMMsg or count == 1:
+            for data, address in datagrams:
+                self.SendOne(data, address)
+            return
+
+        names = self.Names
+        if len(names) > self.MAX_NAMES:
+            names.clear()
+
+        # Every datagram goes in one buffer and every sockaddr_in in another, the iovecs and headers point
+        # into them.  The buffers have to stay alive until sendmmsg returns.
+        payload = ctypes.create_string_buffer(b"".join([data for data, address in datagrams]))
+        offset = ctypes.addressof(payload)
+        name_list = []
+        vectors = []
+        for data, address in datagrams:
+            name = names.get(address)
+            if name is None:
+                name = names[address] = PackAddress(address)
+            name_list.append(name)
+            vectors.append(IOVEC.pack(offset, len(data)))
+            offset = offset + len(data)
+
+        name_buffer = ctypes.create_string_buffer(b"".join(name_list))
+        vector_buffer = ctypes.create_string_buffer(b"".join(vectors))
+        name_address = ctypes.addressof(name_buffer)
+        vector_address = ctypes.addressof(vector_buffer)
+        pack = MMSGHDR.pack
+        header_buffer = ctypes.create_string_buffer(b"".join([
+            pack(name_address + n * SOCKADDR_IN.size, SOCKADDR_IN.size, vector_address + n * IOVEC.size, 1, 0, 0, 0, 0)
+            for n in range(count)]))
+
+        fileno = self.Socket.fileno()
+        headers = ctypes.addressof(header_buffer)
+        start = 0
+        while start < count:
+            sent = Libc.sendmmsg(fileno, headers + start * MMSGHDR.size, count - start, 0)
+            if sent <= 0:
+                # The first datagram failed, let sendto report it and go on with the rest.
+                self.SendOne(*datagrams[start])
+                start = start + 1
+            else:
+                self.Sent = self.Sent + sent
+                start = start + sent
+
+
+    def SendOne(self, data, address):
+        """Sends one datagram with sendto."""
+        try:
+            self.Socket.sendto(data, address)
+            self.Sent = self.Sent + 1
+        except socket.error as e:
+            Log.Warning("Could not send %d bytes to %s: %s", len(data), address, e)
@@ -0,0 +1,1475 @@
+# Benchmark.py
+# Micro benchmarks for the hot paths of the central node and the clients.
+#
+#     $>python Benchmark.py [name ...]
+#
+# With no arguments every benchmark is run.
+
+import os
+import sys
+import time
+from struct import pack, unpack
+from CRCCalculator import CRCCalculator
+from Command import Command
+import Log
+
+
+def TimeIt(func, min_time=0.5):
+    """Calls func until at least min_time seconds have passed.  Returns (calls, seconds)."""
+    calls = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < min_time:
+        func()
+        calls = calls + 1
+        elapsed = time.time() - start
+
+    return calls, elapsed
+
+
+def BenchmarkCRC():
+    """Throughput of each CRC backend for control sized, chunk sized and large buffers."""
+    print "%-10s %10s %12s" % ("backend", "size", "MB/s")
+
+    for size in (44, 1024, 65536):
+        data = os.urandom(size)
+        for backend in CRCCalculator.GetBackends():
+            calc = CRCCalculator(backend)
+            calls, elapsed = TimeIt(lambda: calc.CalculateCRC(data))
+            print "%-10s %10d %12.2f" % (backend, size, calls * size / elapsed / 1e6)
+
+    # streaming a large payload in file sized chunks should cost the same as one big call.
+    data = os.urandom(1 << 20)
+    stream = CRCCalculator().CreateStream()
+
+    def StreamChunks():
+        stream.Reset()
+        for n in range(0, len(data), 1024):
+            stream.Update(data[n:n + 1024])
+
+    calls, elapsed = TimeIt(StreamChunks)
+    print "%-10s %10s %12.2f" % ("stream", "1M/1024", calls * len(data) / elapsed / 1e6)
+
+
+def LegacyEncode(code, transaction_id, sensor_type, payload):
+    """The original Command.GetPacket(), packs everything twice and builds the format every time."""
+    fmt = Command.DEFAULT_DECODER_STRING % len(payload)
+    calc = CRCCalculator(CRCCalculator.BACKEND_TABLE)
+    noCrcPacket = pack(fmt, code, transaction_id, 0, sensor_type, payload, 0)
+    crc = calc.CalculateCRC(noCrcPacket[0:-4])
+    return pack(fmt, code, transaction_id, 0, sensor_type, payload, crc)
+
+
+def LegacyDecode(packet):
+    """The original Command.CreateFromPacket(), unpacks and then encodes again to check the CRC."""
+    fmt = Command.DEFAULT_DECODER_STRING % (len(packet) - Command.HEADER_LENGTH)
+    code, transaction_id, reserved, sensor_type, payload, crc = unpack(fmt, packet)
+    return crc == unpack(fmt, LegacyEncode(code, transaction_id, sensor_type, payload))[-1]
+
+
+def BenchmarkCodec():
+    """Encode and decode rate of a typical ADD_SUBSCRIBER PDU before and after the codec."""
+    key = "plant3/line2/temperature"
+    packet = Command.Codec.Encode(Command.ADD_SUBSCRIBER, 42, 7, key)
+    assert packet == LegacyEncode(Command.ADD_SUBSCRIBER, 42, 7, key)
+
+    print "%-8s %-8s %12s" % ("path", "impl", "kPDU/s")
+    results = [
+        ("encode", "legacy", lambda: LegacyEncode(Command.ADD_SUBSCRIBER, 42, 7, key)),
+        ("encode", "codec", lambda: Command.Codec.Encode(Command.ADD_SUBSCRIBER, 42, 7, key)),
+        ("decode", "legacy", lambda: LegacyDecode(packet)),
+        ("decode", "codec", lambda: Command.Codec.Decode(packet)),
+    ]
+    for path, impl, func in results:
+        calls, elapsed = TimeIt(func)
+        print "%-8s %-8s %12.1f" % (path, impl, calls / elapsed / 1e3)
+
+
+def MakeSensorTraces(count=5000):
+    """Synthetic but realistic integer traces as (name, period in ms, [(timestamp, value)])."""
+    import math
+    import random
+    random.seed(1)
+    start = 1467244800000
+
+    temperature = []
+    value = 2150
+    for n in range(count):
+        value += random.randint(-3, 3)
+        temperature.append((start + n * 1000 + random.randint(0, 2), value))
+
+    vibration = [(start + n, int(2000 * math.sin(n / 7.0)) + random.randint(-40, 40)) for n in range(count)]
+
+    counter = []
+    value = 100000
+    for n in range(count):
+        value += random.randint(1, 3)
+        counter.append((start + n * 10, value))
+
+    return [("temperature 1Hz", 1000, temperature), ("vibration 1kHz", 1, vibration), ("counter 100Hz", 10, counter)]
+
+
+def BenchmarkDataEncoding(linger_ms=100):
+    """Bytes per sample on the wire for plain, framed and compact data packets.  Frames are flushed when
+       they are full or when the samples in them span the linger time."""
+    import DataPacket
+
+    # IP and UDP headers
+    overhead = 28
+
+    print "%-16s %-8s %10s %10s %10s" % ("trace", "mode", "datagrams", "B/sample", "wire B/s")
+    for name, period, trace in MakeSensorTraces():
+
+        modes = [("plain", None), ("framed", DataPacket.DataFrame()), ("compact", DataPacket.CompactFrame())]
+        for mode, frame in modes:
+            datagrams = []
+            for stamp, value in trace:
+                if frame is None:
+                    datagrams.append(DataPacket.PackSample(stamp, str(value)))
+                    continue
+
+                if frame.count() > 0 and stamp - frame.BaseStamp >= linger_ms:
+                    datagrams.append(frame.getPacket())
+                if not frame.add(stamp, str(value)):
+                    datagrams.append(frame.getPacket())
+                    frame.add(stamp, str(value))
+
+            if frame is not None and frame.count() > 0:
+                datagrams.append(frame.getPacket())
+
+            # make sure every mode gets the same samples back.
+            decoded = []
+            for datagram in datagrams:
+                decoded.extend(DataPacket.UnpackSample(packet) for packet in DataPacket.UnpackDatagram(datagram))
+            assert decoded == [(stamp, str(value)) for stamp, value in trace]
+
+            total = sum(len(datagram) for datagram in datagrams)
+            per_sample = float(total) / len(trace)
+            wire = (total + overhead * len(datagrams)) * 1000.0 / period / len(trace)
+            print "%-16s %-8s %10d %10.2f %10.1f" % (name, mode, len(datagrams), per_sample, wire)
+
+
+def MakeTextSamples(count=4000):
+    """Status lines like a gateway would log them, one sample per line and as 1024 byte file chunks."""
+    import random
+    random.seed(2)
+    lines = []
+    for n in range(count):
+        lines.append("2016-06-30T12:%02d:%02dZ plant3/line2/press%d temp=%.2fC humidity=%.1f%% status=%s\n" %
+                     (n // 60 % 60, n % 60, n % 4, random.uniform(20, 23), random.uniform(38, 42),
+                      random.choice(["OK", "OK", "OK", "WARN"])))
+
+    text = "".join(lines)
+    chunks = [text[n:n + 1024] for n in range(0, len(text), 1024)]
+    return [("status line", lines), ("file chunk", chunks)]
+
+
+def BenchmarkCompression():
+    """Compression ratio and CPU cost per sample for text samples, without and with a trained dictionary."""
+    import DataPacket
+
+    print "%-12s %-12s %8s %10s %10s" % ("samples", "dictionary", "ratio", "us/sample", "skipped")
+    for name, samples in MakeTextSamples():
+        # train on the first half and measure on the second half.
+        half = len(samples) // 2
+        trained = DataPacket.TrainDictionary(samples[:half])
+        DataPacket.RegisterDictionary(1, trained)
+        packets = [DataPacket.PackSample(DataPacket.GetTimestamp(), sample) for sample in samples[half:]]
+
+        for dictionary_name, dictionary in (("none", b""), ("trained", trained)):
+            compressor = DataPacket.DataCompressor(dictionary)
+            for packet in packets:
+                datagram = compressor.compressDatagram(packet)
+                assert DataPacket.UnpackDatagram(datagram) == [packet]
+
+            stats = compressor.getStats()
+            print "%-12s %-12s %8.2f %10.1f %10d" % (name, dictionary_name, stats["ratio"],
+                                                     stats["us_per_sample"], stats["skipped"])
+
+
+# Sends control packets from many client sockets at a fixed rate.  Runs in its own process so it
+# does not compete with the central node for the GIL.
+LOAD_GENERATOR = """
+import socket, sys, time
+sys.path.insert(0, %(path)r)
+from Command import Command
+address = (%(ip)r, %(port)d)
+clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for n in range(%(clients)d)]
+for n, client in enumerate(clients):
+    client.sendto(Command.Codec.Encode(Command.ADD_PUBLISHER, n, 0, "bench/pub%%d" %% n), address)
+time.sleep(0.5)
+keep_alive = Command.Codec.Encode(Command.KEEP_ALIVE, 0, 0, " ")
+sent = 0
+start = time.time()
+while time.time() - start < %(seconds)f:
+    # catch up to the target rate in bursts of one packet per client.
+    while sent < (time.time() - start) * %(rate)d:
+        for client in clients:
+            client.sendto(keep_alive, address)
+        sent += len(clients)
+    time.sleep(0.001)
+print sent
+"""
+
+
+def RunCentralNodeLoad(central_node, port, rate, seconds, clients=100):
+    """Runs a central node on a thread while another process sends it keep alives.  Returns the number
+       of keep alives sent, handled, and the housekeeping runs seen while under load."""
+    import subprocess
+    import threading
+    import SMPCentralNodeRequestHandler as RequestHandler
+    from TopicTrie import TopicTrie
+
+    handled = [0]
+    housekeeping = [0]
+    keep_alive = RequestHandler.SMPCentralNodeRequestHandler.CommandHandlers[Command.KEEP_ALIVE]
+    timeout = RequestHandler.HandleTimeout
+
+    def CountingKeepAlive(handler, command):
+        handled[0] += 1
+        return keep_alive(handler, command)
+
+    def CountingTimeout():
+        housekeeping[0] += 1
+        timeout()
+
+    RequestHandler.SMPCentralNodeRequestHandler.CommandHandlers[Command.KEEP_ALIVE] = CountingKeepAlive
+    RequestHandler.HandleTimeout = CountingTimeout
+    if hasattr(central_node.Server, "Stop"):
+        central_node.Server.handle_timeout = CountingTimeout
+
+    # the central node is chatty, keep it off the console.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    log_level = Log.Level
+    Log.SetLevel(Log.WARNING)
+    try:
+        node_thread = threading.Thread(target=central_node.Start)
+        node_thread.daemon = True
+        node_thread.start()
+
+        script = LOAD_GENERATOR % {"path": os.path.dirname(os.path.abspath(__file__)), "ip": "127.0.0.1",
+                                   "port": port, "clients": clients, "seconds": seconds, "rate": rate}
+        start_cpu = os.times()
+        sent = int(subprocess.check_output([sys.executable, "-c", script]))
+        time.sleep(0.5)
+        end_cpu = os.times()
+
+        central_node.Stop()
+        node_thread.join(2)
+        central_node.Server.server_close()
+    finally:
+        sys.stdout = stdout
+        Log.SetLevel(log_level)
+        RequestHandler.SMPCentralNodeRequestHandler.CommandHandlers[Command.KEEP_ALIVE] = keep_alive
+        RequestHandler.HandleTimeout = timeout
+        RequestHandler.Pubs.Clear()
+        RequestHandler.PublisherTopics = TopicTrie()
+        RequestHandler.Patterns = TopicTrie()
+        RequestHandler.Sessions.clear()
+        del RequestHandler.SessionDeadlines[:]
+        RequestHandler.Transactions.clear()
+
+    cpu = (end_cpu[0] - start_cpu[0]) + (end_cpu[1] - start_cpu[1])
+    return sent, handled[0], housekeeping[0], cpu
+
+
+def BenchmarkCentralNodeEngines(rate=10000, seconds=3):
+    """Keep alives handled by each central node engine at a fixed offered load."""
+    from CentralNode import SMPCentralNode
+
+    print "%-10s %10s %10s %8s %12s %12s" % ("engine", "sent", "handled", "lost %", "housekeeping", "us CPU/pkt")
+    for port, engine in ((16001, SMPCentralNode.ENGINE_THREADED), (16002, SMPCentralNode.ENGINE_EVENT_LOOP)):
+        sent, handled, housekeeping, cpu = RunCentralNodeLoad(SMPCentralNode("127.0.0.1", port, engine), port, rate, seconds)
+        print "%-10s %10d %10d %8.1f %12d %12.1f" % (engine, sent, handled, 100.0 * (sent - handled) / sent,
+                                                    housekeeping, cpu * 1e6 / max(handled, 1))
+
+
+class NullSocket(object):
+    """Socket stand in that throws away everything sent to it."""
+
+    def sendto(self, data, address):
+        return len(data)
+
+
+def BenchmarkRetransmit(due=10):
+    """Cost of one housekeeping tick with many outstanding transactions of which only a few are due."""
+    import SMPCentralNodeRequestHandler as RequestHandler
+    from TimerWheel import TimerWheel
+
+    command = Command().CreateFromParams(Command.START_PUBLISHING, -1, 0, "bench/pub")
+    stdout = sys.stdout
+
+    # transaction ids are 16 bits so there can never be many more than 32k outstanding.
+    print "%-12s %12s %12s" % ("outstanding", "wheel us", "scan us")
+    for outstanding in (1000, 10000, 30000):
+        now = time.time()
+        RequestHandler.Transactions.clear()
+
+        sys.stdout = open(os.devnull, "w")
+        try:
+            for n in range(outstanding):
+                RequestHandler.StoreTransaction(-n - 1, command, NullSocket(), ("127.0.0.1", 1))
+        finally:
+            sys.stdout = stdout
+
+        # only the first few are due on this tick, the rest are still waiting on their response.
+        RequestHandler.TransactionTimers = TimerWheel(now=now)
+        for transaction in RequestHandler.Transactions.values():
+            if transaction.ID >= -due:
+                transaction.Deadline = now + 1
+            else:
+                transaction.Deadline = now + 30
+            RequestHandler.TransactionTimers.Schedule(transaction.Deadline, transaction)
+
+        sys.stdout = open(os.devnull, "w")
+        try:
+            start = time.time()
+            RequestHandler.HandleTransactionTimeouts(now + 1.5)
+            wheel = time.time() - start
+        finally:
+            sys.stdout = stdout
+
+        # the old housekeeping looked at every transaction on every tick.
+        start = time.time()
+        for key, value in RequestHandler.Transactions.items():
+            if value.Deadline <= now + 1.5:
+                value.Send()
+        scan = time.time() - start
+
+        print "%-12d %12.1f %12.1f" % (outstanding, wheel * 1e6, scan * 1e6)
+
+    RequestHandler.Transactions.clear()
+    RequestHandler.TransactionTimers = TimerWheel()
+
+
+def LegacyKeepAlive(pubs, client_address):
+    """The keep alive handling from before sessions, a brute force loop over every subscriber."""
+    for pubkey, pubvalue in pubs.items():
+        if pubvalue.ClientAddress == client_address:
+            pubvalue.TimeoutCount = 0
+
+        for subkey, subvalue in pubvalue.Subs.items():
+            if subvalue.Key == client_address:
+                subvalue.TimeoutCount = 0
+
+
+def BenchmarkSessions(publishers=10000, subscribers=10):
+    """Keep alive and client removal cost with publishers * subscribers records on the central node."""
+    import SMPCentralNodeRequestHandler as RequestHandler
+    from Publisher import Publisher
+    from Subscriber import Subscriber
+
+    class FakeHandler(object):
+        pass
+
+    request = (None, NullSocket())
+    subscriber_clients = publishers // 10
+
+    for n in range(publishers):
+        address = ("10.0.%d.%d" % (n // 250, n % 250), 20000)
+        publisher = Publisher("bench/pub/%d" % n, request, address, 15002)
+        RequestHandler.Pubs.Add(publisher)
+        RequestHandler.GetSession(address).Publishers[publisher.Key] = publisher
+
+        # spread the subscriptions so every subscriber client is on many publishers.
+        for k in range(subscribers):
+            address = ("10.1.0.1", 30000 + (n * subscribers + k) % subscriber_clients)
+            subscriber = Subscriber(request, address)
+            publisher.Subs[address] = subscriber
+            RequestHandler.GetSession(address).Subscriptions[publisher.Key] = subscriber
+
+    keep_alive = RequestHandler.SMPCentralNodeRequestHandler.CommandHandlers[Command.KEEP_ALIVE]
+    command = Command().CreateFromParams(Command.KEEP_ALIVE, 1, 0, "")
+    handler = FakeHandler()
+    handler.client_address = ("10.1.0.1", 30000)
+
+    # the legacy loop needs the counters that used to live on every record and a plain dictionary.
+    pubs = dict(RequestHandler.Pubs.Items())
+    for publisher in RequestHandler.Pubs.Values():
+        publisher.TimeoutCount = 0
+        for subscriber in publisher.Subs.values():
+            subscriber.TimeoutCount = 0
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        legacy_calls, legacy_seconds = TimeIt(lambda: LegacyKeepAlive(pubs, handler.client_address))
+        session_calls, session_seconds = TimeIt(lambda: keep_alive(handler, command))
+
+        start = time.time()
+        RequestHandler.RemoveSession(handler.client_address)
+        remove_seconds = time.time() - start
+    finally:
+        sys.stdout = stdout
+        RequestHandler.Pubs.Clear()
+        RequestHandler.Sessions.clear()
+        del RequestHandler.SessionDeadlines[:]
+        RequestHandler.Transactions.clear()
+
+    print "%d publishers x %d subscribers, %d subscriber clients" % (publishers, subscribers, subscriber_clients)
+    print "%-24s %12.1f us" % ("keep alive brute force", legacy_seconds * 1e6 / legacy_calls)
+    print "%-24s %12.1f us" % ("keep alive session", session_seconds * 1e6 / session_calls)
+    print "%-24s %12.1f us" % ("remove session", remove_seconds * 1e6)
+
+
+def LegacyHousekeeping(pubs, limit):
+    """The liveness sweep from before deadlines, counts every record up and dedupes subscribers with a list."""
+    already_incremented_subs = []
+    for pubkey, pubvalue in pubs.items():
+        pubvalue.TimeoutCount = pubvalue.TimeoutCount + 1
+        if pubvalue.TimeoutCount > limit:
+            continue
+
+        for subkey, subvalue in pubvalue.Subs.items():
+            if subkey not in already_incremented_subs:
+                subvalue.TimeoutCount = subvalue.TimeoutCount + 1
+                already_incremented_subs.append(subkey)
+
+
+def BenchmarkLiveness(counts=(100, 1000, 10000), subscribers=10):
+    """Cost of one liveness sweep when no client has actually timed out."""
+    import SMPCentralNodeRequestHandler as RequestHandler
+    from Publisher import Publisher
+    from Subscriber import Subscriber
+
+    request = (None, NullSocket())
+
+    print "%-12s %14s %14s" % ("publishers", "counters us", "deadlines us")
+    for publishers in counts:
+        subscriber_clients = max(publishers // 10, subscribers)
+        for n in range(publishers):
+            address = ("10.0.%d.%d" % (n // 250, n % 250), 20000)
+            publisher = Publisher("bench/pub/%d" % n, request, address, 15002)
+            publisher.TimeoutCount = 0
+            RequestHandler.Pubs.Add(publisher)
+            RequestHandler.GetSession(address).Publishers[publisher.Key] = publisher
+
+            for k in range(subscribers):
+                address = ("10.1.0.1", 30000 + (n * subscribers + k) % subscriber_clients)
+                subscriber = Subscriber(request, address)
+                subscriber.TimeoutCount = 0
+                publisher.Subs[address] = subscriber
+                RequestHandler.GetSession(address).Subscriptions[publisher.Key] = subscriber
+
+        try:
+            pubs = dict(RequestHandler.Pubs.Items())
+            start = time.time()
+            LegacyHousekeeping(pubs, 1e9)
+            legacy = time.time() - start
+
+            start = time.time()
+            RequestHandler.HandleSessionTimeouts()
+            deadlines = time.time() - start
+        finally:
+            RequestHandler.Pubs.Clear()
+            RequestHandler.Sessions.clear()
+            del RequestHandler.SessionDeadlines[:]
+
+        print "%-12d %14.1f %14.1f" % (publishers, legacy * 1e6, deadlines * 1e6)
+
+
+def BenchmarkPorts(ports="15002-15554,20000-59999"):
+    """Broadcast port allocation, the old list with pop(0) against the free list allocator."""
+    from PortAllocator import PortAllocator
+
+    allocator = PortAllocator.FromString(ports)
+    size = allocator.GetFreeCount()
+    legacy = []
+    for first, last in allocator.Ranges:
+        legacy.extend(range(first, last + 1))
+
+    # hand out every port, the list gets shorter as it goes so this favors the old way.
+    start = time.time()
+    while legacy:
+        legacy.pop(0)
+    legacy_seconds = time.time() - start
+
+    start = time.time()
+    allocated = [allocator.Allocate() for n in range(size)]
+    allocate_seconds = time.time() - start
+
+    start = time.time()
+    for port in allocated:
+        allocator.Release(port)
+    release_seconds = time.time() - start
+
+    # publishers come and go far more often than there are ports.
+    churn = 10 * size
+    start = time.time()
+    for n in range(churn):
+        allocator.Release(allocator.Allocate())
+    churn_seconds = time.time() - start
+
+    print "%d ports" % size
+    print "%-24s %10.3f us" % ("legacy pop(0)", legacy_seconds * 1e6 / size)
+    print "%-24s %10.3f us" % ("allocate", allocate_seconds * 1e6 / size)
+    print "%-24s %10.3f us" % ("release", release_seconds * 1e6 / size)
+    print "%-24s %10.3f us  (%d registrations, %d free after)" % ("allocate + release", churn_seconds * 1e6 / churn,
+                                                                  churn, allocator.GetFreeCount())
+
+
+def CheckRegistryInvariants(RequestHandler):
+    """Returns a list of everything that is inconsistent between the publishers, sessions and ports."""
+    problems = []
+    ports = set()
+
+    for key, publisher in RequestHandler.Pubs.Items():
+        if publisher.BroadcastPort in ports:
+            problems.append("port %d handed out twice" % publisher.BroadcastPort)
+        ports.add(publisher.BroadcastPort)
+
+        session = RequestHandler.Sessions.get(publisher.ClientAddress)
+        if session is None or session.Publishers.get(key) is not publisher:
+            problems.append("publisher %s missing from its session" % key)
+
+        for address, subscriber in publisher.Subs.items():
+            session = RequestHandler.Sessions.get(address)
+            if session is None or session.Subscriptions.get(key) is not subscriber:
+                problems.append("subscriber %s of %s missing from its session" % (address, key))
+
+    for address, session in RequestHandler.Sessions.items():
+        if session.IsEmpty():
+            problems.append("empty session %s" % (address,))
+
+        for key, publisher in session.Publishers.items():
+            if RequestHandler.Pubs.Get(key) is not publisher:
+                problems.append("session %s has removed publisher %s" % (address, key))
+
+        for key, subscriber in session.Subscriptions.items():
+            publisher = RequestHandler.Pubs.Get(key)
+            if publisher is None or publisher.Subs.get(address) is not subscriber:
+                problems.append("session %s has removed subscription %s" % (address, key))
+
+        for pattern, subscriber in session.Patterns.items():
+            if RequestHandler.Patterns.Get(pattern).get(address) is not subscriber:
+                problems.append("session %s has removed pattern %s" % (address, pattern))
+
+    for subscriber in RequestHandler.Patterns.Values():
+        session = RequestHandler.Sessions.get(subscriber.Key)
+        if session is None or session.Patterns.get(subscriber.Pattern) is not subscriber:
+            problems.append("pattern %s of %s missing from its session" % (subscriber.Pattern, subscriber.Key))
+
+    # every wildcard subscriber of a publisher is a live subscription that matches it.
+    for key, publisher in RequestHandler.Pubs.Items():
+        if RequestHandler.PublisherTopics.Get(key).get(key) is not publisher:
+            problems.append("publisher %s missing from the topics" % key)
+
+        for address, subscriber in publisher.Subs.items():
+            if subscriber.Pattern is not None and (RequestHandler.Patterns.Get(subscriber.Pattern).get(address) is not subscriber
+                                                   or subscriber not in RequestHandler.Patterns.Match(key)):
+                problems.append("publisher %s has removed pattern %s of %s" % (key, subscriber.Pattern, address))
+
+    if len(RequestHandler.PublisherTopics) != len(RequestHandler.Pubs):
+        problems.append("%d publishers in the topics and %d in the registry" % (len(RequestHandler.PublisherTopics),
+                                                                               len(RequestHandler.Pubs)))
+
+    # the discovery indexes have every publisher under its sensor type and nothing else.
+    sensor_types = dict()
+    for key, publisher in RequestHandler.Pubs.Items():
+        sensor_types.setdefault(publisher.SensorType, []).append(key)
+    if RequestHandler.Pubs.KeyIndex.Keys != sorted(key for keys in sensor_types.values() for key in keys):
+        problems.append("the key index does not match the registry")
+    for sensor_type, index in RequestHandler.Pubs.SensorTypeIndex.items():
+        if index.Keys != sorted(sensor_types.get(sensor_type, [])):
+            problems.append("the index of sensor type %d does not match the registry" % sensor_type)
+    if set(RequestHandler.Pubs.SensorTypeIndex) != set(sensor_types):
+        problems.append("the sensor type indexes are not the sensor types in the registry")
+
+    if RequestHandler.Ports.GetFreeCount() + len(ports) != RequestHandler.Ports.Size:
+        problems.append("%d ports free and %d in use out of %d" % (RequestHandler.Ports.GetFreeCount(), len(ports),
+                                                                   RequestHandler.Ports.Size))
+
+    return problems
+
+
+def BenchmarkRegistryStress(threads=8, seconds=3, keys=200, clients=64):
+    """Hammers add/remove/subscribe from many threads while housekeeping expires clients, then checks that
+       the publishers, sessions, wildcard subscriptions and ports still agree with each other."""
+    import random
+    import threading
+    import SMPCentralNodeRequestHandler as RequestHandler
+    from PortAllocator import PortAllocator
+    from TopicTrie import TopicTrie
+
+    class StressHandler(RequestHandler.SMPCentralNodeRequestHandler):
+        def __init__(self, client_address):
+            self.request = (None, NullSocket())
+            self.client_address = client_address
+
+    handlers = RequestHandler.SMPCentralNodeRequestHandler.CommandHandlers
+    codes = [Command.ADD_PUBLISHER, Command.REMOVE_PUBLISHER, Command.ADD_SUBSCRIBER, Command.REMOVE_SUBSCRIBER,
+             Command.KEEP_ALIVE]
+    # subscribers sometimes go for a pattern instead of a key.
+    patterns = ["stress/3/*", "stress/*/5", "stress/#"]
+    operations = [0]
+    errors = []
+    stop = threading.Event()
+
+    def Worker(seed):
+        rng = random.Random(seed)
+        count = 0
+        while not stop.is_set():
+            handler = StressHandler(("10.2.0.%d" % rng.randrange(clients), 40000))
+            code = rng.choice(codes)
+            key = rng.randrange(keys)
+            key = "stress/%d/%d" % (key % 8, key)
+            if code in (Command.ADD_SUBSCRIBER, Command.REMOVE_SUBSCRIBER) and rng.random() < 0.1:
+                key = rng.choice(patterns)
+            command = Command().CreateFromParams(code, 1, 0, key)
+            try:
+                handlers[code](handler, command)
+            except Exception as e:
+                errors.append(repr(e))
+            count = count + 1
+        operations[0] += count
+
+    def Housekeeping():
+        while not stop.is_set():
+            RequestHandler.HandleTimeout()
+            time.sleep(0.01)
+
+    ports = RequestHandler.Ports
+    timeout_limit = RequestHandler.TIMEOUT_LIMIT
+    RequestHandler.Ports = PortAllocator([(20000, 20000 + keys - 1)])
+    # short enough that clients keep expiring while the handlers are busy.
+    RequestHandler.TIMEOUT_LIMIT = 0.05
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        workers = [threading.Thread(target=Worker, args=(n,)) for n in range(threads)]
+        workers.append(threading.Thread(target=Housekeeping))
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        time.sleep(seconds)
+        stop.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+
+        problems = CheckRegistryInvariants(RequestHandler)
+        publishers = len(RequestHandler.Pubs)
+    finally:
+        sys.stdout = stdout
+        RequestHandler.Ports = ports
+        RequestHandler.TIMEOUT_LIMIT = timeout_limit
+        RequestHandler.Pubs.Clear()
+        RequestHandler.PublisherTopics = TopicTrie()
+        RequestHandler.Patterns = TopicTrie()
+        RequestHandler.Sessions.clear()
+        del RequestHandler.SessionDeadlines[:]
+        RequestHandler.Transactions.clear()
+
+    print "%d threads, %d operations in %.1f s, %.0f ops/s, %d publishers left" % (
+        threads, operations[0], elapsed, operations[0] / elapsed, publishers)
+    print "%d handler exceptions, %d invariant violations" % (len(errors), len(problems))
+    for problem in (errors + problems)[:10]:
+        print "    " + problem
+
+
+REQUEST_GENERATOR = """
+import select, socket, sys, time
+sys.path.insert(0, %(path)r)
+from Command import Command
+address = (%(ip)r, %(port)d)
+clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for n in range(%(clients)d)]
+# subscribing to publishers that don't exist is answered by the worker that owns the key.  Every request
+# has its own transaction id so none of them are answered from the response cache.
+requests = [Command.Codec.Encode(Command.ADD_SUBSCRIBER, n, 0, "bench/key%%d" %% (n %% 1000)) for n in range(32768)]
+outstanding = dict((client, 0) for client in clients)
+received = 0
+sent = 0
+start = time.time()
+while time.time() - start < %(seconds)f:
+    for client in clients:
+        # keep a few requests in flight per client so we measure the node and not the round trip.
+        while outstanding[client] < %(window)d:
+            client.sendto(requests[sent %% len(requests)], address)
+            outstanding[client] += 1
+            sent += 1
+    for client in select.select(clients, [], [], 0.01)[0]:
+        client.recv(256)
+        outstanding[client] = max(outstanding[client] - 1, 0)
+        received += 1
+    # requests lost to a full socket buffer are written off after a while.
+    if sent - received > %(clients)d * %(window)d * 4:
+        outstanding = dict((client, 0) for client in clients)
+print received
+"""
+
+
+def BenchmarkWorkers(counts=(1, 2, 4), seconds=3, generators=2):
+    """Requests answered per second by a central node split over more and more worker processes."""
+    import subprocess
+
+    path = os.path.dirname(os.path.abspath(__file__))
+    print "%-8s %12s %10s" % ("workers", "responses/s", "speedup")
+    baseline = None
+    for workers in counts:
+        port = 16010 + workers
+        node_script = "import sys; sys.path.insert(0, %r); import CentralNode; CentralNode.StartWorkers(%r, %d, %d)" % (
+            path, "127.0.0.1", port, workers)
+        if workers == 1:
+            node_script = "import sys; sys.path.insert(0, %r); import CentralNode; CentralNode.SMPCentralNode(%r, %d, %r).Start()" % (
+                path, "127.0.0.1", port, "eventloop")
+
+        node = subprocess.Popen([sys.executable, "-c", node_script], stdout=open(os.devnull, "w"))
+        try:
+            time.sleep(1)
+            script = REQUEST_GENERATOR % {"path": path, "ip": "127.0.0.1", "port": port, "clients": 32,
+                                          "window": 4, "seconds": seconds}
+            loads = [subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE) for n in range(generators)]
+            received = sum(int(load.communicate()[0]) for load in loads)
+        finally:
+            node.terminate()
+            node.wait()
+
+        rate = received / float(seconds)
+        if baseline is None:
+            baseline = rate
+        print "%-8d %12.0f %10.2f" % (workers, rate, rate / max(baseline, 1))
+
+    print "(%d CPUs on this machine)" % CountCPUs()
+
+
+def CountCPUs():
+    """Returns the number of CPUs, scaling past this many workers is not possible."""
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def BenchmarkHashRing(keys=100000, counts=(1, 2, 4, 8)):
+    """Share of the publisher keys that change central node when one more node joins the cluster, the
+       consistent hash ring against plain modulo hashing."""
+    from HashRing import HashRing
+
+    names = ["plant/%d/sensor/%d" % (n / 16, n % 16) for n in range(keys)]
+
+    print "%-8s %12s %12s %12s %16s" % ("nodes", "ring moved", "modulo moved", "ideal", "ring lookup us")
+    for count in counts:
+        nodes = ["10.0.0.%d:15001" % (n + 1) for n in range(count + 1)]
+        ring = HashRing(nodes[:count])
+
+        start = time.time()
+        before = [ring.GetNode(key) for key in names]
+        lookup_seconds = time.time() - start
+
+        ring.AddNode(nodes[count])
+        after = [ring.GetNode(key) for key in names]
+        ring_moved = sum(1 for old, new in zip(before, after) if old != new)
+
+        modulo_moved = sum(1 for key in names
+                           if ring.GetHash(key) % count != ring.GetHash(key) % (count + 1))
+
+        print "%-8s %11.1f%% %11.1f%% %11.1f%% %16.2f" % ("%d->%d" % (count, count + 1),
+                                                         100.0 * ring_moved / keys,
+                                                         100.0 * modulo_moved / keys,
+                                                         100.0 / (count + 1),
+                                                         lookup_seconds * 1e6 / keys)
+
+
+def BenchmarkLogging(calls=200000):
+    """Cost on the calling thread of one per packet log line, the old print against the logger with
+       the level off and on, and what gets dropped when the writer can't keep up."""
+    import os
+
+    address = ("10.0.0.1", 40000)
+    devnull = open(os.devnull, "w")
+    stdout = sys.stdout
+    level = Log.Level
+
+    # what every keep alive used to cost, with the console taken out of the picture.
+    sys.stdout = devnull
+    try:
+        start = time.time()
+        for n in range(calls):
+            print "Keep alive was from " + str(address) + "."
+        print_seconds = time.time() - start
+    finally:
+        sys.stdout = stdout
+
+    Log.SetOutput(devnull)
+    try:
+        Log.SetLevel(Log.INFO)
+        start = time.time()
+        for n in range(calls):
+            Log.Debug("Keep alive was from %s.", address)
+        disabled_seconds = time.time() - start
+
+        # a burst that fits in the buffer, the writer catches up afterwards.
+        Log.SetLevel(Log.DEBUG)
+        burst = Log.Capacity / 2
+        Log.Flush()
+        start = time.time()
+        for n in range(burst):
+            Log.Debug("Keep alive was from %s.", address)
+        enabled_seconds = time.time() - start
+        Log.Flush()
+
+        # a flood much bigger than the buffer.
+        dropped = Log.Dropped
+        start = time.time()
+        for n in range(calls):
+            Log.Debug("Keep alive was from %s.", address)
+        flood_seconds = time.time() - start
+        Log.Flush()
+        dropped = Log.Dropped - dropped
+    finally:
+        Log.SetLevel(level)
+        Log.SetOutput(stdout)
+        devnull.close()
+
+    print "%-28s %10.3f us" % ("print to /dev/null", print_seconds * 1e6 / calls)
+    print "%-28s %10.3f us" % ("Log.Debug, level off", disabled_seconds * 1e6 / calls)
+    print "%-28s %10.3f us" % ("Log.Debug, level on", enabled_seconds * 1e6 / burst)
+    print "%-28s %10.3f us  (%d of %d dropped)" % ("Log.Debug, flooded", flood_seconds * 1e6 / calls,
+                                                    dropped, calls)
+
+
+def BenchmarkMetrics(calls=200000, publishers=10000):
+    """What the handlers pay per request to keep the stats, and what one scrape costs."""
+    from Metrics import MetricsRegistry
+    import SMPCentralNodeRequestHandler as RequestHandler
+    from Publisher import Publisher
+
+    registry = MetricsRegistry()
+    counter = registry.GetCounter("packets")
+    histogram = registry.GetHistogram("latency_us")
+
+    start = time.time()
+    for n in range(calls):
+        counter.Increment()
+    counter_seconds = time.time() - start
+
+    start = time.time()
+    for n in range(calls):
+        histogram.Record(n % 1000 + 0.5)
+    histogram_seconds = time.time() - start
+
+    # a scrape walks every publisher for the subscriber counts.
+    for n in range(publishers):
+        RequestHandler.Pubs.Add(Publisher("bench/pub/%d" % n, (None, NullSocket()), ("10.0.0.1", n), 15002))
+    try:
+        start = time.time()
+        text = RequestHandler.Stats.Format()
+        scrape_seconds = time.time() - start
+    finally:
+        RequestHandler.Pubs.Clear()
+
+    print "%-28s %10.3f us" % ("counter increment", counter_seconds * 1e6 / calls)
+    print "%-28s %10.3f us" % ("histogram record", histogram_seconds * 1e6 / calls)
+    print "%-28s %10.3f ms  (%d publishers, %d bytes)" % ("scrape", scrape_seconds * 1e3, publishers, len(text))
+
+
+def BenchmarkRestore(publishers=50000, subscribers=50000):
+    """Time to bring back a central node with publishers + subscribers registrations, replaying the whole
+       write ahead log and then loading a compacted snapshot."""
+    import shutil
+    import tempfile
+    import SMPCentralNodeRequestHandler as RequestHandler
+    from PortAllocator import PortAllocator
+    from Publisher import Publisher
+    from RegistryJournal import RegistryJournal
+    from TopicTrie import TopicTrie
+
+    def Reset():
+        if RequestHandler.Journal is not None:
+            RequestHandler.Journal.Close()
+        RequestHandler.Journal = None
+        RequestHandler.Pubs.Clear()
+        RequestHandler.PublisherTopics = TopicTrie()
+        RequestHandler.Patterns = TopicTrie()
+        RequestHandler.Sessions.clear()
+        del RequestHandler.SessionDeadlines[:]
+        RequestHandler.Ports = PortAllocator([(10000, 10000 + publishers - 1)])
+
+    def Restore():
+        start = time.time()
+        RequestHandler.RestoreRegistry(RegistryJournal(directory), NullSocket())
+        return time.time() - start
+
+    directory = tempfile.mkdtemp()
+    ports = RequestHandler.Ports
+    try:
+        journal = RegistryJournal(directory)
+        journal.Open()
+        start = time.time()
+        for n in range(publishers):
+            journal.AddPublisher(Publisher("bench/pub/%d" % n, (None, None), ("10.0.0.%d" % (n % 250), 40000 + n % 1000),
+                                           10000 + n))
+        for n in range(subscribers):
+            journal.AddSubscriber("bench/pub/%d" % (n % publishers), ("10.1.0.%d" % (n % 250), 50000 + n % 1000))
+        journal.Sync()
+        append_seconds = time.time() - start
+        journal.Close()
+        log_bytes = os.path.getsize(journal.LogPath)
+
+        Reset()
+        log_seconds = Restore()
+        restored = len(RequestHandler.Pubs)
+
+        start = time.time()
+        RequestHandler.Journal.Compact(RequestHandler.GetRegistryRecords)
+        compact_seconds = time.time() - start
+        snapshot_bytes = os.path.getsize(journal.SnapshotPath)
+
+        Reset()
+        snapshot_seconds = Restore()
+        problems = CheckRegistryInvariants(RequestHandler)
+    finally:
+        Reset()
+        RequestHandler.Ports = ports
+        shutil.rmtree(directory)
+
+    registrations = publishers + subscribers
+    print "%-28s %10.3f us  (%d bytes)" % ("append", append_seconds * 1e6 / registrations, log_bytes)
+    print "%-28s %10.1f ms  (%d publishers)" % ("restore from log", log_seconds * 1e3, restored)
+    print "%-28s %10.1f ms  (%d bytes)" % ("compact", compact_seconds * 1e3, snapshot_bytes)
+    print "%-28s %10.1f ms" % ("restore from snapshot", snapshot_seconds * 1e3)
+    print "%d invariant violations" % len(problems)
+
+
+def BenchmarkBursts(burst=64, rounds=200, rate=20000, seconds=3):
+    """Per datagram cost of reading and answering bursts with recvmmsg/sendmmsg against one recvfrom/sendto
+       per datagram, and the datagrams the event loop gets per wakeup under load."""
+    import socket
+    import BatchSocket
+    from CentralNode import SMPCentralNode
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.setblocking(0)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind(("127.0.0.1", 0))
+    packet = Command.Codec.Encode(Command.SUCCESS, 1, 0, 15002)
+    address = receiver.getsockname()
+
+    modes = [("recvfrom/sendto", False)]
+    if BatchSocket.HAVE_MMSG:
+        modes.append(("recvmmsg/sendmmsg", True))
+    else:
+        print "recvmmsg/sendmmsg not available, only the fallback is measured"
+
+    print "%-20s %14s %14s" % ("", "us recv/pkt", "us send/pkt")
+    for name, use_mmsg in modes:
+        batch_receiver = BatchSocket.BatchReceiver(receiver, burst, 4096, use_mmsg)
+        batch_sender = BatchSocket.BatchSender(sender, use_mmsg)
+        receive_seconds = send_seconds = 0.0
+        received = 0
+        for n in range(rounds):
+            start = time.time()
+            batch_sender.Begin()
+            for m in range(burst):
+                batch_sender.sendto(packet, address)
+            batch_sender.Flush()
+            send_seconds = send_seconds + time.time() - start
+
+            start = time.time()
+            received = received + len(batch_receiver.Receive())
+            receive_seconds = receive_seconds + time.time() - start
+
+        print "%-20s %14.2f %14.2f" % (name, receive_seconds * 1e6 / max(received, 1),
+                                       send_seconds * 1e6 / (burst * rounds))
+
+    receiver.close()
+    sender.close()
+
+    print
+    print "%-20s %10s %10s %10s %12s" % ("event loop", "sent", "handled", "wakeups", "us CPU/pkt")
+    for port, (name, use_mmsg) in zip((16003, 16004), modes):
+        central_node = SMPCentralNode("127.0.0.1", port, SMPCentralNode.ENGINE_EVENT_LOOP)
+        server = central_node.Server
+        server.Receiver = BatchSocket.BatchReceiver(server.socket, server.MAX_DRAIN, server.MAX_DATAGRAM_SIZE, use_mmsg)
+        server.Sender = BatchSocket.BatchSender(server.socket, use_mmsg)
+        sent, handled, housekeeping, cpu = RunCentralNodeLoad(central_node, port, rate, seconds)
+        print "%-20s %10d %10d %10d %12.1f   %.1f datagrams per wakeup" % (
+            name, sent, handled, server.Wakeups, cpu * 1e6 / max(handled, 1),
+            float(server.Datagrams) / max(server.Wakeups, 1))
+
+
+def BenchmarkAdmission(calls=200000, clients=10000):
+    """Cost of the rate limit check per packet, and what a client spamming random 13-44 byte packets costs
+       the central node with and without rate limits."""
+    import random
+    from AdmissionControl import AdmissionControl
+    import SMPCentralNodeRequestHandler as RequestHandler
+
+    admission = AdmissionControl()
+    keep_alive = Command.Codec.Encode(Command.KEEP_ALIVE, 0, 0, " ")
+    addresses = [("10.3.%d.%d" % (n // 250, n % 250), 40000) for n in range(clients)]
+
+    # clients well under their limits, one keep alive each per round.
+    now = time.time()
+    start = time.time()
+    for n in range(calls):
+        admission.Admit(keep_alive, addresses[n % clients], now + n * 1e-6)
+    admitted_seconds = time.time() - start
+
+    # one client far over its limit.
+    start = time.time()
+    for n in range(calls):
+        admission.Admit(keep_alive, addresses[0], now + 1.0)
+    throttled_seconds = time.time() - start
+
+    class SpamHandler(RequestHandler.SMPCentralNodeRequestHandler):
+        def __init__(self, client_address):
+            self.request = (None, NullSocket())
+            self.client_address = client_address
+
+    rng = random.Random(1)
+    spam = ["".join(chr(rng.randrange(256)) for m in range(rng.randrange(13, 45))) for n in range(1000)]
+    spammer = SpamHandler(("10.4.0.1", 40000))
+
+    log_level = Log.Level
+    Log.SetLevel(Log.OFF)
+    try:
+        results = []
+        for limits in (None, AdmissionControl()):
+            RequestHandler.Admission = limits
+            start = time.time()
+            for n in range(calls // 10):
+                spammer.HandleRequest(spam[n % len(spam)])
+            results.append(time.time() - start)
+    finally:
+        RequestHandler.Admission = None
+        Log.SetLevel(log_level)
+
+    print "%-28s %10.3f us" % ("admit", admitted_seconds * 1e6 / calls)
+    print "%-28s %10.3f us" % ("throttle", throttled_seconds * 1e6 / calls)
+    print "%-28s %10.3f us" % ("spam, no limits", results[0] * 1e6 / (calls // 10))
+    print "%-28s %10.3f us" % ("spam, rate limited", results[1] * 1e6 / (calls // 10))
+    print "%d buckets for %d clients" % (len(admission), clients)
+
+
+def BenchmarkPipeline(keys=500, port=16005):
+    """Time for one client to subscribe to keys publishers with a command per round trip against one
+       sendCentralNodeBatch call, and the datagrams each way takes."""
+    import threading
+    from CentralNode import SMPCentralNode
+    from SMPClient import SMPClient
+    import SMPCentralNodeRequestHandler as RequestHandler
+    from TopicTrie import TopicTrie
+
+    log_level = Log.Level
+    Log.SetLevel(Log.WARNING)
+    central_node = SMPCentralNode("127.0.0.1", port, SMPCentralNode.ENGINE_EVENT_LOOP, ports="20000-29999")
+    node_thread = threading.Thread(target=central_node.Start)
+    node_thread.daemon = True
+    node_thread.start()
+
+    try:
+        publisher = SMPClient("127.0.0.1", SMPClient.SMP_CLIENT_TYPE_PUBLISHER, "bench", 0, False, False)
+        publisher.SMPCentralNodeAddress = ("127.0.0.1", port)
+        publisher.sendCentralNodeBatch([(Command.ADD_PUBLISHER, "bench/pub%d" % n) for n in range(keys)])
+
+        print "%-12s %10s %10s %10s" % ("", "seconds", "sent", "subscribed")
+        for name in ("one by one", "batch"):
+            subscriber = SMPClient("127.0.0.1", SMPClient.SMP_CLIENT_TYPE_SUBSCRIBER, "bench", 0, False, False)
+            subscriber.SMPCentralNodeAddress = ("127.0.0.1", port)
+            start = time.time()
+            if name == "batch":
+                responses = subscriber.sendCentralNodeBatch([(Command.ADD_SUBSCRIBER, "bench/pub%d" % n)
+                                                             for n in range(keys)])
+            else:
+                responses = [subscriber.sendCentralNodeCommand(Command.ADD_SUBSCRIBER, subscriber.getTransactionId(),
+                                                               "bench/pub%d" % n, True) for n in range(keys)]
+            seconds = time.time() - start
+
+            subscribed = sum(1 for response in responses if response is not None and response.Code == Command.SUCCESS)
+            print "%-12s %10.3f %10d %10d" % (name, seconds, subscriber.PacketsSent.Value, subscribed)
+            subscriber.ClientSocket.close()
+
+        publisher.ClientSocket.close()
+    finally:
+        central_node.Stop()
+        node_thread.join(2)
+        central_node.Server.server_close()
+        Log.SetLevel(log_level)
+        RequestHandler.Pubs.Clear()
+        RequestHandler.PublisherTopics = TopicTrie()
+        RequestHandler.Patterns = TopicTrie()
+        RequestHandler.Sessions.clear()
+        del RequestHandler.SessionDeadlines[:]
+        RequestHandler.Transactions.clear()
+
+
+GATEWAY_CLIENT = """
+import os, sys, time
+sys.path.insert(0, %(path)r)
+import SMPClient
+SMPClient.SMPClient.SMP_CENTRAL_NODE_PORT = %(port)d
+from SMPPublisherClient import SMPPublisherClient
+from SMPPublisherGateway import SMPPublisherGateway
+
+def GetStatus(field):
+    for line in open("/proc/self/status"):
+        if line.startswith(field + ":"):
+            return int(line.split()[1])
+
+rss = GetStatus("VmRSS")
+start = time.time()
+if %(model)r == "gateway":
+    gateway = SMPPublisherGateway("127.0.0.1")
+    gateway.addPubs([("bench/%(model)s%%d" %% n, 1) for n in range(%(publishers)d)])
+    registered = len(gateway.Streams)
+else:
+    clients = [SMPPublisherClient("127.0.0.1", "bench/%(model)s%%d" %% n, 1) for n in range(%(publishers)d)]
+    registered = sum(1 for client in clients if client.addPub() is not None)
+seconds = time.time() - start
+
+# registered and idle, each publisher gets a sample a second that waits for a subscriber
+cpu = os.times()
+for second in range(%(seconds)d):
+    if %(model)r == "gateway":
+        for n in range(%(publishers)d):
+            gateway.publishData("bench/%(model)s%%d" %% n, ["sample"])
+    else:
+        for client in clients:
+            client.publishData(["sample"])
+    time.sleep(1)
+end = os.times()
+print registered, seconds, (end[0] - cpu[0]) + (end[1] - cpu[1]), GetStatus("VmRSS") - rss, GetStatus("Threads"), len(os.listdir("/proc/self/fd"))
+sys.stdout.flush()
+os._exit(0)
+"""
+
+
+def BenchmarkGateway(publishers=200, seconds=6, port=16020):
+    """Memory, threads, sockets and CPU of a process hosting publishers with an SMPPublisherClient each against
+       one SMPPublisherGateway, while they sit registered through a keep alive interval."""
+    import subprocess
+
+    path = os.path.dirname(os.path.abspath(__file__))
+    node_script = "import sys; sys.path.insert(0, %r); import CentralNode, Log; Log.SetLevel(Log.WARNING); " \
+                  "CentralNode.SMPCentralNode(%r, %d, %r, ports=%r).Start()" % (
+                      path, "127.0.0.1", port, "eventloop", "20000-29999")
+    node = subprocess.Popen([sys.executable, "-c", node_script], stdout=open(os.devnull, "w"))
+    try:
+        time.sleep(1)
+        print "%-10s %10s %12s %10s %10s %8s %8s" % ("", "publishers", "register s", "CPU s", "RSS KB", "threads", "fds")
+        for model in ("clients", "gateway"):
+            script = GATEWAY_CLIENT % {"path": path, "port": port, "model": model, "publishers": publishers,
+                                       "seconds": seconds}
+            output = subprocess.check_output([sys.executable, "-c", script]).split()
+            registered, register_seconds, cpu, rss, threads, fds = output[-6:]
+            print "%-10s %10s %12.3f %10.2f %10s %8s %8s" % (model, registered, float(register_seconds), float(cpu),
+                                                            rss, threads, fds)
+    finally:
+        node.terminate()
+        node.wait()
+
+
+def BenchmarkResponseCache(calls=100000, publishers=1000):
+    """What the response cache adds to every registry command, and a duplicate answered from it against the
+       same command carried out again."""
+    import SMPCentralNodeRequestHandler as RequestHandler
+    from ResponseCache import ResponseCache
+    from PortAllocator import PortAllocator
+    from TimerWheel import TimerWheel
+    from TopicTrie import TopicTrie
+
+    class CacheHandler(RequestHandler.SMPCentralNodeRequestHandler):
+        def __init__(self, client_address):
+            self.request = (None, NullSocket())
+            self.client_address = client_address
+
+    ports = RequestHandler.Ports
+    responses = RequestHandler.Responses
+    log_level = Log.Level
+    Log.SetLevel(Log.OFF)
+    RequestHandler.Ports = PortAllocator([(20000, 20000 + publishers - 1)])
+    try:
+        owner = CacheHandler(("10.5.0.1", 40000))
+        for n in range(publishers):
+            owner.HandleCommand(Command.Codec.Decode(Command.Codec.Encode(Command.ADD_PUBLISHER, n, 0, "bench/pub%d" % n)))
+
+        # the same subscriber removed and added again, each command with its own transaction id.
+        subscriber = CacheHandler(("10.5.0.2", 40000))
+        commands = [Command.Codec.Decode(Command.Codec.Encode(code, n % 32768, 0, "bench/pub%d" % (n // 2 % publishers)))
+                    for n, code in zip(range(calls), [Command.ADD_SUBSCRIBER, Command.REMOVE_SUBSCRIBER] * calls)]
+
+        print "%-28s %10s" % ("", "us/command")
+        response_cache = ResponseCache()
+        for name, cache in (("no cache", None), ("cache, new commands", response_cache)):
+            # every pass starts without the START_PUBLISHING transactions the one before left behind.
+            RequestHandler.Transactions.clear()
+            RequestHandler.TransactionTimers = TimerWheel()
+            RequestHandler.Responses = cache
+            start = time.time()
+            for command in commands:
+                subscriber.HandleCommand(command)
+            print "%-28s %10.2f" % (name, (time.time() - start) * 1e6 / calls)
+
+        # the last command again and again, answered from the cache or carried out every time.
+        duplicate = commands[-1]
+        for name, cache in (("duplicate, carried out", None), ("duplicate, from the cache", response_cache)):
+            RequestHandler.Responses = cache
+            start = time.time()
+            for n in range(calls):
+                subscriber.HandleCommand(duplicate)
+            print "%-28s %10.2f" % (name, (time.time() - start) * 1e6 / calls)
+    finally:
+        RequestHandler.Responses = responses
+        RequestHandler.Ports = ports
+        RequestHandler.TransactionTimers = TimerWheel()
+        Log.SetLevel(log_level)
+        RequestHandler.Pubs.Clear()
+        RequestHandler.PublisherTopics = TopicTrie()
+        RequestHandler.Patterns = TopicTrie()
+        RequestHandler.Sessions.clear()
+        del RequestHandler.SessionDeadlines[:]
+        RequestHandler.Transactions.clear()
+
+
+def LegacyMatch(patterns, topic):
+    """Wildcard matching without a trie, every pattern is checked against the topic level by level."""
+    levels = topic.split("/")
+    matches = []
+    for pattern in patterns:
+        wanted = pattern.split("/")
+        for n, level in enumerate(wanted):
+            if level == "#":
+                matches.append(pattern)
+                break
+            if n >= len(levels) or (level != "*" and level != levels[n]):
+                break
+        else:
+            if len(wanted) == len(levels):
+                matches.append(pattern)
+    return matches
+
+
+def BenchmarkTopics(publishers=100000, counts=(10, 1000, 100000), lookups=2000):
+    """Finding the wildcard subscriptions a new publisher matches, and the publishers a new pattern matches,
+       with the topic tries against checking every pattern or publisher."""
+    import random
+    from TopicTrie import TopicTrie
+
+    rng = random.Random(23)
+    keys = ["site%d/line%d/sensor%d" % (n % 100, n // 100 % 10, n) for n in range(publishers)]
+    publisher_topics = TopicTrie()
+    for key in keys:
+        publisher_topics.Add(key, key, key)
+
+    def GetPattern(n):
+        site, line = rng.randrange(1000), rng.randrange(10)
+        return ["site%d/line%d/#" % (site, line), "site%d/*/sensor%d" % (site, n), "*/line%d/sensor%d" % (line, n),
+                "site%d/#" % site][n % 4]
+
+    print "%-10s %10s %14s %14s" % ("patterns", "method", "us/publisher", "matches")
+    for count in counts:
+        patterns = [GetPattern(n) for n in range(count)]
+        trie = TopicTrie()
+        for n, pattern in enumerate(patterns):
+            trie.Add(pattern, n, pattern)
+
+        topics = [rng.choice(keys) for n in range(lookups)]
+        # the scan is slow with many patterns, time fewer lookups.
+        sample = topics if count <= 1000 else topics[:20]
+        for name, match in (("scan", lambda topic: LegacyMatch(patterns, topic)), ("trie", trie.Match)):
+            start = time.time()
+            found = 0
+            for topic in sample:
+                found = found + len(match(topic))
+            print "%-10d %10s %14.2f %14.2f" % (count, name, (time.time() - start) * 1e6 / len(sample),
+                                                float(found) / len(sample))
+
+    print
+    print "%-10s %10s %14s %14s" % ("publishers", "method", "us/pattern", "matches")
+    sample = [GetPattern(n) for n in range(20)]
+    for name, find in (("scan", lambda pattern: [key for key in keys if LegacyMatch([pattern], key)]),
+                       ("trie", publisher_topics.Find)):
+        start = time.time()
+        found = 0
+        for pattern in sample:
+            found = found + len(find(pattern))
+        print "%-10d %10s %14.2f %14.2f" % (publishers, name, (time.time() - start) * 1e6 / len(sample),
+                                            float(found) / len(sample))
+
+
+def LegacyDiscover(pubs, prefix, sensor_type, page):
+    """Discovery without indexes, every publisher is looked at and the matches sorted for the first page."""
+    keys = sorted(key for key, publisher in pubs.Items()
+                  if key.startswith(prefix) and (sensor_type is None or publisher.SensorType == sensor_type))
+    return keys[:page]
+
+
+def BenchmarkDiscover(counts=(1000, 10000, 100000), queries=200):
+    """Time to answer one DISCOVER page as the central node gets more publishers, with the sorted indexes
+       against looking at every publisher."""
+    import SMPCentralNodeRequestHandler as RequestHandler
+    from PublisherRegistry import PublisherRegistry
+    from Publisher import Publisher
+
+    class DiscoverHandler(RequestHandler.SMPCentralNodeRequestHandler):
+        def __init__(self):
+            self.request = (None, NullSocket())
+            self.client_address = ("10.6.0.1", 40000)
+
+    handler = DiscoverHandler()
+    pubs = RequestHandler.Pubs
+    try:
+        print "%-10s %-28s %10s %10s %10s" % ("publishers", "query", "method", "us/page", "entries")
+        for count in counts:
+            registry = PublisherRegistry()
+            registry.Load(dict(("site%d/line%d/sensor%d" % (n % 100, n // 100 % 10, n),
+                                Publisher("site%d/line%d/sensor%d" % (n % 100, n // 100 % 10, n), (None, NullSocket()),
+                                          ("10.6.0.2", n), 15002, n % 16))
+                               for n in range(count)))
+            RequestHandler.Pubs = registry
+
+            for prefix, sensor_type in (("", None), ("site7/", None), ("site7/line3/", 3)):
+                reserved = 0 if sensor_type is None else Command.DISCOVER_BY_SENSOR_TYPE
+                command = Command.Codec.Decode(Command.Codec.Encode(Command.DISCOVER, 1, sensor_type or 0,
+                                                                    Command.PackDiscover(prefix), reserved))
+                name = "%s sensor type %s" % (prefix or "*", sensor_type)
+
+                start = time.time()
+                for n in range(queries):
+                    response = handler.HandleDiscover(command)
+                elapsed = time.time() - start
+                entries = len(Command.UnpackDiscoverResponse(Command.Codec.Decode(response).Payload)[1])
+                print "%-10d %-28s %10s %10.2f %10d" % (count, name, "index", elapsed * 1e6 / queries, entries)
+
+                # the scan is slow with many publishers, time fewer queries.
+                sample = queries if count <= 10000 else queries // 20
+                start = time.time()
+                for n in range(sample):
+                    LegacyDiscover(registry, prefix, sensor_type, entries)
+                print "%-10d %-28s %10s %10.2f %10d" % (count, name, "scan", (time.time() - start) * 1e6 / sample,
+                                                        entries)
+    finally:
+        RequestHandler.Pubs = pubs
+
+
+def LegacyPublisherLoop(lock, event, queue):
+    """The publisher data loop from before the publish queue, it polls the deque whether there is data or not."""
+    while not lock.acquire(False):
+        if event.isSet():
+            packets = queue.maxlen
+            while packets > 0:
+                try:
+                    queue.popleft()
+                    packets -= 1
+                except IndexError:
+                    None
+
+
+def BenchmarkPublishQueue(seconds=2, samples=200000, queue_size=4096):
+    """CPU an idle publisher burns waiting for data with the old polling loop against the publish queue, and
+       the cost of moving samples from a producer to the data thread with each full queue policy."""
+    import collections
+    import threading
+    import PublishQueue
+
+    def GetCPU():
+        return sum(os.times()[:2])
+
+    def QueueLoop(lock, queue):
+        while not lock.acquire(False):
+            queue.take(queue.maxlen)
+
+    print "%-24s %14s" % ("idle publisher", "cpu s/s")
+    for name in ("polling, stopped", "polling, publishing", "queue, stopped", "queue, publishing"):
+        lock = threading.Semaphore()
+        lock.acquire()
+        if name.startswith("polling"):
+            event = threading.Event()
+            if name.endswith("publishing"):
+                event.set()
+            polled = collections.deque(maxlen=queue_size)
+            thread = threading.Thread(target=LegacyPublisherLoop, args=(lock, event, polled))
+        else:
+            queue = PublishQueue.PublishQueue(queue_size)
+            queue.setEnabled(name.endswith("publishing"))
+            thread = threading.Thread(target=QueueLoop, args=(lock, queue))
+
+        thread.start()
+        start = GetCPU()
+        time.sleep(seconds)
+        used = GetCPU() - start
+        lock.release()
+        if name.startswith("polling"):
+            # the old loop only looks at the lock again once it has sent a queue full.
+            polled.extend(["sample"] * queue_size)
+        else:
+            queue.wake()
+        thread.join()
+        print "%-24s %14.3f" % (name, used / seconds)
+
+    print
+    print "%-24s %14s %10s %10s %10s" % ("policy", "us/sample", "sent", "dropped", "rejected")
+    data = ["sample"] * samples
+    for policy in PublishQueue.POLICIES:
+        lock = threading.Semaphore()
+        lock.acquire()
+        queue = PublishQueue.PublishQueue(queue_size, policy)
+        queue.setEnabled(True)
+        sent = []
+        def Consume():
+            while not lock.acquire(False):
+                sent.append(len(queue.take(queue.maxlen)))
+        thread = threading.Thread(target=Consume)
+        thread.start()
+
+        start = time.time()
+        for n in range(0, samples, 64):
+            try:
+                queue.extend(data[n:n + 64])
+            except PublishQueue.QueueFull:
+                None
+        elapsed = time.time() - start
+
+        # let the data thread empty the queue before it stops
+        while len(queue):
+            time.sleep(0.01)
+        lock.release()
+        queue.wake()
+        thread.join()
+        print "%-24s %14.2f %10d %10d %10d" % (policy, elapsed * 1e6 / samples, sum(sent), queue.Drops.Value,
+                                                queue.Rejected.Value)
+
+
+BENCHMARKS = [
+    ("crc", BenchmarkCRC),
+    ("codec", BenchmarkCodec),
+    ("encoding", BenchmarkDataEncoding),
+    ("compression", BenchmarkCompression),
+    ("engines", BenchmarkCentralNodeEngines),
+    ("retransmit", BenchmarkRetransmit),
+    ("sessions", BenchmarkSessions),
+    ("liveness", BenchmarkLiveness),
+    ("ports", BenchmarkPorts),
+    ("stress", BenchmarkRegistryStress),
+    ("workers", BenchmarkWorkers),
+    ("ring", BenchmarkHashRing),
+    ("logging", BenchmarkLogging),
+    ("metrics", BenchmarkMetrics),
+    ("restore", BenchmarkRestore),
+    ("bursts", BenchmarkBursts),
+    ("admission", BenchmarkAdmission),
+    ("pipeline", BenchmarkPipeline),
+    ("gateway", BenchmarkGateway),
+    ("responses", BenchmarkResponseCache),
+    ("topics", BenchmarkTopics),
+    ("discover", BenchmarkDiscover),
+    ("publishqueue", BenchmarkPublishQueue),
+]
+
+
+def main(args):
+    names = args[1:]
+    for name, func in BENCHMARKS:
+        if not names or name in names:
+            print "\n[" + name + "]"
+            func()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -4,48 +4,192 @@
 # This module calculates the IEEE-32-bit CRC using the standard aglorithm.
 # it is used to ensure data integrity of messages.
 
-import ctypes
+import struct
+import sys
+import zlib
+
+# zlib only accepts read-only buffers in python 2, so we use buffer() to get a zero copy view
+# of part of a packet.  Python 3 dropped buffer() in favor of memoryview.
+if sys.version_info[0] < 3:
+    def View(data, offset, length):
+        return buffer(data, offset, length)
+else:
+    def View(data, offset, length):
+        return memoryview(data)[offset:offset + length]
+
 
 class CRCCalculator(object):
     """Object for calculating IEEE-32-bit CRCs using the standard polynomial 0xedb88320."""
 
-    # This is the actual look up table.
+    # The different ways we know how to calculate the same CRC.
+    BACKEND_TABLE = "table"
+    BACKEND_SLICING8 = "slicing8"
+    BACKEND_ZLIB = "zlib"
+
+    POLYNOMIAL = 0xedb88320
+    MINUS_ONE_UINT32 = 0xFFFFFFFF
+
+    # This is the actual look up table, slicing by 8 needs 7 more derived from the first one.
+    # These are shared by every instance and only built once when the module is loaded.
     CRCTable = []
+    SlicingTables = []
+
+    # Set once we have checked that zlib gives us the exact same answer as the table.
+    ZlibVerified = False
+
+    def __init__(self, backend=None):
+        """Public constructor picks the backend.  If no backend is given we use the fastest one we trust."""
+        self.Polynomial = self.POLYNOMIAL
+        self.MinusOneUint32 = self.MINUS_ONE_UINT32
+
+        if backend is None:
+            backend = self.GetDefaultBackend()
+
+        if backend == self.BACKEND_TABLE:
+            self.Update = self.UpdateTable
+        elif backend == self.BACKEND_SLICING8:
+            self.Update = self.UpdateSlicing8
+        elif backend == self.BACKEND_ZLIB:
+            if not self.ZlibVerified:
+                raise ValueError("zlib crc32 does not match the table CRC on this platform")
+            self.Update = self.UpdateZlib
+        else:
+            raise ValueError("Unknown CRC backend " + str(backend))
+
+        self.Backend = backend
 
-    def __init__(self):
-        """Public constructor builds the CRC table and sets up the polynomials."""
-        # make these calls to build the underlying type once since we have to use them a bunch.
-        self.Polynomial = ctypes.c_uint32(0xedb88320).value
-        self.MinusOneUint32 = ctypes.c_uint32(0xFFFFFFFF).value
 
-        # actually make the call to build the table.
-        self.BuildCRCTable()
+    @classmethod
+    def GetDefaultBackend(cls):
+        """Returns the backend new calculators use when none is asked for."""
+        if cls.ZlibVerified:
+            return cls.BACKEND_ZLIB
+        return cls.BACKEND_SLICING8
 
 
-    def BuildCRCTable(self):
-        """Builds the CRC table.  This function should not be called by the user."""
+    @classmethod
+    def GetBackends(cls):
+        """Returns a list of all of the backends that can be used on this platform."""
+        backends = [cls.BACKEND_TABLE, cls.BACKEND_SLICING8]
+        if cls.ZlibVerified:
+            backends.append(cls.BACKEND_ZLIB)
+        return backends
+
+
+    @classmethod
+    def BuildCRCTable(cls):
+        """Builds the CRC tables.  This function should not be called by the user, it runs once on import."""
+
+        # only ever build the table once no matter how many calculators are created.
+        if cls.CRCTable:
+            return
 
         # actually build the table from the polynomial.
+        table = []
         for n in range(256):
-            # has to be a uint32.
-            c = ctypes.c_uint32(n).value
+            c = n
             for k in range(8):
                 if(c & 1):
-                    c = self.Polynomial ^ (c >> 1)
+                    c = cls.POLYNOMIAL ^ (c >> 1)
                 else:
                     c = (c >> 1)
-        
-            self.CRCTable.append(ctypes.c_uint32(c).value)
 
+            table.append(c)
+
+        # each slicing table advances the previous one by another zero byte.
+        slicing = [table]
+        for k in range(1, 8):
+            prev = slicing[k - 1]
+            slicing.append([(prev[n] >> 8) ^ table[prev[n] & 0xFF] for n in range(256)])
+
+        cls.CRCTable = table
+        cls.SlicingTables = slicing
 
-    def CalculateCRC(self, data):
+        # only trust zlib if it agrees with the table on a few check values.
+        calc = object.__new__(cls)
+        cls.ZlibVerified = True
+        for check in (b"", b"123456789", bytes(bytearray(range(256))) * 3):
+            if calc.UpdateZlib(0, check) != calc.UpdateTable(0, check):
+                cls.ZlibVerified = False
+
+
+    def CalculateCRC(self, data, length=None):
         """This function actually calcualtes the CRC32 from some data.  Whatever you pass you should
-           convert to a string or an array of bytes."""
+           convert to a string or an array of bytes.  If length is given only the first length bytes
+           are used, without copying them."""
+        if length is not None:
+            data = View(data, 0, length)
+
+        return self.Update(0, data)
+
+
+    def CreateStream(self):
+        """Returns a CRCStream so large data can be checksummed a chunk at a time."""
+        return CRCStream(self)
+
+
+    def UpdateTable(self, crc, data):
+        """Continues a CRC over data one byte at a time with the classic lookup table."""
+        table = self.CRCTable
+        c = crc ^ self.MINUS_ONE_UINT32
+
+        for b in bytearray(data):
+            c = table[(c ^ b) & 0xFF] ^ (c >> 8)
+
+        return c ^ self.MINUS_ONE_UINT32
+
+
+    def UpdateSlicing8(self, crc, data):
+        """Continues a CRC over data eight bytes at a time with the slicing by 8 tables."""
+        t0, t1, t2, t3, t4, t5, t6, t7 = self.SlicingTables
+        c = crc ^ self.MINUS_ONE_UINT32
+
+        raw_bytes = bytes(bytearray(data))
+        blocks = len(raw_bytes) >> 3
+
+        # read two little endian words at a time since the crc is bit reflected.
+        words = struct.unpack_from("<%dI" % (blocks * 2), raw_bytes)
+        for n in range(0, blocks * 2, 2):
+            one = words[n] ^ c
+            two = words[n + 1]
+            c = t7[one & 0xFF] ^ t6[(one >> 8) & 0xFF] ^ t5[(one >> 16) & 0xFF] ^ t4[one >> 24] ^ \
+                t3[two & 0xFF] ^ t2[(two >> 8) & 0xFF] ^ t1[(two >> 16) & 0xFF] ^ t0[two >> 24]
+
+        # finish whatever didnt fit into a block one byte at a time.
+        for b in bytearray(raw_bytes[blocks << 3:]):
+            c = t0[(c ^ b) & 0xFF] ^ (c >> 8)
+
+        return c ^ self.MINUS_ONE_UINT32
+
+
+    def UpdateZlib(self, crc, data):
+        """Continues a CRC over data using zlib, which does the same math in C."""
+        return zlib.crc32(data, crc) & self.MINUS_ONE_UINT32
+
+
+class CRCStream(object):
+    """Running CRC for data that shows up a chunk at a time."""
+
+    def __init__(self, calculator):
+        """Public constructor, the calculator decides which backend does the work."""
+        self.Calculator = calculator
+        self.CRC = 0
+        self.Length = 0
+
+    def Update(self, chunk):
+        """Adds the next chunk of data to the CRC."""
+        self.CRC = self.Calculator.Update(self.CRC, chunk)
+        self.Length = self.Length + len(chunk)
+        return self
+
+    def GetCRC(self):
+        """Returns the CRC of everything seen so far."""
+        return self.CRC
 
-        c = self.MinusOneUint32
-        raw_bytes = bytearray(data)
+    def Reset(self):
+        """Starts over as if no data has been seen."""
+        self.CRC = 0
+        self.Length = 0
 
-        for n in range(len(raw_bytes)):
-            c = ctypes.c_uint32(self.CRCTable[(c ^ raw_bytes[n]) & 0xFF] ^ (c >> 8)).value
 
-        return c ^ self.MinusOneUint32
\ No newline at end of file
+CRCCalculator.BuildCRCTable()
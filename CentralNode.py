@@ -4,30 +4,229 @@
 # Main entry to the central node.  Kicks off the central node server.
 
 import SMPCentralNodeRequestHandler
+from PortAllocator import PortAllocator
 from SMPCentralNodeServer import SMPCentralNodeServer
+from SMPCentralNodeEventLoop import SMPCentralNodeEventLoop
+from ShardRouter import ShardRouter
+from RegistryJournal import RegistryJournal
+from AdmissionControl import AdmissionControl
+from Metrics import StatsServer
+import Log
+import argparse
+import os
+import signal
 import socket
+import time
 
 class SMPCentralNode:
     """Main entry point for the central node server.  This creates the request handler."""
 
-    def __init__(self, ip_str, port_num):
-        """ Public constructor kicks off the server. """
-        self.Server = SMPCentralNodeServer(ip_str, port_num, SMPCentralNodeRequestHandler.SMPCentralNodeRequestHandler)
-        self.Server.timeout = 1
-        self.Server.handle_timeout = SMPCentralNodeRequestHandler.HandleTimeout
+    # The different engines that can run the central node.
+    ENGINE_THREADED = "threaded"
+    ENGINE_EVENT_LOOP = "eventloop"
+
+    # Seconds between housekeeping runs.
+    HOUSEKEEPING_INTERVAL = 1
+
+    def __init__(self, ip_str, port_num, engine=ENGINE_THREADED, timeout_limit=None, ports=None, router=None,
+                 cluster=None, stats_port=None, state_dir=None, rate_limits=None):
+        """ Public constructor kicks off the server.  timeout_limit is the number of seconds a client can go
+            without a keep alive before it is removed.  ports is a string of broadcast port ranges like
+            "15002-15554,20000-29999".  router is only given to the worker processes of StartWorkers().
+            cluster is a list of the (ip, port) addresses of the other central nodes in our cluster.  With a
+            stats_port the stats can be read as text from that port on localhost, worker n uses stats_port + n.
+            With a state_dir the publishers and subscribers are kept there and restored when we start again.
+            rate_limits turns on the per client rate limits, it is a string like "keepalive=20/40,register=5"
+            or "" for the defaults. """
+        if timeout_limit is not None:
+            SMPCentralNodeRequestHandler.TIMEOUT_LIMIT = float(timeout_limit)
+
+        if ports is not None:
+            SMPCentralNodeRequestHandler.Ports = PortAllocator.FromString(ports)
+
+        if rate_limits is not None:
+            SMPCentralNodeRequestHandler.Admission = AdmissionControl.FromString(rate_limits)
+
+        # A node on its own has no ring, only the nodes listed in cluster may ever join us.
+        if cluster:
+            SMPCentralNodeRequestHandler.SetCluster((ip_str, port_num), cluster)
+
+        # Workers share the port with each other and each one runs a single event loop.
+        if router is not None:
+            SMPCentralNodeRequestHandler.SetWorker(router.Index, router.Count)
+            engine = self.ENGINE_EVENT_LOOP
+
+        if engine == self.ENGINE_EVENT_LOOP:
+            self.Server = SMPCentralNodeEventLoop(ip_str, port_num, SMPCentralNodeRequestHandler.SMPCentralNodeRequestHandler,
+                                                  router is not None, router)
+            self.Server.handle_timeout = SMPCentralNodeRequestHandler.HandleTimeout
+        else:
+            self.Server = SMPCentralNodeServer(ip_str, port_num, SMPCentralNodeRequestHandler.SMPCentralNodeRequestHandler)
+
+        self.Server.timeout = self.HOUSEKEEPING_INTERVAL
+        self.Engine = engine
+        self.Running = False
+
+        if state_dir is not None:
+            self.RestoreRegistry(state_dir, router)
+
+        if engine == self.ENGINE_EVENT_LOOP:
+            SMPCentralNodeRequestHandler.Stats.SetGauge("socket_wakeups", lambda: self.Server.Wakeups)
+            SMPCentralNodeRequestHandler.Stats.SetGauge("socket_datagrams", lambda: self.Server.Datagrams)
+            SMPCentralNodeRequestHandler.Stats.SetGauge("send_bursts", lambda: self.Server.Sender.Bursts)
+
+        if router is not None:
+            SMPCentralNodeRequestHandler.Stats.SetGauge("router_forwarded", lambda: router.Forwarded)
+            SMPCentralNodeRequestHandler.Stats.SetGauge("router_dropped", lambda: router.Dropped)
+
+        self.StatsServer = None
+        if stats_port is not None:
+            if router is not None:
+                stats_port = stats_port + router.Index
+            self.StatsServer = StatsServer(("127.0.0.1", stats_port), SMPCentralNodeRequestHandler.Stats)
+            self.StatsServer.Start()
+
+        # Let the rest of the cluster know about us, one worker is enough.
+        if cluster and (router is None or router.Index == 0):
+            SMPCentralNodeRequestHandler.AnnounceJoin(self.Server.socket)
+
+    def RestoreRegistry(self, state_dir, router):
+        """ Loads the registry we had when we went down and journals every change from now on.  Each worker
+            has its own journal, so the number of workers has to stay the same across restarts. """
+        name = "registry"
+        if router is not None:
+            name = "registry-" + str(router.Index)
+
+        start = time.time()
+        publishers, subscribers = SMPCentralNodeRequestHandler.RestoreRegistry(RegistryJournal(state_dir, name),
+                                                                               self.Server.socket)
+        Log.Info("Restored %d publishers and %d subscribers from %s in %.0f ms", publishers, subscribers,
+                 state_dir, (time.time() - start) * 1000)
 
     def Start(self):
         """ Handle one request after another forever"""
-        while True:
+        self.Running = True
+
+        if self.Engine == self.ENGINE_EVENT_LOOP:
+            self.Server.serve_forever()
+            return
+
+        # The UDP server only calls handle_timeout when it has been idle for a whole timeout, so under
+        # steady traffic we have to watch the clock ourselves.
+        next_housekeeping = time.time() + self.HOUSEKEEPING_INTERVAL
+        while self.Running:
             self.Server.handle_request()
 
+            if time.time() >= next_housekeeping:
+                SMPCentralNodeRequestHandler.HandleTimeout()
+                next_housekeeping = time.time() + self.HOUSEKEEPING_INTERVAL
+
+    def Stop(self):
+        """ Makes Start() return, the threaded engine returns after its next request or timeout. """
+        self.Running = False
+        if self.Engine == self.ENGINE_EVENT_LOOP:
+            self.Server.Stop()
+
+
+def StartWorkers(ip_str, port_num, workers, timeout_limit=None, ports=None, cluster=None, stats_port=None,
+                 state_dir=None, rate_limits=None):
+    """ Forks workers central node processes that all bind the same port with SO_REUSEPORT.  Each one owns a
+        shard of the publisher keys and forwards the commands it does not own to the right worker.  Returns
+        once every worker has exited. """
+    channels = ShardRouter.CreateChannels(workers)
+
+    children = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            Log.AfterFork()
+            try:
+                SMPCentralNode(ip_str, port_num, timeout_limit=timeout_limit, ports=ports,
+                               router=ShardRouter(index, channels), cluster=cluster, stats_port=stats_port,
+                               state_dir=state_dir, rate_limits=rate_limits).Start()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                # _exit skips the atexit handlers, write out what is left first.
+                Log.Flush()
+                os._exit(0)
+
+        children.append(pid)
+
+    # Take the workers down with us when we are told to stop.
+    def Terminate(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, Terminate)
+
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+def ParseCluster(text):
+    """ Returns the list of (ip, port) addresses in a string like "127.0.0.2,127.0.0.3:15001". """
+    if not text:
+        return None
+
+    cluster = []
+    for node in text.split(","):
+        ip, colon, port = node.strip().partition(":")
+        cluster.append((ip, int(port or 15001)))
+
+    return cluster
+
+
+def ParseArgs():
+    """ Command line options for the central node. """
+    parser = argparse.ArgumentParser(description="SMP central node")
+    parser.add_argument("ip", nargs="?", default=None,
+                        help="IP address to bind to, defaults to the address of this host")
+    parser.add_argument("--engine", choices=[SMPCentralNode.ENGINE_THREADED, SMPCentralNode.ENGINE_EVENT_LOOP],
+                        default=SMPCentralNode.ENGINE_THREADED,
+                        help="threaded handles every request on its own thread, eventloop handles them all on one")
+    parser.add_argument("--timeout", type=float, default=SMPCentralNodeRequestHandler.TIMEOUT_LIMIT,
+                        help="seconds a client can go without a keep alive before it is removed")
+    parser.add_argument("--ports", default=None,
+                        help="broadcast port ranges for publishers, like 15002-15554,20000-29999")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes to shard the publishers across, more than one always uses eventloop")
+    parser.add_argument("--cluster", default=None,
+                        help="other central nodes to share the publishers with, like 127.0.0.2,127.0.0.3:15001")
+    parser.add_argument("--stats-port", type=int, default=None,
+                        help="serve the stats as text on this port on localhost, workers use the ports after it too")
+    parser.add_argument("--state-dir", default=None,
+                        help="directory to keep the publishers and subscribers in so a restart picks them up again")
+    parser.add_argument("--rate-limit", nargs="?", const="", default=None,
+                        help="limit the commands each client can send, alone for the defaults or like "
+                             "keepalive=20/40,register=5 for rate/burst per second of some classes")
+    parser.add_argument("--log-level", type=str.lower, choices=["debug", "info", "warning", "error", "off"], default="info",
+                        help="least important messages to log, debug logs every packet")
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
 
-    ip_addr = socket.gethostbyname(socket.gethostname())
+    args = ParseArgs()
+
+    ip_addr = args.ip
+    if ip_addr is None:
+        ip_addr = socket.gethostbyname(socket.gethostname())
 
-    print "Starting server on " + ip_addr + ":15001"
+    Log.SetLevel(args.log_level)
+    Log.Info("Starting server on %s:15001", ip_addr)
 
     # RQ 4
-    central_node = SMPCentralNode(ip_addr, 15001)
-    central_node.Start()
+    cluster = ParseCluster(args.cluster)
+    if args.workers > 1:
+        StartWorkers(ip_addr, 15001, args.workers, args.timeout, args.ports, cluster, args.stats_port, args.state_dir,
+                     args.rate_limit)
+    else:
+        central_node = SMPCentralNode(ip_addr, 15001, args.engine, args.timeout, args.ports, cluster=cluster,
+                                      stats_port=args.stats_port, state_dir=args.state_dir, rate_limits=args.rate_limit)
+        central_node.Start()
@@ -0,0 +1,28 @@
+# ClientSession.py
+# Data structure representing everything one client address owns on the central node.
+
+class ClientSession(object):
+    """Every publisher and subscriber a single client address owns.  Keep alives are tracked per session
+       so one lookup covers all of them."""
+
+    def __init__(self, client_address, last_seen):
+        """Public constructor sets up all important variables."""
+        self.ClientAddress = client_address
+
+        # Publisher key to the Publisher this client added.
+        self.Publishers = dict()
+
+        # Publisher key to the Subscriber this client has on that publisher.
+        self.Subscriptions = dict()
+
+        # Pattern to the Subscriber of each wildcard subscription, it is also in Subscriptions under the key
+        # of every publisher it matched.
+        self.Patterns = dict()
+
+        # When we last heard from the client, in seconds since the epoch.
+        self.LastSeen = last_seen
+
+
+    def IsEmpty(self):
+        """Returns True once the client does not own anything anymore."""
+        return not self.Publishers and not self.Subscriptions and not self.Patterns
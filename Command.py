@@ -4,7 +4,9 @@
 # Data structure that represents a single control command PDU.
 
 from struct import *
-from CRCCalculator import CRCCalculator
+from CommandCodec import CommandCodec
+import socket
+import Log
 
 class Command:
     """This class is a data structure representing a single control command PDU."""
@@ -21,6 +23,27 @@ class Command:
     PUBLISHER_REMOVED = 7
     START_PUBLISHING = 8
     STOP_PUBLISHING = 9
+    # Sent by a clustered central node that does not own a publisher key, the payload has the address
+    # of the node that does and, if we are moving a key the client already uses, the key.
+    REDIRECT = 10
+    # Sent by a central node joining a cluster to the nodes already in it, the payload is its address.  Each
+    # of them answers with a NODE_JOINED of its own with a reserved byte of NODE_JOINED_REPLY.
+    NODE_JOINED = 11
+    # Asks the central node for its stats.  The payload is the first line wanted, the response is a
+    # STATS command with as many lines as fit and a reserved byte of 1 if there are more.
+    STATS = 12
+    # Carries several commands in one datagram, each one a whole command PDU with its length in front.  The
+    # response is a BATCH with the same transaction id carrying the responses the same way.  Every command
+    # should have its own transaction id, that is how its response is found.
+    BATCH = 13
+    # Tells a wildcard subscriber about a publisher that matches its pattern, the payload has the broadcast
+    # port and data encoding of the publisher followed by its key.  The subscriber answers with SUCCESS.
+    PUBLISHER_ADDED = 14
+    # Asks the central node what publishers it has.  The payload is a key prefix and the cursor from the last
+    # page, empty for the first, and a reserved byte of DISCOVER_BY_SENSOR_TYPE only asks for the sensor type
+    # in the header.  The response is a DISCOVER with the cursor for the next page and as many publishers as
+    # fit, and a reserved byte of 1 if there are more.
+    DISCOVER = 15
 
     # all of the error codes.
     INVALID_COMMAND = 1
@@ -28,6 +51,9 @@ class Command:
     PUB_DOES_NOT_EXIST = 3
     PUB_ALREADY_EXISTS = 4
     PERMISSION_ERROR = 5
+    NO_PORTS_AVAILABLE = 6
+    # The client sent more commands than its rate limit allows, it should slow down and try again.
+    THROTTLED = 7
 
     # RQ 8
     # These strings are used to parse the different kinds of commands.
@@ -38,15 +64,48 @@ class Command:
     # all command PDUs have a header of 12 bytes.
     HEADER_LENGTH = 12
 
-    # Create the CRC object once since it has to build a table.
-    CRCCalc = CRCCalculator()
+    # Node addresses in REDIRECT and NODE_JOINED payloads are a packed IPv4 address and port.
+    NODE_ADDRESS_STRUCT = Struct('>4sH')
 
-    def CreateFromParams(self, code, transaction_id, sensor_type, payload):
+    # Broadcast port and data encoding in front of the key in a PUBLISHER_ADDED payload.
+    PUBLISHER_ADDED_STRUCT = Struct('>HB')
+
+    # The length in front of every command in a BATCH payload.
+    BATCH_ENTRY_STRUCT = Struct('>H')
+
+    # Longest BATCH datagram we send or accept, it fits in one ethernet frame.
+    MAX_BATCH_LENGTH = 1400
+
+    # Reserved byte of a DISCOVER that only wants the publishers of the sensor type in its header.
+    DISCOVER_BY_SENSOR_TYPE = 1
+
+    # Reserved byte of a NODE_JOINED sent back to a node that joined, it is not announced back again.
+    NODE_JOINED_REPLY = 1
+
+    # The length in front of the prefix of a DISCOVER and of the cursor in its response, and the worker in
+    # front of the last key in a cursor.
+    DISCOVER_LENGTH_STRUCT = Struct('>B')
+
+    # Key length, sensor type, broadcast port and subscriber count in front of every key in a DISCOVER response.
+    DISCOVER_ENTRY_STRUCT = Struct('>BIHH')
+
+    # Longest DISCOVER datagram we accept, it has room for a whole key as the prefix and another in the cursor.
+    MAX_DISCOVER_LENGTH = HEADER_LENGTH + 2 * (DISCOVER_LENGTH_STRUCT.size + 32)
+
+    # The codec compiles every packet layout once and shares the CRC calculator.
+    Codec = CommandCodec({SUCCESS: SUCCESS_DECODER_STRING, FAILURE: FAILURE_DECODER_STRING}, DEFAULT_DECODER_STRING)
+    CRCCalc = Codec.CRCCalc
+
+    # Set by CreateFromPacket() since the CRC is checked while decoding.
+    CRCOkay = None
+
+    def CreateFromParams(self, code, transaction_id, sensor_type, payload, reserved=0):
         """Since python doesn't provide constructor overloads this is my solution two 
            different functions that parse data into the different packet fields. This one
            happens to just store the passed paremeters"""
         self.Code = code
         self.TransactionID = transaction_id
+        self.Reserved = reserved
         self.SensorType = sensor_type
         self.Payload = payload
         self.CRC = 0
@@ -69,18 +128,19 @@ class Command:
         # Store total length since we might need it in GetDecoderString()
         self.Length = len(packet) - self.HEADER_LENGTH
 
-        # We need to grab the code here, so that GetDecoderString() has something to switch on.
-        # python packs it as a string with '\x00' this magic is to get an int, map(ord, x) returns a list
-        # of its so we take the zeroth element since we know there is only 1.
-        self.Code = map(ord, packet[0])[0]
-
-        # actually do the parsing.
-        self.Code, self.TransactionID, self.Reserved, self.SensorType, self.Payload, self.CRC \
-            = unpack(self.GetDecoderString(), packet)
+        # actually do the parsing, the codec checks the CRC on the way.
+        record = self.Codec.Decode(packet)
+        self.Code = record.Code
+        self.TransactionID = record.TransactionID
+        self.Reserved = record.Reserved
+        self.SensorType = record.SensorType
+        self.Payload = record.Payload
+        self.CRC = record.CRC
+        self.CRCOkay = record.CRCOkay
 
         # check for the CRC
-        if not self.IsCRCOkay():
-           print "BAD CRC"
+        if not self.CRCOkay:
+           Log.Warning("BAD CRC")
            return None
 
         return self
@@ -89,36 +149,26 @@ class Command:
     def GetPacket(self):
         """This function packs the commands parmaters into a byte array for transmission.  It always calculates the
            CRC and stores that in the packet."""
-
-        # We have to create hte packet without the CRC first so that we can calcuate it.
-        noCrcPacket = pack(self.GetDecoderString(), self.Code, self.TransactionID, 0, self.SensorType, self.Payload, 0)
-        noCrcString = noCrcPacket[0:-4]
-
-        crc = self.CRCCalc.CalculateCRC(noCrcString)
-
-        # create and return a new packet that now has the CRC.
-        return pack(self.GetDecoderString(), self.Code, self.TransactionID, 0, self.SensorType, self.Payload, crc)
+        return self.Codec.Encode(self.Code, self.TransactionID, self.SensorType, self.Payload, self.Reserved)
 
 
     def GetDecoderString(self):
         """ Depending on what type of command we are building or parsing it may have a different structure.
             This function returns a special parsing string used by the "struct" module of python."""
-        if(self.Code == self.SUCCESS):
-            return self.SUCCESS_DECODER_STRING
-        elif(self.Code == self.FAILURE):
-            return self.FAILURE_DECODER_STRING
-        else:
-            # all other types of packets use this default string.
-            return self.DEFAULT_DECODER_STRING % self.Length 
+        return self.Codec.GetLayout(self.Code, self.Length).format
 
 
     def IsCRCOkay(self):
         """Calculates the CRC of an entire packet and compares it to its stored CRC.
            Returns True if the CRC of the packet was correct or false otherwise."""
+        # Packets we parsed were already checked by the codec.
+        if self.CRCOkay is not None:
+            return self.CRCOkay
+
         # Get the raw bytes.
         packet = self.GetPacket()
         # Skip the last four bytes since we can't include the CRC in the packet.
-        return self.CRC == CRCCalculator().CalculateCRC(packet[0:-4])
+        return self.CRC == self.CRCCalc.CalculateCRC(packet, len(packet) - 4)
 
 
     def GetCommandString(self):
@@ -143,6 +193,18 @@ class Command:
             return "START_PUBLISHING"
         if self.Code == self.STOP_PUBLISHING:
             return "STOP_PUBLISHING"
+        if self.Code == self.REDIRECT:
+            return "REDIRECT"
+        if self.Code == self.NODE_JOINED:
+            return "NODE_JOINED"
+        if self.Code == self.STATS:
+            return "STATS"
+        if self.Code == self.BATCH:
+            return "BATCH"
+        if self.Code == self.PUBLISHER_ADDED:
+            return "PUBLISHER_ADDED"
+        if self.Code == self.DISCOVER:
+            return "DISCOVER"
 
 
     def GetStringFromErrorCode(self, code):
@@ -157,6 +219,134 @@ class Command:
             return "PUB_ALREADY_EXISTS"
         if code == self.PERMISSION_ERROR:
             return "PERMISSION_ERROR"
+        if code == self.NO_PORTS_AVAILABLE:
+            return "NO_PORTS_AVAILABLE"
+        if code == self.THROTTLED:
+            return "THROTTLED"
+
+
+    @staticmethod
+    def PackNodeAddress(address, key=""):
+        """Builds a REDIRECT or NODE_JOINED payload from an (ip, port) address and an optional publisher key."""
+        return Command.NODE_ADDRESS_STRUCT.pack(socket.inet_aton(address[0]), address[1]) + key
+
+
+    @staticmethod
+    def UnpackNodeAddress(payload):
+        """Returns the (ip, port) address and the publisher key, which may be empty, from a REDIRECT or
+           NODE_JOINED payload."""
+        ip, port = Command.NODE_ADDRESS_STRUCT.unpack_from(payload)
+        return (socket.inet_ntoa(ip), port), payload[Command.NODE_ADDRESS_STRUCT.size:]
+
+
+    @staticmethod
+    def PackPublisherAdded(broadcast_port, data_encoding, key):
+        """Builds a PUBLISHER_ADDED payload."""
+        return Command.PUBLISHER_ADDED_STRUCT.pack(broadcast_port, data_encoding) + key
+
+
+    @staticmethod
+    def UnpackPublisherAdded(payload):
+        """Returns the broadcast port, data encoding and key from a PUBLISHER_ADDED payload."""
+        broadcast_port, data_encoding = Command.PUBLISHER_ADDED_STRUCT.unpack_from(payload)
+        return broadcast_port, data_encoding, payload[Command.PUBLISHER_ADDED_STRUCT.size:]
+
+
+    @staticmethod
+    def PackBatch(packets):
+        """Builds a BATCH payload from a list of command PDUs."""
+        return "".join([Command.BATCH_ENTRY_STRUCT.pack(len(packet)) + packet for packet in packets])
+
+
+    @staticmethod
+    def UnpackBatch(payload):
+        """Returns the list of command PDUs in a BATCH payload.  Raises ValueError if the payload is cut short."""
+        packets = []
+        offset = 0
+        size = Command.BATCH_ENTRY_STRUCT.size
+        while offset < len(payload):
+            if offset + size > len(payload):
+                raise ValueError("BATCH payload ends in the middle of a length")
+
+            length = Command.BATCH_ENTRY_STRUCT.unpack_from(payload, offset)[0]
+            offset = offset + size
+            if offset + length > len(payload):
+                raise ValueError("BATCH payload ends in the middle of a command")
+
+            packets.append(payload[offset:offset + length])
+            offset = offset + length
+
+        return packets
+
+
+    @staticmethod
+    def PackDiscover(prefix, cursor=""):
+        """Builds a DISCOVER payload from a key prefix and the cursor of the last response.  A response payload
+           is built the same way from its cursor, with the publishers after it."""
+        return Command.DISCOVER_LENGTH_STRUCT.pack(len(prefix)) + prefix + cursor
+
+
+    @staticmethod
+    def UnpackDiscover(payload):
+        """Returns the prefix and cursor from a DISCOVER payload.  Raises ValueError if the payload is cut short."""
+        size = Command.DISCOVER_LENGTH_STRUCT.size
+        if len(payload) < size:
+            raise ValueError("DISCOVER payload is empty")
+
+        end = size + Command.DISCOVER_LENGTH_STRUCT.unpack_from(payload)[0]
+        if end > len(payload):
+            raise ValueError("DISCOVER payload ends in the middle of the prefix")
+
+        return payload[size:end], payload[end:]
+
+
+    @staticmethod
+    def PackDiscoverCursor(worker, key=None):
+        """Builds the cursor that carries on after key in the publishers of a worker, or starts at the first
+           of them if key is None.  Clients never look inside a cursor, they just send it back."""
+        return Command.DISCOVER_LENGTH_STRUCT.pack(worker) + (key or "")
+
+
+    @staticmethod
+    def UnpackDiscoverCursor(cursor):
+        """Returns the worker and the key to carry on after, which is None if the worker starts at its first
+           publisher.  An empty cursor is the start of the first worker."""
+        if not cursor:
+            return 0, None
+
+        size = Command.DISCOVER_LENGTH_STRUCT.size
+        return Command.DISCOVER_LENGTH_STRUCT.unpack_from(cursor)[0], cursor[size:] or None
+
+
+    @staticmethod
+    def PackDiscoverEntry(key, sensor_type, broadcast_port, subscribers):
+        """Builds one publisher of a DISCOVER response, the subscriber count stops at the most a short holds."""
+        return Command.DISCOVER_ENTRY_STRUCT.pack(len(key), sensor_type, broadcast_port, min(subscribers, 0xFFFF)) + key
+
+
+    @staticmethod
+    def UnpackDiscoverResponse(payload):
+        """Returns the cursor for the next page and a list of (key, sensor type, broadcast port, subscriber
+           count) from a DISCOVER response.  Raises ValueError if the payload is cut short."""
+        # The cursor has its length in front just like the prefix of a DISCOVER.
+        cursor = Command.UnpackDiscover(payload)[0]
+        offset = Command.DISCOVER_LENGTH_STRUCT.size + len(cursor)
+
+        entries = []
+        size = Command.DISCOVER_ENTRY_STRUCT.size
+        while offset < len(payload):
+            if offset + size > len(payload):
+                raise ValueError("DISCOVER response ends in the middle of a publisher")
+
+            length, sensor_type, broadcast_port, subscribers = Command.DISCOVER_ENTRY_STRUCT.unpack_from(payload, offset)
+            offset = offset + size
+            if offset + length > len(payload):
+                raise ValueError("DISCOVER response ends in the middle of a key")
+
+            entries.append((payload[offset:offset + length], sensor_type, broadcast_port, subscribers))
+            offset = offset + length
+
+        return cursor, entries
 
 
     def __str__(self):
@@ -0,0 +1,88 @@
+# CommandCodec.py
+# Encodes and decodes control command PDUs with precompiled struct layouts.
+
+from struct import Struct
+from CRCCalculator import CRCCalculator
+
+
+class CommandRecord(object):
+    """Compact decoded control command PDU.  Has the same fields as a decoded Command."""
+
+    __slots__ = ("Code", "TransactionID", "Reserved", "SensorType", "Payload", "CRC", "CRCOkay")
+
+    def __init__(self, code, transaction_id, reserved, sensor_type, payload, crc, crc_okay):
+        self.Code = code
+        self.TransactionID = transaction_id
+        self.Reserved = reserved
+        self.SensorType = sensor_type
+        self.Payload = payload
+        self.CRC = crc
+        self.CRCOkay = crc_okay
+
+
+class CommandCodec(object):
+    """Packs and parses command PDUs.  Every layout is compiled into a struct.Struct once and the CRC
+       is calculated in one pass over the packet instead of packing the whole thing twice."""
+
+    # all command PDUs have a header of 12 bytes, the CRC is the last 4 of them.
+    HEADER_LENGTH = 12
+    CRC_LENGTH = 4
+
+    CRCStruct = Struct('>I')
+
+    def __init__(self, fixed_layouts, default_layout, crc_calculator=None):
+        """Public constructor.  fixed_layouts maps command codes whose payload is a number to their
+           struct format, everything else uses default_layout with the payload length filled in."""
+        self.FixedLayouts = dict((code, Struct(fmt)) for code, fmt in fixed_layouts.items())
+        self.DefaultLayout = default_layout
+
+        if crc_calculator is None:
+            crc_calculator = CRCCalculator()
+        self.CRCCalc = crc_calculator
+
+        # Compiled layouts for the string payloads keyed by payload length.
+        self.Layouts = dict()
+
+
+    def GetLayout(self, code, length):
+        """Returns the compiled struct for a command code and payload length."""
+        layout = self.FixedLayouts.get(code)
+        if layout is None:
+            layout = self.Layouts.get(length)
+            if layout is None:
+                layout = Struct(self.DefaultLayout % length)
+                self.Layouts[length] = layout
+
+        return layout
+
+
+    def Encode(self, code, transaction_id, sensor_type, payload, reserved=0):
+        """Packs a command into a byte string with the CRC filled in."""
+
+        # The payload can be a string or a number, numbers are always 4 bytes.
+        try:
+            length = len(payload)
+        except TypeError:
+            length = 4
+
+        layout = self.GetLayout(code, length)
+        crc_offset = layout.size - self.CRC_LENGTH
+
+        # pack once with an empty CRC and then patch the CRC in place.
+        packet = bytearray(layout.size)
+        layout.pack_into(packet, 0, code, transaction_id, reserved, sensor_type, payload, 0)
+        self.CRCStruct.pack_into(packet, crc_offset, self.CRCCalc.CalculateCRC(packet, crc_offset))
+
+        return bytes(packet)
+
+
+    def Decode(self, packet):
+        """Parses a packet into a CommandRecord.  The CRC is checked but a bad one does not stop the
+           decode, the caller has to look at CRCOkay.  Raises struct.error for malformed packets."""
+        crc_offset = len(packet) - self.CRC_LENGTH
+
+        layout = self.GetLayout(ord(packet[0:1]), len(packet) - self.HEADER_LENGTH)
+        code, transaction_id, reserved, sensor_type, payload, crc = layout.unpack(packet)
+
+        return CommandRecord(code, transaction_id, reserved, sensor_type, payload, crc,
+                             crc == self.CRCCalc.CalculateCRC(packet, crc_offset))
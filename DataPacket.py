@@ -0,0 +1,395 @@
+""" Data plane packet formats shared by the publisher and subscriber clients.
+
+    A plain data packet is an 8 byte millisecond timestamp followed by the sample.
+    Milliseconds since the epoch never need the top bits of the timestamp, so those
+    are used as flags that describe how the rest of the datagram is laid out.
+
+    A framed datagram packs many small samples into one datagram. The header
+    timestamp is the time of the first sample and each sample follows as a 4 byte
+    millisecond offset from it, a 2 byte length, and the sample bytes.
+
+    A compact datagram carries integer samples from periodic numeric sensors.
+    The header timestamp is the time of the first sample, followed by the first
+    value and then the change in time and value from one sample to the next, all
+    as zigzag varints. The compact encoding is negotiated with the central node
+    when the publisher is added, and subscribers are told about it when they
+    are added.
+
+    Any of the above can also be compressed with zlib. The body after the header
+    is replaced by the 4 byte id of the preset dictionary and the raw deflate
+    stream, and the compressed flag is set so compressed and uncompressed
+    datagrams can be mixed. Dictionaries are trained per sensor type and have to
+    be registered on both the publisher and the subscriber. """
+
+from struct import Struct
+import collections
+import time
+import zlib
+
+HEADER = Struct('>Q')
+FRAME_ENTRY = Struct('>IH')
+
+HEADER_LENGTH = HEADER.size
+FRAME_ENTRY_LENGTH = FRAME_ENTRY.size
+
+# flag bits in the header timestamp
+FLAG_FRAMED = 1 << 63
+FLAG_COMPACT = 1 << 62
+FLAG_COMPRESSED = 1 << 61
+FLAGS_MASK = FLAG_FRAMED | FLAG_COMPACT | FLAG_COMPRESSED
+STAMP_MASK = (1 << 61) - 1
+
+# 1500 byte ethernet MTU minus the IP and UDP headers
+DEFAULT_FRAME_MTU = 1472
+# longest a sample may wait for a frame to fill up, in seconds
+DEFAULT_MAX_LINGER = 0.01
+
+# data encodings a publisher can ask for in the reserved byte of addPub
+ENCODING_PLAIN = 0
+ENCODING_COMPACT = 1
+ENCODINGS = (ENCODING_PLAIN, ENCODING_COMPACT)
+
+DICTIONARY_ID = Struct('>I')
+# deflate can only look back 32k
+MAX_DICTIONARY_LENGTH = 32768
+# compressed datagrams may not inflate beyond the biggest UDP payload
+MAX_DECOMPRESSED_LENGTH = 65535
+
+# trained dictionaries by sensor type, and primed decompressors by dictionary id
+Dictionaries = {}
+Decompressors = {}
+
+
+def GetTimestamp():
+    """ current time in milliseconds for the data packet header """
+    return int(round(time.time() * 1000))
+
+
+def PackSample(stamp, data):
+    """ create a plain data packet for one sample """
+    return HEADER.pack(stamp & STAMP_MASK) + data
+
+
+def UnpackSample(packet):
+    """ returns the (timestamp, data) of a plain data packet """
+    return HEADER.unpack_from(packet)[0] & STAMP_MASK, packet[HEADER_LENGTH:]
+
+
+def EncodeVarint(value, out):
+    """ append the zigzag varint for a signed integer to the bytearray out """
+    if value >= 0:
+        value = value << 1
+    else:
+        value = ((-value) << 1) - 1
+
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def DecodeVarint(data, offset):
+    """ returns the signed integer of the zigzag varint in the bytearray data
+        at offset and the offset of the byte after it """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+
+    return (value >> 1) ^ -(value & 1), offset
+
+
+def UnpackDatagram(datagram):
+    """ returns the list of plain data packets carried by a received datagram.
+        plain packets are returned as is, frames are split back into samples
+        and compact values become decimal strings.
+        raises struct.error or IndexError for a truncated frame and ValueError
+        for compressed data that can't be decompressed. """
+    header = HEADER.unpack_from(datagram)[0]
+
+    if header & FLAG_COMPRESSED:
+        header = header & ~FLAG_COMPRESSED
+        datagram = HEADER.pack(header) + Decompress(datagram[HEADER_LENGTH:])
+
+    if header & FLAG_COMPACT:
+        return UnpackCompact(header & STAMP_MASK, datagram)
+
+    if not header & FLAG_FRAMED:
+        return [datagram]
+
+    base = header & STAMP_MASK
+    samples = []
+    offset = HEADER_LENGTH
+    end = len(datagram)
+
+    while offset < end:
+        delta, length = FRAME_ENTRY.unpack_from(datagram, offset)
+        offset += FRAME_ENTRY_LENGTH
+        samples.append(HEADER.pack(base + delta) + datagram[offset:offset + length])
+        offset += length
+
+    return samples
+
+
+def UnpackCompact(stamp, datagram):
+    """ returns the plain data packets for the samples in a compact datagram """
+    data = bytearray(datagram)
+    value, offset = DecodeVarint(data, HEADER_LENGTH)
+    samples = [HEADER.pack(stamp) + str(value)]
+    end = len(data)
+
+    while offset < end:
+        delta, offset = DecodeVarint(data, offset)
+        change, offset = DecodeVarint(data, offset)
+        stamp += delta
+        value += change
+        samples.append(HEADER.pack(stamp) + str(value))
+
+    return samples
+
+
+def TrainDictionary(samples, size=MAX_DICTIONARY_LENGTH, segment_length=16):
+    """ build a preset dictionary from example samples. segments that repeat
+        across samples are kept, the most common ones go last since deflate
+        finds short distances the cheapest. what is left is filled with the
+        most recent samples. """
+    counts = collections.defaultdict(int)
+    for sample in samples:
+        for n in range(0, len(sample) - segment_length + 1, segment_length):
+            counts[sample[n:n + segment_length]] += 1
+
+    common = sorted((count, segment) for segment, count in counts.items() if count > 1)
+    chosen = [segment for count, segment in common][-(size // segment_length):]
+
+    dictionary = b"".join(chosen)
+    for sample in reversed(samples):
+        if len(dictionary) >= size:
+            break
+        dictionary = sample[:size - len(dictionary)] + dictionary
+
+    return dictionary[-size:]
+
+
+def GetDictionaryId(dictionary):
+    """ the id sent in compressed datagrams, the adler32 just like zlib uses """
+    return zlib.adler32(dictionary) & 0xFFFFFFFF
+
+
+def PrimeDictionary(dictionary, level=zlib.Z_DEFAULT_COMPRESSION):
+    """ returns a raw deflate compressor that has already compressed the
+        dictionary and the bytes it produced. python 2 zlib has no preset
+        dictionary support, but a copy of a primed compressor can refer back
+        to the dictionary the same way. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    primer = compressor.compress(dictionary) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compressor, primer
+
+
+def RegisterDictionary(sensor_type, dictionary):
+    """ register the preset dictionary for a sensor type so publishers of that
+        type can compress with it and subscribers can decompress it """
+    dictionary = dictionary[-MAX_DICTIONARY_LENGTH:]
+    Dictionaries[sensor_type] = dictionary
+    AddDecompressor(dictionary)
+
+
+def AddDecompressor(dictionary):
+    """ prime a decompressor for datagrams compressed with the dictionary """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    decompressor.decompress(PrimeDictionary(dictionary)[1])
+    Decompressors[GetDictionaryId(dictionary)] = decompressor
+
+
+def Decompress(body):
+    """ returns the original body of a compressed datagram """
+    if len(body) < DICTIONARY_ID.size:
+        raise ValueError("compressed data packet is too short")
+
+    dictionaryId = DICTIONARY_ID.unpack_from(body)[0]
+    if dictionaryId not in Decompressors:
+        raise ValueError("unknown compression dictionary " + str(dictionaryId))
+
+    try:
+        return Decompressors[dictionaryId].copy().decompress(body[DICTIONARY_ID.size:], MAX_DECOMPRESSED_LENGTH)
+    except zlib.error as e:
+        raise ValueError("bad compressed data packet: " + str(e))
+
+
+class DataCompressor:
+    """ compresses data datagrams with a preset dictionary. datagrams are only
+        sent compressed if that makes them smaller, and after a run of
+        datagrams that did not shrink compression is only tried now and then """
+
+    # skip compression after this many datagrams in a row did not shrink
+    MAX_MISSES = 16
+    # while skipping, still try every this many datagrams
+    PROBE_INTERVAL = 16
+
+    def __init__(self, dictionary=b"", level=zlib.Z_DEFAULT_COMPRESSION):
+        self.DictionaryId = DICTIONARY_ID.pack(GetDictionaryId(dictionary))
+        self.Compressor = PrimeDictionary(dictionary, level)[0]
+        self.Misses = 0
+        self.Skipped = 0
+        # statistics for deciding if compression pays off for a stream
+        self.Datagrams = 0
+        self.Samples = 0
+        self.Compressed = 0
+        self.RawBytes = 0
+        self.SentBytes = 0
+        self.CompressSeconds = 0.0
+
+    """ returns the datagram to send for a data packet, compressed if that pays off.
+        samples is how many samples the packet carries """
+    def compressDatagram(self, packet, samples=1):
+
+        self.Datagrams += 1
+        self.Samples += samples
+        self.RawBytes += len(packet)
+
+        if self.Misses >= DataCompressor.MAX_MISSES and self.Datagrams % DataCompressor.PROBE_INTERVAL:
+            self.Skipped += 1
+            self.SentBytes += len(packet)
+            return packet
+
+        start = time.time()
+        compressor = self.Compressor.copy()
+        body = compressor.compress(packet[HEADER_LENGTH:]) + compressor.flush()
+        self.CompressSeconds += time.time() - start
+
+        if DICTIONARY_ID.size + len(body) >= len(packet) - HEADER_LENGTH:
+            self.Misses += 1
+            self.SentBytes += len(packet)
+            return packet
+
+        self.Misses = 0
+        self.Compressed += 1
+        header = HEADER.unpack_from(packet)[0] | FLAG_COMPRESSED
+        packet = HEADER.pack(header) + self.DictionaryId + body
+        self.SentBytes += len(packet)
+        return packet
+
+    """ returns the compression ratio and cost so far as a dictionary """
+    def getStats(self):
+        return {"datagrams": self.Datagrams,
+                "samples": self.Samples,
+                "compressed": self.Compressed,
+                "skipped": self.Skipped,
+                "ratio": float(self.RawBytes) / max(self.SentBytes, 1),
+                "us_per_sample": self.CompressSeconds * 1e6 / max(self.Samples, 1)}
+
+
+class DataFrame:
+    """ collects samples for one framed datagram """
+
+    def __init__(self, mtu=DEFAULT_FRAME_MTU):
+        self.MTU = mtu
+        self.Entries = []
+        self.Length = HEADER_LENGTH
+        self.BaseStamp = 0
+        # wall clock time the first sample was added, used for the linger timeout
+        self.StartTime = 0
+
+    """ add a sample to the frame. returns False if it does not fit """
+    def add(self, stamp, data):
+
+        length = FRAME_ENTRY_LENGTH + len(data)
+        if self.Length + length > self.MTU:
+            return False
+
+        if not self.Entries:
+            self.BaseStamp = stamp
+            self.StartTime = time.time()
+
+        self.Entries.append(FRAME_ENTRY.pack(stamp - self.BaseStamp, len(data)))
+        self.Entries.append(data)
+        self.Length += length
+        return True
+
+    """ number of samples in the frame """
+    def count(self):
+        return len(self.Entries) // 2
+
+    """ True if the oldest sample in the frame has waited max_linger seconds """
+    def isExpired(self, max_linger):
+        return bool(self.Entries) and time.time() - self.StartTime >= max_linger
+
+    """ seconds until the oldest sample in the frame has waited max_linger
+        seconds, 0 if it already has """
+    def lingerLeft(self, max_linger):
+        return max(self.StartTime + max_linger - time.time(), 0)
+
+    """ returns the datagram for the frame and empties it """
+    def getPacket(self):
+        packet = HEADER.pack(FLAG_FRAMED | self.BaseStamp) + b"".join(self.Entries)
+        self.Entries = []
+        self.Length = HEADER_LENGTH
+        return packet
+
+
+class CompactFrame:
+    """ collects integer samples for one compact datagram. has the same
+        interface as DataFrame so the publisher loop can use either one """
+
+    def __init__(self, mtu=DEFAULT_FRAME_MTU):
+        self.MTU = mtu
+        self.Body = bytearray()
+        self.Count = 0
+        self.BaseStamp = 0
+        self.LastStamp = 0
+        self.LastValue = 0
+        self.StartTime = 0
+
+    """ add a sample to the frame. returns False if it does not fit.
+        raises ValueError if the sample is not an integer """
+    def add(self, stamp, value):
+
+        value = int(value)
+        length = len(self.Body)
+
+        if self.Count == 0:
+            EncodeVarint(value, self.Body)
+        else:
+            EncodeVarint(stamp - self.LastStamp, self.Body)
+            EncodeVarint(value - self.LastValue, self.Body)
+
+        if HEADER_LENGTH + len(self.Body) > self.MTU and self.Count > 0:
+            del self.Body[length:]
+            return False
+
+        if self.Count == 0:
+            self.BaseStamp = stamp
+            self.StartTime = time.time()
+
+        self.LastStamp = stamp
+        self.LastValue = value
+        self.Count += 1
+        return True
+
+    """ number of samples in the frame """
+    def count(self):
+        return self.Count
+
+    """ True if the oldest sample in the frame has waited max_linger seconds """
+    def isExpired(self, max_linger):
+        return self.Count > 0 and time.time() - self.StartTime >= max_linger
+
+    """ seconds until the oldest sample in the frame has waited max_linger
+        seconds, 0 if it already has """
+    def lingerLeft(self, max_linger):
+        return max(self.StartTime + max_linger - time.time(), 0)
+
+    """ returns the datagram for the frame and empties it """
+    def getPacket(self):
+        packet = HEADER.pack(FLAG_COMPACT | self.BaseStamp) + bytes(self.Body)
+        self.Body = bytearray()
+        self.Count = 0
+        return packet
+
+
+# datagrams compressed without a trained dictionary use the empty one
+AddDecompressor(b"")
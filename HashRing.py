@@ -0,0 +1,71 @@
+# HashRing.py
+# Consistent hash ring used to split the publisher keys between the central nodes of a cluster.
+# Adding a node only moves the keys that land on its part of the ring.
+
+import bisect
+import hashlib
+import struct
+
+class HashRing(object):
+    """Consistent hash ring.  Every node is put on the ring many times so the keys are spread evenly,
+       a key belongs to the first node point at or after the hash of the key."""
+
+    # Points on the ring per node.
+    DEFAULT_REPLICAS = 100
+
+    HashStruct = struct.Struct(">I")
+
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        """Public constructor.  Nodes are strings like "127.0.0.1:15001"."""
+        self.Replicas = replicas
+        self.Nodes = set()
+        self.Points = []
+        self.Owners = []
+
+        for node in nodes:
+            self.AddNode(node)
+
+
+    def GetHash(self, value):
+        """Returns the position of a string on the ring."""
+        return self.HashStruct.unpack_from(hashlib.md5(value).digest())[0]
+
+
+    def AddNode(self, node):
+        """Puts a node on the ring.  Returns False if it was already there."""
+        if node in self.Nodes:
+            return False
+
+        self.Nodes.add(node)
+        for n in range(self.Replicas):
+            point = self.GetHash(node + "#" + str(n))
+            index = bisect.bisect_left(self.Points, point)
+            self.Points.insert(index, point)
+            self.Owners.insert(index, node)
+
+        return True
+
+
+    def RemoveNode(self, node):
+        """Takes a node off the ring.  Returns False if it was not there."""
+        if node not in self.Nodes:
+            return False
+
+        self.Nodes.remove(node)
+        keep = [n for n, owner in enumerate(self.Owners) if owner != node]
+        self.Points = [self.Points[n] for n in keep]
+        self.Owners = [self.Owners[n] for n in keep]
+
+        return True
+
+
+    def GetNode(self, key):
+        """Returns the node that owns a key, or None if the ring is empty."""
+        if not self.Points:
+            return None
+
+        index = bisect.bisect_left(self.Points, self.GetHash(key))
+        if index == len(self.Points):
+            index = 0
+
+        return self.Owners[index]
@@ -0,0 +1,205 @@
+# Log.py
+# Leveled logging for the central node and the clients.  Calls below the current level return right
+# away without building the message.  Records at or above it go on a bounded buffer that a background
+# thread writes out, so the threads handling packets never wait on the console.
+
+import atexit
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+LevelNames = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR", OFF: "OFF"}
+
+# Records below this level are thrown away without being formatted.
+Level = INFO
+
+# Most records that can wait for the writer, new records are dropped while the buffer is full.
+DEFAULT_CAPACITY = 8192
+Capacity = DEFAULT_CAPACITY
+
+# Seconds the writer sleeps between looking at the buffer.
+FLUSH_INTERVAL = 0.05
+
+# (time, level, message, args) tuples waiting to be written.  Appending to and popping from a deque
+# is atomic, so logging threads don't take a lock.
+Records = deque()
+
+# Records thrown away because the buffer was full, and how many of those the writer already reported.
+Dropped = 0
+ReportedDrops = 0
+DropLock = threading.Lock()
+
+Written = 0
+Output = sys.stdout
+Writer = None
+WriterLock = threading.Lock()
+# Set at exit to make the writer thread return before the interpreter tears the modules down.
+Stopping = threading.Event()
+
+
+def SetLevel(level):
+    """Sets the lowest level that is logged, either a number or a name like "debug"."""
+    global Level
+    Level = ParseLevel(level)
+
+
+def ParseLevel(level):
+    """Returns the number of a level given as a number or a name."""
+    if isinstance(level, int):
+        return level
+
+    for number, name in LevelNames.items():
+        if name == str(level).upper():
+            return number
+
+    raise ValueError("Unknown log level " + repr(level))
+
+
+def SetOutput(stream):
+    """Writes the records to stream from now on, sys.stdout by default."""
+    global Output
+    Flush()
+    Output = stream
+
+
+def IsEnabled(level):
+    """Returns True if records at this level are logged.  Use it to skip building expensive arguments."""
+    return level >= Level
+
+
+def Debug(message, *args):
+    """Logs per packet details.  The message is only formatted with args, like message % args, on the writer."""
+    if DEBUG >= Level:
+        Write(DEBUG, message, args)
+
+
+def Info(message, *args):
+    """Logs changes to the publishers and subscribers."""
+    if INFO >= Level:
+        Write(INFO, message, args)
+
+
+def Warning(message, *args):
+    """Logs bad requests and other things that are not our fault."""
+    if WARNING >= Level:
+        Write(WARNING, message, args)
+
+
+def Error(message, *args):
+    """Logs things that should not happen."""
+    if ERROR >= Level:
+        Write(ERROR, message, args)
+
+
+def Exception(message, *args):
+    """Logs an error along with the traceback of the exception being handled.  The traceback has to be
+       taken here, the writer thread does not know about it."""
+    if ERROR >= Level:
+        Write(ERROR, message + "\n%s", args + (traceback.format_exc().rstrip(),))
+
+
+def Write(level, message, args):
+    """Puts a record on the buffer for the writer.  The args must not change after this call, they are
+       formatted later on another thread."""
+    global Dropped
+    if len(Records) >= Capacity:
+        with DropLock:
+            Dropped = Dropped + 1
+        return
+
+    Records.append((time.time(), level, message, args))
+
+    if Writer is None:
+        Start()
+
+
+def FormatRecord(record):
+    """Returns the line written for a record."""
+    when, level, message, args = record
+    if args:
+        try:
+            message = message % args
+        except (TypeError, ValueError):
+            message = message + " " + repr(args)
+
+    return "%s.%03d %-7s %s\n" % (time.strftime("%H:%M:%S", time.localtime(when)), int(when * 1000) % 1000,
+                                  LevelNames.get(level, str(level)), message)
+
+
+def Flush():
+    """Writes every record on the buffer now.  Returns the number of records written."""
+    global Written, ReportedDrops
+    with WriterLock:
+        lines = []
+        while True:
+            try:
+                lines.append(FormatRecord(Records.popleft()))
+            except IndexError:
+                break
+
+        dropped = Dropped
+        if dropped != ReportedDrops:
+            lines.append(FormatRecord((time.time(), WARNING, "%d log records dropped, the buffer was full",
+                                       (dropped - ReportedDrops,))))
+            ReportedDrops = dropped
+
+        if lines:
+            try:
+                Output.write("".join(lines))
+                Output.flush()
+            except (IOError, ValueError):
+                # Nowhere to write to, like a closed pipe, losing the records beats taking the node down.
+                pass
+            Written = Written + len(lines)
+
+        return len(lines)
+
+
+def WriterLoop(stopping):
+    """Background thread that writes the buffered records until stopping is set."""
+    while not stopping.wait(FLUSH_INTERVAL):
+        Flush()
+
+
+def Start():
+    """Starts the writer thread, the first record logged does this on its own."""
+    global Writer
+    with DropLock:
+        if Writer is not None:
+            return
+
+        Writer = threading.Thread(target=WriterLoop, args=(Stopping,), name="Log writer")
+        Writer.daemon = True
+        Writer.start()
+
+    atexit.register(Stop)
+
+
+def Stop():
+    """Stops the writer thread and writes what is left on the buffer, this runs at exit."""
+    Stopping.set()
+    writer = Writer
+    if writer is not None and writer is not threading.current_thread():
+        writer.join()
+    Flush()
+
+
+def AfterFork():
+    """Call this in a child process right after fork.  Only the forking thread survives a fork, so the
+       child starts its own writer, and the records the parent still had are the parent's to write."""
+    global Writer, WriterLock, DropLock, Dropped, ReportedDrops, Stopping
+    Writer = None
+    WriterLock = threading.Lock()
+    DropLock = threading.Lock()
+    Stopping = threading.Event()
+    Records.clear()
+    Dropped = 0
+    ReportedDrops = 0
@@ -0,0 +1,208 @@
+# Metrics.py
+# Counters and latency histograms for the central node and the clients.  Updating a metric is a lock
+# and an add, the text they are reported in is only built when someone asks for the stats.
+
+import math
+import socket
+import threading
+import SocketServer
+from math import frexp
+
+class Counter(object):
+    """A number that only goes up."""
+
+    def __init__(self):
+        """Public constructor."""
+        self.Lock = threading.Lock()
+        self.Value = 0
+
+
+    def Increment(self, amount=1):
+        """Adds to the counter."""
+        with self.Lock:
+            self.Value = self.Value + amount
+
+
+class Histogram(object):
+    """Log scale histogram.  Every power of two is split into SUB_BUCKETS buckets, so a percentile is never
+       off by more than 12.5%, and recording a value does not depend on how many were recorded before."""
+
+    SUB_BUCKETS = 8
+    BUCKET_SCALE = 2 * SUB_BUCKETS
+
+    # Percentiles reported for every histogram.
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self):
+        """Public constructor."""
+        self.Lock = threading.Lock()
+        self.Buckets = dict()
+        self.Count = 0
+        self.Sum = 0.0
+        self.Max = 0.0
+
+
+    def GetBucket(self, value):
+        """Returns the bucket a value falls in.  Everything at or below zero goes in bucket None."""
+        if value <= 0:
+            return None
+
+        mantissa, exponent = frexp(value)
+        return exponent * self.SUB_BUCKETS + int((mantissa - 0.5) * self.BUCKET_SCALE)
+
+
+    def GetBucketLimit(self, bucket):
+        """Returns the biggest value that falls in a bucket."""
+        if bucket is None:
+            return 0.0
+
+        exponent, sub_bucket = divmod(bucket, self.SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub_bucket + 1) / (2.0 * self.SUB_BUCKETS), exponent)
+
+
+    def Record(self, value):
+        """Adds a value to the histogram.  Handlers call this for every request, so GetBucket is inlined."""
+        if value > 0:
+            mantissa, exponent = frexp(value)
+            bucket = exponent * self.SUB_BUCKETS + int((mantissa - 0.5) * self.BUCKET_SCALE)
+        else:
+            bucket = None
+
+        with self.Lock:
+            self.Buckets[bucket] = self.Buckets.get(bucket, 0) + 1
+            self.Count = self.Count + 1
+            self.Sum = self.Sum + value
+            if value > self.Max:
+                self.Max = value
+
+
+    def GetPercentile(self, quantile):
+        """Returns the value quantile of the recorded values are at or below, like 0.99 for the 99th
+           percentile.  Returns 0 if nothing was recorded."""
+        with self.Lock:
+            buckets = sorted(self.Buckets.items(), key=lambda item: -1 if item[0] is None else item[0])
+            count = self.Count
+            largest = self.Max
+
+        wanted = quantile * count
+        seen = 0
+        for bucket, bucket_count in buckets:
+            seen = seen + bucket_count
+            if seen >= wanted:
+                return min(self.GetBucketLimit(bucket), largest)
+
+        return largest
+
+
+class MetricsRegistry(object):
+    """Every metric of a central node or a client by name.  Names can carry labels in braces, like
+       packets_received{command="KEEP_ALIVE"}.  Gauges are functions that are only called when the
+       stats are formatted."""
+
+    def __init__(self, prefix=""):
+        """Public constructor.  prefix goes in front of every metric name in the text."""
+        self.Prefix = prefix
+        self.Lock = threading.Lock()
+        self.Counters = dict()
+        self.Histograms = dict()
+        self.Gauges = dict()
+
+
+    def GetCounter(self, name):
+        """Returns the counter with this name, creating it the first time."""
+        with self.Lock:
+            counter = self.Counters.get(name)
+            if counter is None:
+                counter = self.Counters[name] = Counter()
+            return counter
+
+
+    def GetHistogram(self, name):
+        """Returns the histogram with this name, creating it the first time."""
+        with self.Lock:
+            histogram = self.Histograms.get(name)
+            if histogram is None:
+                histogram = self.Histograms[name] = Histogram()
+            return histogram
+
+
+    def SetGauge(self, name, function):
+        """Reports the value function returns under name.  The function can also return a list of
+           (labels, value) pairs, like [('key="plant/1"', 3)], for one line per label."""
+        with self.Lock:
+            self.Gauges[name] = function
+
+
+    def GetLines(self):
+        """Returns the stats as a list of "name value" lines sorted by name."""
+        with self.Lock:
+            counters = self.Counters.items()
+            histograms = self.Histograms.items()
+            gauges = self.Gauges.items()
+
+        lines = []
+        for name, counter in counters:
+            lines.append("%s%s %d" % (self.Prefix, name, counter.Value))
+
+        for name, histogram in histograms:
+            lines.append("%s%s_count %d" % (self.Prefix, name, histogram.Count))
+            lines.append("%s%s_sum %.1f" % (self.Prefix, name, histogram.Sum))
+            lines.append("%s%s_max %.1f" % (self.Prefix, name, histogram.Max))
+            for quantile in Histogram.QUANTILES:
+                lines.append('%s%s{quantile="%g"} %.1f' % (self.Prefix, name, quantile, histogram.GetPercentile(quantile)))
+
+        for name, function in gauges:
+            value = function()
+            if isinstance(value, (int, long, float)):
+                lines.append("%s%s %s" % (self.Prefix, name, value))
+            else:
+                for labels, labeled_value in value:
+                    lines.append("%s%s{%s} %s" % (self.Prefix, name, labels, labeled_value))
+
+        lines.sort()
+        return lines
+
+
+    def Format(self):
+        """Returns the stats as text, one metric per line."""
+        return "".join(line + "\n" for line in self.GetLines())
+
+
+class StatsRequestHandler(SocketServer.StreamRequestHandler):
+    """Answers every connection with the stats as a plain text HTTP response, so curl, a browser or a
+       scraper can read them.  A bare connection that sends nothing gets them too."""
+
+    # Seconds to wait for the request before answering anyway.
+    REQUEST_TIMEOUT = 1.0
+
+    def handle(self):
+        self.connection.settimeout(self.REQUEST_TIMEOUT)
+        try:
+            while self.rfile.readline().strip():
+                pass
+        except socket.error:
+            pass
+
+        text = self.server.Registry.Format()
+        self.wfile.write("HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n%s"
+                         % (len(text), text))
+
+
+class StatsServer(SocketServer.ThreadingTCPServer):
+    """Local text endpoint for a metrics registry.  Nothing is formatted until someone connects."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, registry):
+        """Public constructor binds the address right away."""
+        SocketServer.ThreadingTCPServer.__init__(self, address, StatsRequestHandler)
+        self.Registry = registry
+
+
+    def Start(self):
+        """Serves the stats on a background thread."""
+        thread = threading.Thread(target=self.serve_forever, name="Stats server")
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,110 @@
+# PortAllocator.py
+# Hands out the broadcast ports publishers stream their data on and takes them back when the
+# publisher goes away.
+
+from collections import deque
+import threading
+
+class PortAllocator(object):
+    """Free list of broadcast ports.  Allocate, release and reserve are all O(1).  Released ports go to
+       the back of the list so a port is not handed out again right after its publisher left.  Safe to use
+       from many threads."""
+
+    # RQ 5
+    DEFAULT_RANGES = [(15002, 15554)]
+
+    def __init__(self, ranges=None, partition=(0, 1)):
+        """Public constructor.  ranges is a list of (first, last) port pairs, both ends included.  With a
+           partition of (index, count) we only own every count-th port starting at the index-th one."""
+        if ranges is None:
+            ranges = self.DEFAULT_RANGES
+
+        self.Lock = threading.Lock()
+        self.Ranges = []
+        self.FreeList = deque()
+        self.Free = set()
+
+        ports = []
+        for first, last in ranges:
+            if first < 1 or last > 65535 or first > last:
+                raise ValueError("Invalid port range " + str(first) + "-" + str(last))
+            self.Ranges.append((first, last))
+            ports.extend(port for port in range(first, last + 1) if port not in self.Free)
+            self.Free.update(ports)
+
+        index, count = partition
+        ports = ports[index::count]
+        self.FreeList.extend(ports)
+        self.Free = set(ports)
+        self.Ports = frozenset(ports)
+        self.Size = len(ports)
+
+
+    @classmethod
+    def FromString(cls, text):
+        """Creates an allocator from ranges written like "15002-15554,20000-29999".  A single port is okay too."""
+        ranges = []
+        for part in text.split(","):
+            part = part.strip()
+            if not part:
+                continue
+
+            first, dash, last = part.partition("-")
+            if not dash:
+                last = first
+            ranges.append((int(first), int(last)))
+
+        if not ranges:
+            raise ValueError("No port ranges in " + repr(text))
+
+        return cls(ranges)
+
+
+    def Allocate(self):
+        """Returns a free port, or None if every port is in use."""
+        with self.Lock:
+            while self.FreeList:
+                port = self.FreeList.popleft()
+
+                # Reserve() leaves ports on the list, skip them here.
+                if port in self.Free:
+                    self.Free.remove(port)
+                    return port
+
+        return None
+
+
+    def Release(self, port):
+        """Gives a port back.  Ports that are not ours or are already free are ignored."""
+        if port is None or not self.Contains(port):
+            return
+
+        with self.Lock:
+            if port not in self.Free:
+                self.Free.add(port)
+                self.FreeList.append(port)
+
+
+    def Reserve(self, port):
+        """Takes a specific port out of the free list.  Returns False if it is not free."""
+        with self.Lock:
+            if port not in self.Free:
+                return False
+
+            self.Free.remove(port)
+            return True
+
+
+    def Partition(self, index, count):
+        """Returns a new allocator for the index-th of count equal shares of the port ranges."""
+        return PortAllocator(self.Ranges, (index, count))
+
+
+    def Contains(self, port):
+        """Returns True if the port is one of ours."""
+        return port in self.Ports
+
+
+    def GetFreeCount(self):
+        """Returns the number of ports that can still be allocated."""
+        return len(self.Free)
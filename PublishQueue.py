@@ -0,0 +1,185 @@
+""" Bounded queue of samples between the code that publishes data and the
+    thread of an SMPPublisherClient that sends it.
+
+    The sending thread sleeps on a condition variable until there are samples
+    and the central node has told the publisher to start, instead of polling
+    the queue. When the queue is full the policy picks what happens to a new
+    sample:
+
+        DROP_OLDEST  the oldest sample is pushed out, the most recent data is
+                     always the data sent. this is how the queue always worked
+        DROP_NEWEST  the new sample is dropped and the queue is left alone
+        BLOCK        the producer waits for room, up to a timeout, then gets
+                     QueueFull
+        FAIL_FAST    the producer gets QueueFull right away
+
+    Every queue counts its drops, rejected samples and producer waits, and
+    reports its length and the longest it has been, in the stats of the
+    client that owns it. """
+
+import collections
+import threading
+import time
+
+from Metrics import MetricsRegistry
+
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+BLOCK = "block"
+FAIL_FAST = "fail-fast"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK, FAIL_FAST)
+
+# seconds a BLOCK producer waits for room before giving up, None waits forever
+DEFAULT_BLOCK_TIMEOUT = 5.0
+
+
+class QueueFull(Exception):
+    """ raised when a BLOCK or FAIL_FAST queue has no room for a sample.
+        Queued is how many of the samples passed in made it in first """
+
+    def __init__(self, queued):
+        Exception.__init__(self, "publish queue is full, %d samples queued" % queued)
+        self.Queued = queued
+
+
+class PublishQueue:
+    """ thread safe bounded queue with a full queue policy. any number of
+        producers, one consumer """
+
+    def __init__(self, maxlen, policy=DROP_OLDEST, timeout=DEFAULT_BLOCK_TIMEOUT, stats=None):
+        if policy not in POLICIES:
+            raise ValueError("unknown publish queue policy " + str(policy))
+
+        self.maxlen = maxlen
+        self.Policy = policy
+        self.Timeout = timeout
+        self.Samples = collections.deque()
+        # the consumer waits on NotEmpty, BLOCK producers on NotFull
+        self.Lock = threading.Lock()
+        self.NotEmpty = threading.Condition(self.Lock)
+        self.NotFull = threading.Condition(self.Lock)
+        # the consumer only gets samples while the queue is enabled
+        self.IsEnabled = False
+        # set by wake until the consumer sees it
+        self.IsWoken = False
+        # longest the queue has been
+        self.MaxLength = 0
+
+        if stats is None:
+            stats = MetricsRegistry("smp_client_")
+        self.Drops = stats.GetCounter("queue_drops")
+        self.DroppedOldest = stats.GetCounter("queue_dropped_oldest")
+        self.DroppedNewest = stats.GetCounter("queue_dropped_newest")
+        self.Rejected = stats.GetCounter("queue_rejected")
+        self.Waits = stats.GetCounter("queue_blocked")
+        stats.SetGauge("queue_length", lambda: len(self.Samples))
+        stats.SetGauge("queue_max_length", lambda: self.MaxLength)
+
+    """ add a sample, see extend """
+    def append(self, sample):
+        return self.extend([sample])
+
+    """ add samples in order, applying the policy to the ones that don't fit.
+        returns the number queued. raises QueueFull under BLOCK and FAIL_FAST
+        at the first sample that can't be queued, the rest are not queued """
+    def extend(self, samples):
+        samples = list(samples)
+        queued = 0
+        with self.Lock:
+            for sample in samples:
+                if len(self.Samples) < self.maxlen:
+                    self.Samples.append(sample)
+                    queued += 1
+
+                elif DROP_OLDEST == self.Policy:
+                    self.Samples.popleft()
+                    self.Samples.append(sample)
+                    queued += 1
+                    self.Drops.Increment()
+                    self.DroppedOldest.Increment()
+
+                elif DROP_NEWEST == self.Policy:
+                    self.Drops.Increment()
+                    self.DroppedNewest.Increment()
+
+                elif BLOCK == self.Policy and self.waitForRoom(queued):
+                    self.Samples.append(sample)
+                    queued += 1
+
+                else:
+                    self.Rejected.Increment(len(samples) - queued)
+                    self.wakeConsumer(queued)
+                    raise QueueFull(queued)
+
+            self.MaxLength = max(self.MaxLength, len(self.Samples))
+            self.wakeConsumer(queued)
+
+        return queued
+
+    """ called by a BLOCK producer with the lock held and the queue full.
+        returns False if there is still no room after the timeout """
+    def waitForRoom(self, queued):
+        self.Waits.Increment()
+        self.MaxLength = max(self.MaxLength, len(self.Samples))
+        # the consumer has to hear about what we queued to make room for the rest
+        self.wakeConsumer(queued)
+
+        deadline = None if self.Timeout is None else time.time() + self.Timeout
+        while len(self.Samples) >= self.maxlen:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.NotFull.wait(remaining)
+
+        return True
+
+    """ called with the lock held after samples were queued """
+    def wakeConsumer(self, queued):
+        if queued > 0 and self.IsEnabled:
+            self.NotEmpty.notify()
+
+    """ take up to count samples, sleeping up to timeout seconds, or until
+        woken if timeout is None, until there are some and the queue is
+        enabled. returns an empty list on timeout or if wake was called """
+    def take(self, count, timeout=None):
+        with self.Lock:
+            if not (self.IsEnabled and self.Samples) and not self.IsWoken:
+                self.NotEmpty.wait(timeout)
+
+            if self.IsWoken:
+                self.IsWoken = False
+                return []
+            if not (self.IsEnabled and self.Samples):
+                return []
+
+            samples = []
+            while self.Samples and len(samples) < count:
+                samples.append(self.Samples.popleft())
+
+            self.NotFull.notify_all()
+            return samples
+
+    """ take one sample without waiting, raises IndexError if there is none """
+    def popleft(self):
+        with self.Lock:
+            sample = self.Samples.popleft()
+            self.NotFull.notify()
+            return sample
+
+    """ let the consumer have samples, or make it sleep until enabled again.
+        samples stay queued while the queue is disabled """
+    def setEnabled(self, enabled):
+        with self.Lock:
+            self.IsEnabled = enabled
+            self.NotEmpty.notify_all()
+
+    """ wake the consumer so it checks whether it should stop. a consumer
+        that is not waiting yet returns from its next take right away """
+    def wake(self):
+        with self.Lock:
+            self.IsWoken = True
+            self.NotEmpty.notify_all()
+
+    def __len__(self):
+        return len(self.Samples)
@@ -5,11 +5,12 @@
 
 from Command import Command
 import SMPCentralNodeRequestHandler
+import Log
 
 class Publisher(object):
     """Data structure representing a single publisher in the CentralNode."""
 
-    def __init__(self, key, request, client_address, broadcast_port, sensor_type=0):
+    def __init__(self, key, request, client_address, broadcast_port, sensor_type=0, data_encoding=0):
         """Public constructor sets up all important variables."""
         self.Subs = dict()
         self.BroadcastPort = broadcast_port
@@ -17,22 +18,29 @@ class Publisher(object):
         self.Socket = request[1]
         self.ClientAddress = client_address
         self.SensorType = sensor_type
-        self.TimeoutCount = 0
+        self.DataEncoding = data_encoding
 
 
-    def SendCommand(self, cmd_code):
-        """ Sends a command to the publisher over the network. """
+    def SendCommand(self, cmd_code, payload=None, deferred=None):
+        """ Sends a command to the publisher over the network.  The payload is the key unless another one is given.
+            If deferred is a list the transaction is put on it instead, for the caller to send after its response. """
 
         # Get the id ahead of time since we need it to log the transaction.
         TxId = SMPCentralNodeRequestHandler.GetNextTransactionID()
 
         #Create the command the key is the payload, its the name of the publisher.
-        command = Command().CreateFromParams(cmd_code, TxId, self.SensorType, self.Key)
+        if payload is None:
+            payload = self.Key
+        command = Command().CreateFromParams(cmd_code, TxId, self.SensorType, payload)
 
         # We log the transaction with the central node since we may need to resend it if we don't get a success.
-        SMPCentralNodeRequestHandler.StoreTransaction(TxId, command, self.Socket, self.ClientAddress)
+        transaction = SMPCentralNodeRequestHandler.StoreTransaction(TxId, command, self.Socket, self.ClientAddress)
 
-        print "Sending: " + command.GetCommandString() + " <" + str(command) + ">"
+        Log.Debug("Sending: <%s>", command)
+
+        if deferred is not None:
+            deferred.append(transaction)
+            return
 
         # Actually do the sending.
-        self.Socket.sendto(command.GetPacket(), self.ClientAddress)
\ No newline at end of file
+        transaction.Send()
\ No newline at end of file
@@ -0,0 +1,237 @@
+# PublisherRegistry.py
+# Thread safe table of the publishers on the central node, split into lock striped shards so
+# handlers working on unrelated publishers don't wait on each other.
+
+import bisect
+import threading
+
+class RegistryShard(object):
+    """One stripe of the registry.  The dictionary is copy on write, it is never changed once it has been
+       published, so readers can use whatever dictionary they see without taking the lock."""
+
+    def __init__(self):
+        """Public constructor sets up all important variables."""
+        self.Lock = threading.RLock()
+        self.Publishers = dict()
+
+
+class SortedKeys(object):
+    """Publisher keys kept in sorted order so the ones starting with a prefix sit next to each other and are
+       found with a binary search.  Not thread safe, the registry locks."""
+
+    def __init__(self):
+        """Public constructor."""
+        self.Keys = []
+
+
+    def Add(self, key):
+        """Puts a key in its place."""
+        bisect.insort(self.Keys, key)
+
+
+    def Remove(self, key):
+        """Takes a key out if it is there."""
+        n = bisect.bisect_left(self.Keys, key)
+        if n < len(self.Keys) and self.Keys[n] == key:
+            del self.Keys[n]
+
+
+    def Range(self, prefix, after=None, limit=None):
+        """Returns up to limit keys that start with prefix, in order and starting after the key after if it
+           is given.  Costs a binary search plus the keys returned."""
+        if after is not None and after >= prefix:
+            n = bisect.bisect_right(self.Keys, after)
+        else:
+            n = bisect.bisect_left(self.Keys, prefix)
+
+        keys = []
+        while n < len(self.Keys) and self.Keys[n].startswith(prefix):
+            if limit is not None and len(keys) >= limit:
+                break
+            keys.append(self.Keys[n])
+            n = n + 1
+
+        return keys
+
+
+    def __len__(self):
+        return len(self.Keys)
+
+
+class PublisherRegistry(object):
+    """Publishers keyed by their name, sharded by the hash of the name.  Writers lock one shard, readers
+       never lock.  The shard lock also protects the subscribers of the publishers in that shard.
+
+       Every key is also kept in sorted secondary indexes, one of them all and one per sensor type, so
+       Discover() finds the publishers with a key prefix and sensor type without looking at the others."""
+
+    DEFAULT_SHARD_COUNT = 64
+
+    def __init__(self, shard_count=DEFAULT_SHARD_COUNT):
+        """Public constructor creates the shards."""
+        self.Shards = [RegistryShard() for n in range(shard_count)]
+
+        # The discovery indexes, protected by IndexLock which is taken inside a shard lock and never
+        # holds another lock.
+        self.IndexLock = threading.Lock()
+        self.KeyIndex = SortedKeys()
+        self.SensorTypeIndex = dict()
+
+
+    def GetShard(self, key):
+        """Returns the shard a publisher key lives in."""
+        return self.Shards[hash(key) % len(self.Shards)]
+
+
+    def GetLock(self, key):
+        """Returns the lock to hold while changing the publisher or its subscribers."""
+        return self.GetShard(key).Lock
+
+
+    def Get(self, key, default=None):
+        """Returns the publisher with this key without locking."""
+        return self.GetShard(key).Publishers.get(key, default)
+
+
+    def Contains(self, key):
+        """Returns True if a publisher with this key exists."""
+        return key in self.GetShard(key).Publishers
+
+
+    def Add(self, publisher):
+        """Adds a publisher.  Returns False if one with the same key is already there."""
+        shard = self.GetShard(publisher.Key)
+        with shard.Lock:
+            if publisher.Key in shard.Publishers:
+                return False
+
+            publishers = dict(shard.Publishers)
+            publishers[publisher.Key] = publisher
+            shard.Publishers = publishers
+            self.IndexPublisher(publisher)
+
+        return True
+
+
+    def Remove(self, key, publisher=None):
+        """Removes a publisher and returns it, or None if it was not there.  If publisher is given it is only
+           removed if it is still the one registered under key."""
+        shard = self.GetShard(key)
+        with shard.Lock:
+            current = shard.Publishers.get(key)
+            if current is None or (publisher is not None and current is not publisher):
+                return None
+
+            publishers = dict(shard.Publishers)
+            del publishers[key]
+            shard.Publishers = publishers
+            self.UnindexPublisher(current)
+
+        return current
+
+
+    def Load(self, publishers):
+        """Replaces every publisher with the ones in a key to publisher dictionary in one go.  Adding them one
+           at a time would copy a shard for every publisher."""
+        shards = [dict() for shard in self.Shards]
+        for key, publisher in publishers.items():
+            shards[hash(key) % len(self.Shards)][key] = publisher
+
+        for shard, publishers in zip(self.Shards, shards):
+            with shard.Lock:
+                shard.Publishers = publishers
+
+        self.Reindex()
+
+
+    def IndexPublisher(self, publisher):
+        """Files a publisher in the discovery indexes."""
+        with self.IndexLock:
+            self.KeyIndex.Add(publisher.Key)
+            index = self.SensorTypeIndex.get(publisher.SensorType)
+            if index is None:
+                index = self.SensorTypeIndex[publisher.SensorType] = SortedKeys()
+            index.Add(publisher.Key)
+
+
+    def UnindexPublisher(self, publisher):
+        """Takes a publisher out of the discovery indexes."""
+        with self.IndexLock:
+            self.KeyIndex.Remove(publisher.Key)
+            index = self.SensorTypeIndex.get(publisher.SensorType)
+            if index is not None:
+                index.Remove(publisher.Key)
+                if not index:
+                    del self.SensorTypeIndex[publisher.SensorType]
+
+
+    def Reindex(self):
+        """Builds the discovery indexes again from the shards, sorting once instead of inserting every key."""
+        sensor_types = dict()
+        for key, publisher in self.Items():
+            sensor_types.setdefault(publisher.SensorType, []).append(key)
+
+        key_index = SortedKeys()
+        key_index.Keys = sorted(key for keys in sensor_types.values() for key in keys)
+        sensor_type_index = dict()
+        for sensor_type, keys in sensor_types.items():
+            index = sensor_type_index[sensor_type] = SortedKeys()
+            index.Keys = sorted(keys)
+
+        with self.IndexLock:
+            self.KeyIndex = key_index
+            self.SensorTypeIndex = sensor_type_index
+
+
+    def Discover(self, prefix="", sensor_type=None, after=None, limit=None):
+        """Returns up to limit keys of publishers whose key starts with prefix and, unless it is None, whose
+           sensor type is sensor_type.  The keys are in order starting after the key after, if it is given,
+           so the last key of one page is where the next one starts.  The second value returned is True if
+           there are more keys after these."""
+        with self.IndexLock:
+            if sensor_type is None:
+                index = self.KeyIndex
+            else:
+                index = self.SensorTypeIndex.get(sensor_type)
+                if index is None:
+                    return [], False
+
+            # One key past the limit tells us whether there is another page.
+            keys = index.Range(prefix, after, limit + 1 if limit is not None else None)
+
+        if limit is not None and len(keys) > limit:
+            return keys[:limit], True
+        return keys, False
+
+
+    def Items(self):
+        """Returns a snapshot list of (key, publisher) pairs.  Each shard is read without locking."""
+        items = []
+        for shard in self.Shards:
+            items.extend(shard.Publishers.items())
+        return items
+
+
+    def Keys(self):
+        """Returns a snapshot list of the publisher keys."""
+        return [key for key, publisher in self.Items()]
+
+
+    def Values(self):
+        """Returns a snapshot list of the publishers."""
+        return [publisher for key, publisher in self.Items()]
+
+
+    def Clear(self):
+        """Removes every publisher."""
+        for shard in self.Shards:
+            with shard.Lock:
+                shard.Publishers = dict()
+
+        with self.IndexLock:
+            self.KeyIndex = SortedKeys()
+            self.SensorTypeIndex = dict()
+
+
+    def __len__(self):
+        return sum(len(shard.Publishers) for shard in self.Shards)
@@ -0,0 +1,242 @@
+# RegistryJournal.py
+# Keeps the publishers and subscribers of the central node on disk, so a restarted central node picks
+# up where it left off instead of making every client register again.  Every change is appended to a
+# write ahead log, and once the log gets big it is compacted into a snapshot of the whole registry.
+
+import mmap
+import os
+import socket
+import struct
+import threading
+import zlib
+from Command import Command
+import Log
+
+class RegistryJournal(object):
+    """Write ahead log plus snapshot of the publisher registry.  A record is one of the keyed command codes,
+       ADD_PUBLISHER, REMOVE_PUBLISHER, ADD_SUBSCRIBER or REMOVE_SUBSCRIBER, with everything needed to redo
+       it.  Replaying records is idempotent, an add replaces and a remove of something missing does nothing,
+       so the log can overlap the snapshot.  Records are checksummed and a torn record at the end of the log,
+       from a crash in the middle of a write, is cut off when the log is loaded.
+
+       Records are written straight to the file descriptor, so a crash of the central node loses nothing.
+       The log is fsynced by Sync() which housekeeping calls once a second, so a crash of the machine loses
+       at most the last second."""
+
+    # Checksum and length of the body in front of every record.
+    RECORD_HEADER = struct.Struct(">IH")
+
+    # Record type, client ip, client port, broadcast port, sensor type and data encoding, then the key.
+    RECORD_BODY = struct.Struct(">B4sHHIB")
+
+    SNAPSHOT_MAGIC = b"SMPSNAP1"
+
+    # Compact once the log is this big.
+    DEFAULT_COMPACT_SIZE = 16 * 1024 * 1024
+
+    NO_ADDRESS = ("0.0.0.0", 0)
+
+    def __init__(self, directory, name="registry", compact_size=DEFAULT_COMPACT_SIZE):
+        """Public constructor.  The files are called name.snap and name.wal in directory."""
+        self.Directory = directory
+        self.LogPath = os.path.join(directory, name + ".wal")
+        self.OldLogPath = self.LogPath + ".old"
+        self.SnapshotPath = os.path.join(directory, name + ".snap")
+        self.CompactSize = compact_size
+
+        self.Lock = threading.Lock()
+        self.File = None
+        self.Size = 0
+        self.Dirty = False
+        self.Compacting = False
+
+
+    def PackRecord(self, code, key, address=NO_ADDRESS, broadcast_port=0, sensor_type=0, data_encoding=0):
+        """Returns the bytes of one record."""
+        body = self.RECORD_BODY.pack(code, socket.inet_aton(address[0]), address[1], broadcast_port,
+                                     sensor_type, data_encoding) + key
+        return self.RECORD_HEADER.pack(zlib.crc32(body) & 0xFFFFFFFF, len(body)) + body
+
+
+    def ReadRecords(self, data, offset=0):
+        """Yields (code, key, address, broadcast port, sensor type, data encoding, end) for every good record
+           in data starting at offset, where end is the offset right after the record.  Stops at the first
+           record that is cut short or has a bad checksum."""
+        header_size = self.RECORD_HEADER.size
+        body_size = self.RECORD_BODY.size
+        header = self.RECORD_HEADER.unpack_from
+        body = self.RECORD_BODY.unpack_from
+        inet_ntoa = socket.inet_ntoa
+
+        size = len(data)
+        while offset + header_size <= size:
+            crc, length = header(data, offset)
+            start = offset + header_size
+            end = start + length
+            if length < body_size or end > size or zlib.crc32(data[start:end]) & 0xFFFFFFFF != crc:
+                return
+
+            code, ip, port, broadcast_port, sensor_type, data_encoding = body(data, start)
+            yield code, data[start + body_size:end], (inet_ntoa(ip), port), broadcast_port, sensor_type, data_encoding, end
+            offset = end
+
+
+    def Load(self):
+        """Yields (code, key, address, broadcast port, sensor type, data encoding) for the snapshot and then
+           for the log, in the order they have to be redone.  Call it before Open()."""
+        if os.path.exists(self.SnapshotPath) and os.path.getsize(self.SnapshotPath) > len(self.SNAPSHOT_MAGIC):
+            with open(self.SnapshotPath, "rb") as snapshot:
+                data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    if data[:len(self.SNAPSHOT_MAGIC)] == self.SNAPSHOT_MAGIC:
+                        for record in self.ReadRecords(data, len(self.SNAPSHOT_MAGIC)):
+                            yield record[:-1]
+                    else:
+                        Log.Error("%s is not a registry snapshot, ignoring it", self.SnapshotPath)
+                finally:
+                    data.close()
+
+        # A log left over from a compaction that never finished comes before the current one.
+        for path in (self.OldLogPath, self.LogPath):
+            if not os.path.exists(path):
+                continue
+
+            with open(path, "rb") as log:
+                data = log.read()
+
+            end = 0
+            for record in self.ReadRecords(data):
+                end = record[-1]
+                yield record[:-1]
+
+            # Drop a record that was only half written when we went down.
+            if end < len(data):
+                Log.Warning("Cutting %d bytes of torn records off the end of %s", len(data) - end, path)
+                with open(path, "r+b") as log:
+                    log.truncate(end)
+
+
+    def Open(self):
+        """Opens the log for appending."""
+        if not os.path.isdir(self.Directory):
+            os.makedirs(self.Directory)
+
+        self.File = os.open(self.LogPath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.Size = os.fstat(self.File).st_size
+
+
+    def Close(self):
+        """Syncs and closes the log."""
+        with self.Lock:
+            if self.File is not None:
+                os.fsync(self.File)
+                os.close(self.File)
+                self.File = None
+
+
+    def Append(self, code, key, address=NO_ADDRESS, broadcast_port=0, sensor_type=0, data_encoding=0):
+        """Writes a record to the log."""
+        record = self.PackRecord(code, key, address, broadcast_port, sensor_type, data_encoding)
+        with self.Lock:
+            os.write(self.File, record)
+            self.Size = self.Size + len(record)
+            self.Dirty = True
+
+
+    def AddPublisher(self, publisher):
+        """Records a new publisher."""
+        self.Append(Command.ADD_PUBLISHER, publisher.Key, publisher.ClientAddress, publisher.BroadcastPort,
+                    publisher.SensorType, publisher.DataEncoding)
+
+
+    def RemovePublisher(self, key):
+        """Records that a publisher and all of its subscribers are gone."""
+        self.Append(Command.REMOVE_PUBLISHER, key)
+
+
+    def AddSubscriber(self, key, client_address):
+        """Records a new subscriber to a publisher."""
+        self.Append(Command.ADD_SUBSCRIBER, key, client_address)
+
+
+    def RemoveSubscriber(self, key, client_address):
+        """Records that a subscriber left a publisher."""
+        self.Append(Command.REMOVE_SUBSCRIBER, key, client_address)
+
+
+    def Sync(self):
+        """Flushes the log to the disk if anything was written since the last time."""
+        with self.Lock:
+            if self.Dirty and self.File is not None:
+                os.fsync(self.File)
+                self.Dirty = False
+
+
+    def NeedsCompaction(self):
+        """Returns True once the log is big enough to be compacted."""
+        return self.Size >= self.CompactSize and not self.Compacting
+
+
+    def Compact(self, get_records):
+        """Replaces the snapshot with the current registry and throws the log away.  get_records is called
+           after the log is rolled over and returns (code, key, address, broadcast port, sensor type, data
+           encoding) add records for everything in the registry.  Changes made while it runs go to the new
+           log, which is replayed on top of the snapshot.  Returns False if a compaction is already running."""
+        with self.Lock:
+            if self.Compacting:
+                return False
+            self.Compacting = True
+
+            os.fsync(self.File)
+            os.close(self.File)
+            if os.path.exists(self.OldLogPath):
+                # The last compaction did not finish, its log has to stay until this one does.
+                with open(self.LogPath, "rb") as log:
+                    data = log.read()
+                with open(self.OldLogPath, "ab") as old:
+                    old.write(data)
+                    os.fsync(old.fileno())
+                os.remove(self.LogPath)
+            else:
+                os.rename(self.LogPath, self.OldLogPath)
+
+            self.File = os.open(self.LogPath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self.Size = 0
+            self.Dirty = False
+
+        try:
+            temporary = self.SnapshotPath + ".tmp"
+            with open(temporary, "wb") as snapshot:
+                snapshot.write(self.SNAPSHOT_MAGIC)
+                chunk = []
+                for record in get_records():
+                    chunk.append(self.PackRecord(*record))
+                    if len(chunk) >= 4096:
+                        snapshot.write(b"".join(chunk))
+                        chunk = []
+                snapshot.write(b"".join(chunk))
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+
+            os.rename(temporary, self.SnapshotPath)
+            self.SyncDirectory()
+            os.remove(self.OldLogPath)
+        finally:
+            self.Compacting = False
+
+        return True
+
+
+    def SyncDirectory(self):
+        """Makes renames in the directory durable."""
+        try:
+            directory = os.open(self.Directory, os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            os.fsync(directory)
+        except OSError:
+            pass
+        finally:
+            os.close(directory)
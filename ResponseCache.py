@@ -0,0 +1,96 @@
+# ResponseCache.py
+# Remembers the responses to recent client commands so a command the client sends again, because
+# our response got lost, gets the same response back instead of being carried out twice.
+
+import time
+
+class ResponseCache(object):
+    """The encoded responses to recent commands keyed by (client address, transaction id).  A command is
+       only a duplicate if it also has the same code, sensor type, reserved byte and payload, so a client
+       that reuses a transaction id for something else is not answered from the cache.
+
+       Entries live in two generations that are swapped every TTL seconds, like the buckets of
+       AdmissionControl, so old entries are dropped a whole generation at a time without ever being
+       looked at.  Begin() checks the age of an entry, so nothing older than the TTL is replayed.
+
+       Handlers on many threads use the cache at once.  Begin() claims a command with one setdefault, so
+       of two copies of a command that arrive together only one is carried out."""
+
+    # Seconds a response is kept, clients give up on a command long before this.
+    DEFAULT_TTL = 30.0
+
+    # Most entries in a generation, a flood swaps early instead of using up memory.
+    MAX_ENTRIES = 100000
+
+    # What Begin() returns for a command that is still being carried out.
+    IN_PROGRESS = object()
+
+    def __init__(self, ttl=DEFAULT_TTL, clock=time.time):
+        """Public constructor."""
+        self.TTL = ttl
+        self.Clock = clock
+        self.Current = dict()
+        self.Previous = dict()
+        self.NextSwap = clock() + ttl
+
+
+    def Begin(self, client_address, command, now=None):
+        """Claims a command for handling.  Returns None if it is new and the caller should carry it out and
+           then call Finish(), the cached response if it is a duplicate, or IN_PROGRESS if another handler
+           is carrying out the same command right now."""
+        if now is None:
+            now = self.Clock()
+
+        if now >= self.NextSwap or len(self.Current) >= self.MAX_ENTRIES:
+            self.Swap(now)
+
+        key = (client_address, command.TransactionID)
+        request = (command.Code, command.SensorType, command.Reserved, command.Payload)
+
+        # (request, response, time it was handled), the response is None until Finish().  Tuples of strings
+        # and numbers drop out of the garbage collector's sight, a cache full of lists made every collection
+        # slower.
+        entry = self.Current.get(key)
+        if entry is None:
+            entry = self.Previous.pop(key, None)
+            if entry is not None:
+                self.Current[key] = entry
+
+        if entry is not None and entry[0] == request and now - entry[2] < self.TTL:
+            return entry[1] if entry[1] is not None else self.IN_PROGRESS
+
+        claim = (request, None, now)
+        if entry is None:
+            entry = self.Current.setdefault(key, claim)
+            if entry is not claim:
+                # Another handler claimed it between our lookup and here.
+                return entry[1] if entry[0] == request and entry[1] is not None else self.IN_PROGRESS
+        else:
+            # A stale entry or a transaction id reused for something else.
+            self.Current[key] = claim
+
+        return None
+
+
+    def Finish(self, client_address, command, response, now=None):
+        """Stores the response to a command claimed with Begin().  A command with no response is forgotten
+           so it can be sent again."""
+        key = (client_address, command.TransactionID)
+        if not response:
+            self.Current.pop(key, None)
+            return
+
+        if now is None:
+            now = self.Clock()
+        self.Current[key] = ((command.Code, command.SensorType, command.Reserved, command.Payload), response, now)
+
+
+    def Swap(self, now):
+        """Starts a new generation, the entries nobody asked for in a whole generation are dropped."""
+        self.Previous = self.Current
+        self.Current = dict()
+        self.NextSwap = now + self.TTL
+
+
+    def __len__(self):
+        return len(self.Current) + len(self.Previous)
@@ -0,0 +1,148 @@
+# SMPCentralNodeEventLoop.py
+# Single threaded central node engine.  Drains the UDP socket in a non-blocking loop and
+# runs the housekeeping on a real clock instead of only when the socket is idle.
+
+import errno
+import select
+import socket
+import time
+from BatchSocket import BatchReceiver, BatchSender
+import Log
+
+class SMPCentralNodeEventLoop(object):
+    """Drop in replacement for SMPCentralNodeServer that handles every request on one thread."""
+
+    # Biggest datagram we will read.  recvmmsg needs a buffer this big for every datagram of a burst, longer
+    # ones are dropped, but no control packet comes close.
+    MAX_DATAGRAM_SIZE = 4096
+
+    # Most datagrams handled in one go before we check the clock again.
+    MAX_DRAIN = 256
+
+    def __init__(self, ip_str, port_num, handler, reuse_port=False, router=None):
+        """Constructor binds the socket and sets up the response handler.  With reuse_port several worker
+           processes can bind the same port, the router forwards commands owned by other workers."""
+        self.SMPCentralNodeServerAddress = (ip_str, port_num)
+        self.Handler = handler
+        self.Router = router
+
+        # Seconds between housekeeping runs, same meaning as the timeout on the UDP server.
+        self.timeout = 1
+        self.Running = False
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(self.SMPCentralNodeServerAddress)
+        self.socket.setblocking(0)
+
+        # Every datagram that is waiting is read in one go, and the responses to them are sent in one go.
+        # Handlers get the sender in place of the socket.
+        self.Receiver = BatchReceiver(self.socket, self.MAX_DRAIN, self.MAX_DATAGRAM_SIZE)
+        self.Sender = BatchSender(self.socket)
+
+        # Times the socket woke us up and the datagrams read, datagrams / wakeups is the average burst.
+        self.Wakeups = 0
+        self.Datagrams = 0
+
+
+    def handle_timeout(self):
+        """Housekeeping, the central node replaces this just like on the UDP server."""
+        pass
+
+
+    def serve_forever(self):
+        """Handle requests and run the housekeeping until Stop() is called."""
+        self.Running = True
+        next_housekeeping = time.time() + self.timeout
+
+        sockets = [self.socket]
+        if self.Router is not None:
+            sockets.append(self.Router.Channel)
+
+        while self.Running:
+            now = time.time()
+
+            # The clock decides when housekeeping runs, not how busy the socket is.
+            if now >= next_housekeeping:
+                # Retransmits that come due together go out together.
+                self.Sender.Begin()
+                try:
+                    self.handle_timeout()
+                finally:
+                    self.Sender.Flush()
+                next_housekeeping = max(next_housekeeping + self.timeout, now)
+                continue
+
+            try:
+                readable = select.select(sockets, [], [], next_housekeeping - now)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if self.socket in readable:
+                self.DrainSocket()
+
+            if self.Router is not None and self.Router.Channel in readable:
+                self.DrainChannel()
+
+
+    def DrainSocket(self):
+        """Handles every datagram waiting on the socket, up to MAX_DRAIN of them, and sends the responses
+           in one burst at the end."""
+        datagrams = self.Receiver.Receive()
+        self.Wakeups = self.Wakeups + 1
+        self.Datagrams = self.Datagrams + len(datagrams)
+
+        self.Sender.Begin()
+        try:
+            for data, client_address in datagrams:
+                self.HandleDatagram(data, client_address)
+        finally:
+            self.Sender.Flush()
+
+
+    def DrainChannel(self):
+        """Handles the commands other workers forwarded to us, up to MAX_DRAIN of them."""
+        self.Sender.Begin()
+        try:
+            for n in range(self.MAX_DRAIN):
+                forwarded = self.Router.Receive()
+                if forwarded is None:
+                    return
+
+                self.RunHandler(forwarded[0], forwarded[1])
+        finally:
+            self.Sender.Flush()
+
+
+    def HandleDatagram(self, data, client_address):
+        """Handles one datagram from a client, or passes it on to the worker that owns it."""
+        if self.Router is not None:
+            try:
+                if not self.Router.Dispatch(data, client_address):
+                    return
+            except Exception:
+                Log.Exception("Exception while routing a request from %s", client_address)
+                return
+
+        self.RunHandler(data, client_address)
+
+
+    def RunHandler(self, data, client_address):
+        """Runs the request handler for one datagram.  A bad request must not stop the loop."""
+        try:
+            self.Handler((data, self.Sender), client_address, self)
+        except Exception:
+            Log.Exception("Exception while handling a request from %s", client_address)
+
+
+    def Stop(self):
+        """Makes serve_forever() return after the current iteration."""
+        self.Running = False
+
+
+    def server_close(self):
+        """Closes the socket."""
+        self.socket.close()
@@ -5,384 +5,1047 @@
 
 from Publisher import Publisher
 from Subscriber import Subscriber
+from ClientSession import ClientSession
+from PortAllocator import PortAllocator
+from PublisherRegistry import PublisherRegistry
+from ResponseCache import ResponseCache
+from HashRing import HashRing
+from ShardRouter import ShardRouter
+from Metrics import MetricsRegistry
+from Transaction import Transaction
+from TimerWheel import TimerWheel
 from SocketServer import BaseRequestHandler 
 from Command import Command
+from struct import unpack_from
+import DataPacket
+import TopicTrie
+import gc
+import heapq
+import itertools
 import threading
+import time
 import Utility
-
-# Count before we boot a publsiher off the network.
-TIMEOUT_LIMIT = 10
-
-# Global data.
-Pubs = dict()
+import Log
+
+# Seconds without a keep alive before we boot a client off the network.
+TIMEOUT_LIMIT = 10.0
+
+# Global data.  Handlers run on many threads at once so each of these has a lock, see the comments.
+# Publishers are sharded and each shard has its own lock, the shard lock also covers the subscribers
+# of the publishers in it.  When locks are nested the order is shard, then topics, then sessions, then
+# transactions.
+Pubs = PublisherRegistry()
+Sessions = dict()
+SessionsLock = threading.RLock()
 Transactions = dict()
+TransactionsLock = threading.RLock()
 TransactionID = 0
 
+# The wildcard subscriptions filed under their pattern by client address, and every publisher filed under its
+# key, so a new publisher finds the patterns it matches and a new pattern finds the publishers it matches
+# without going through all of them.  Both are protected by TopicsLock.
+Patterns = TopicTrie.TopicTrie()
+PublisherTopics = TopicTrie.TopicTrie()
+TopicsLock = threading.RLock()
+
+# Which worker process this is when the central node runs as several, see SetWorker().
+WorkerIndex = 0
+WorkerCount = 1
+
+# Heap of (deadline, sequence, session) liveness deadlines.  A keep alive only updates the session, stale
+# entries are pushed back when they come up so every session has exactly one entry on the heap.
+# Protected by SessionsLock.
+SessionDeadlines = []
+SessionSequence = itertools.count()
+
+# Retransmit deadlines of the outstanding transactions, protected by TransactionsLock.
+TransactionTimers = TimerWheel()
+
+# The data encoding each sensor type settled on when its first publisher was added.
+SensorEncodings = dict()
+
+# The consistent hash ring of the cluster this central node is part of and our name on it, see SetCluster().
+# Both stay None when the node runs on its own.  The ring starts out with only us on it and a peer is put on
+# it when it joins.  The ring is replaced, never changed, and RingLock is held while it is, it is never held
+# with another lock.  Peers are the names of the nodes we were configured with, the only ones that may join.
+Ring = None
+LocalNode = None
+Peers = frozenset()
+RingLock = threading.Lock()
+
+# The RegistryJournal every change to the publishers and subscribers is written to so a restarted central
+# node gets them back, see RestoreRegistry().  None when the node does not keep any state.  Records are
+# appended while holding the shard lock so the log has the changes of a publisher in the order they happened.
+Journal = None
+
+# The AdmissionControl that rate limits the commands of each client, None lets everything through.
+Admission = None
+
+# The responses to recent client commands, a command sent again because the response got lost is answered
+# from here instead of being carried out twice.  None carries out every copy.
+Responses = ResponseCache()
+
+# Counters and histograms for STATS and the stats endpoint.  The gauges at the bottom of the file are only
+# worked out when someone asks for the stats.
+Stats = MetricsRegistry("smp_")
+PacketCounters = dict()
+BadPackets = Stats.GetCounter("bad_packets")
+CRCFailures = Stats.GetCounter("crc_failures")
+Redirects = Stats.GetCounter("redirects")
+Retransmits = Stats.GetCounter("retransmits")
+TransactionsExpired = Stats.GetCounter("transactions_expired")
+ClientsExpired = Stats.GetCounter("clients_expired")
+HandlerLatency = Stats.GetHistogram("handler_latency_us")
+DuplicateCommands = Stats.GetCounter("duplicate_commands")
+ThrottledCounters = dict()
+
+def NegotiateDataEncoding(sensor_type, requested):
+    """Returns the data encoding publishers of a sensor type have to use.  The first publisher of a
+       sensor type picks the encoding, every later one is told to use the same one."""
+    if requested not in DataPacket.ENCODINGS:
+        requested = DataPacket.ENCODING_PLAIN
+
+    # setdefault is atomic so two first publishers can't both win.
+    return SensorEncodings.setdefault(sensor_type, requested)
+
 def StoreTransaction(id, command, socket, address):
-    """This function logs a transaction with the central node, since it may need to be resent. """
-    print "New transaction logged: ID=" + str(id) + " Address=" + str(address)
-    # we store the actually command, the socket of hte client it went to, the lcients address and a timeout counter in a tuple.
+    """This function logs a transaction with the central node, since it may need to be resent.  The command
+       is encoded once here, returns the Transaction so the caller can send it."""
+    Log.Debug("New transaction logged: ID=%s Address=%s", id, address)
 
-    Transactions[id] = (command, socket, address, 0)
+    transaction = Transaction(id, command.GetPacket(), socket, address)
+    transaction.Deadline = time.time() + transaction.GetTimeout()
+    with TransactionsLock:
+        Transactions[id] = transaction
+        TransactionTimers.Schedule(transaction.Deadline, transaction)
 
+    return transaction
 
-def HandleTimeout():
-    """This function is called if nothing is recieved during a call to handle_request() on the UDP server."""
-    
-    # Keep a list of those transactions we need to remove.
-    toberemoved = []
-
-    # for all transactions...
-    for key,value in Transactions.items():
-
-        # stored the command in the zeroeth element of the tuple.
-        command = Transactions[key][0]
-        # stored the socket in the first element.
-        socket = Transactions[key][1]
-        # stored the address in the second element.
-        address = Transactions[key][2]
-
-        # RQ 14
-        # the final elemnt of the transaction is the count.  If this is the second time we were here instead of
-        # retrying the send we call it a loss and delete the transaction.
-        if Transactions[key][3] <= 1:
-            print "Resending transaction " + str(key)
-            socket.sendto(command.GetPacket(), address)
-
-            # We have to update the tuble this way since tuples are immutable.
-            Transactions[key] = (Transactions[key][0], Transactions[key][1], Transactions[key][2], Transactions[key][3]+1) 
-        else:
-            # We are giving up on this transaction its time to remove it.
-            toberemoved.append(key)
 
-    # We have to go back and delete all of the items that we didn't retry now.
-    for key in toberemoved:
-        print "Transaction " + str(key) + " timed out.  Removing it."
-        del Transactions[key]
+def HandleTransactionTimeouts(now=None):
+    """Retransmits the transactions whose deadline has passed, backing off a little more each time,
+       and gives up on the ones that ran out of retransmits.  Only the due transactions are touched."""
+    if now is None:
+        now = time.time()
+
+    with TransactionsLock:
+        for transaction in TransactionTimers.Advance(now):
 
+            # The transaction already got its response, or the id was reused for a newer one.
+            if Transactions.get(transaction.ID) is not transaction:
+                continue
 
-    # Keep track of publishers we need to delete.
-    already_incremented_subs = []
-    pubs_to_be_deleted = []
+            # RQ 14
+            if transaction.Retransmits < Transaction.MAX_RETRANSMITS:
+                Log.Debug("Resending transaction %s", transaction.ID)
+                transaction.Send()
+                Retransmits.Increment()
+
+                transaction.Retransmits = transaction.Retransmits + 1
+                transaction.Deadline = now + transaction.GetTimeout()
+                TransactionTimers.Schedule(transaction.Deadline, transaction)
+            else:
+                # We are giving up on this transaction its time to remove it.
+                Log.Info("Transaction %s timed out.  Removing it.", transaction.ID)
+                del Transactions[transaction.ID]
+                TransactionsExpired.Increment()
+
+
+def HandleTimeout():
+    """This function is called by the central node once a second to do the housekeeping."""
+
+    HandleTransactionTimeouts()
+
+    HandleSessionTimeouts()
+
+    HandleJournal()
+
+
+def HandleJournal():
+    """Flushes the registry journal to the disk and compacts it into a snapshot once the log gets big.  The
+       snapshot is written on its own thread so housekeeping is not held up."""
+    journal = Journal
+    if journal is None:
+        return
+
+    journal.Sync()
+
+    if journal.NeedsCompaction():
+        thread = threading.Thread(target=CompactJournal, args=(journal,), name="Journal compaction")
+        thread.daemon = True
+        thread.start()
+
+
+def CompactJournal(journal):
+    """Writes a snapshot of the registry and throws away the log it replaces."""
+    start = time.time()
+    try:
+        if journal.Compact(GetRegistryRecords):
+            Log.Info("Compacted the registry journal in %.0f ms", (time.time() - start) * 1000)
+    except Exception:
+        Log.Exception("Compacting the registry journal failed")
+
+
+def GetRegistryRecords():
+    """Yields the journal records that add every publisher and subscriber in the registry right now."""
+    for key, publisher in Pubs.Items():
+        with Pubs.GetLock(key):
+            if Pubs.Get(key) is not publisher:
+                continue
+            # Wildcard subscribers are added back by their pattern.
+            addresses = [address for address, subscriber in publisher.Subs.items() if subscriber.Pattern is None]
+
+        yield (Command.ADD_PUBLISHER, key, publisher.ClientAddress, publisher.BroadcastPort,
+               publisher.SensorType, publisher.DataEncoding)
+        for address in addresses:
+            yield (Command.ADD_SUBSCRIBER, key, address)
+
+    with TopicsLock:
+        subscribers = Patterns.Values()
+
+    for subscriber in subscribers:
+        yield (Command.ADD_SUBSCRIBER, subscriber.Pattern, subscriber.Key)
+
+
+def RestoreRegistry(journal, socket):
+    """Rebuilds the publishers, subscribers, broadcast ports and client sessions from a journal, then keeps
+       writing to it.  Call it once at startup before serving any requests.  socket is the server socket
+       commands to the restored clients are sent from.  Returns the number of publishers and subscribers."""
+    global Journal
+
+    # Nothing we create here is garbage, so don't let the collector walk the growing registry over and over.
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        count = LoadRegistry(journal, socket)
+    finally:
+        if collecting:
+            gc.enable()
+
+    journal.Open()
+    Journal = journal
+
+    return count
+
+
+def LoadRegistry(journal, socket):
+    """Replays a journal into the registry, see RestoreRegistry()."""
+
+    # Replay the records into plain tuples first, a publisher may be added and removed many times in the log.
+    # The subscriptions to a pattern are kept apart, they outlive the publishers they matched.
+    records = dict()
+    patterns = dict()
+    for code, key, address, broadcast_port, sensor_type, data_encoding in journal.Load():
+        if code == Command.ADD_PUBLISHER:
+            records[key] = (address, broadcast_port, sensor_type, data_encoding, [])
+        elif code == Command.REMOVE_PUBLISHER:
+            records.pop(key, None)
+        elif code == Command.ADD_SUBSCRIBER and TopicTrie.IsPattern(key):
+            patterns.setdefault(key, set()).add(address)
+        elif code == Command.REMOVE_SUBSCRIBER and TopicTrie.IsPattern(key):
+            patterns.get(key, set()).discard(address)
+        elif code == Command.ADD_SUBSCRIBER:
+            if key in records and address not in records[key][4]:
+                records[key][4].append(address)
+        elif code == Command.REMOVE_SUBSCRIBER:
+            if key in records and address in records[key][4]:
+                records[key][4].remove(address)
+
+    # Every restored client gets a whole TIMEOUT_LIMIT from now to show up again.
+    now = time.time()
+    sessions = dict()
+    def GetRestoredSession(address):
+        session = sessions.get(address)
+        if session is None:
+            session = sessions[address] = ClientSession(address, now)
+        return session
+
+    publishers = dict()
+    subscribers = 0
+    request = (None, socket)
+    for key, (address, broadcast_port, sensor_type, data_encoding, addresses) in records.items():
+        # Clients keep streaming on the port they were given, so it has to stay theirs.
+        if not Ports.Reserve(broadcast_port):
+            Log.Warning("Restored publisher %s has port %d which is outside the port ranges or taken twice",
+                        key, broadcast_port)
+
+        SensorEncodings.setdefault(sensor_type, data_encoding)
+        publisher = Publisher(key, request, address, broadcast_port, sensor_type, data_encoding)
+        publishers[key] = publisher
+        GetRestoredSession(address).Publishers[key] = publisher
+
+        for subscriber_address in addresses:
+            subscriber = Subscriber(request, subscriber_address)
+            publisher.Subs[subscriber_address] = subscriber
+            GetRestoredSession(subscriber_address).Subscriptions[key] = subscriber
+            subscribers = subscribers + 1
+
+    # The clients already know the publishers their patterns matched, so nobody is told about them again.
+    with TopicsLock:
+        for key, publisher in publishers.items():
+            PublisherTopics.Add(key, key, publisher)
+
+        for pattern, addresses in patterns.items():
+            for subscriber_address in addresses:
+                subscriber = Subscriber(request, subscriber_address, 0, pattern)
+                Patterns.Add(pattern, subscriber_address, subscriber)
+                session = GetRestoredSession(subscriber_address)
+                session.Patterns[pattern] = subscriber
+                subscribers = subscribers + 1
+
+                for publisher in PublisherTopics.Find(pattern):
+                    if subscriber_address not in publisher.Subs:
+                        publisher.Subs[subscriber_address] = subscriber
+                        session.Subscriptions[publisher.Key] = subscriber
+
+    with SessionsLock:
+        Sessions.update(sessions)
+        SessionDeadlines.extend((now + TIMEOUT_LIMIT, next(SessionSequence), session) for session in sessions.values())
+        heapq.heapify(SessionDeadlines)
+
+    Pubs.Load(publishers)
+
+    return len(publishers), subscribers
+
+
+def HandleSessionTimeouts(now=None):
+    """Removes the clients we have not heard from in TIMEOUT_LIMIT seconds.  Only the sessions whose
+       deadline has passed are looked at."""
+    if now is None:
+        now = time.time()
 
     # RQ 16b
-    # We also need to handle when a  subscriber doesn't send us a keep alive packet.
-    for pubkey, pubvalue in Pubs.items():
-        pubvalue.TimeoutCount = pubvalue.TimeoutCount + 1
+    # Every client has to keep sending keep alives, if one stops everything it owns is removed.
+    expired = []
+    with SessionsLock:
+        while SessionDeadlines and SessionDeadlines[0][0] <= now:
+            deadline, sequence, session = heapq.heappop(SessionDeadlines)
+
+            # The session was already removed, or the client owns nothing anymore.
+            if Sessions.get(session.ClientAddress) is not session:
+                continue
+
+            # We heard from the client since this deadline was set, so wait for the new one.
+            if session.LastSeen + TIMEOUT_LIMIT > now:
+                ScheduleSession(session)
+                continue
+
+            expired.append(session)
+
+    # The removal takes shard locks so it has to happen after we let go of the sessions.
+    for session in expired:
+        Log.Info("Client %s has timed out.  Removing its publishers and subscribers...", session.ClientAddress)
+        ClientsExpired.Increment()
+        RemoveSession(session.ClientAddress, session)
+
+
+def ScheduleSession(session):
+    """Puts the liveness deadline of a session on the heap, the caller holds SessionsLock."""
+    heapq.heappush(SessionDeadlines, (session.LastSeen + TIMEOUT_LIMIT, next(SessionSequence), session))
+
+
+def GetSession(client_address):
+    """Returns the session of a client address, creating it the first time the client adds something.
+       The caller should hold SessionsLock for as long as it uses the session."""
+    with SessionsLock:
+        session = Sessions.get(client_address)
+        if session is None:
+            session = ClientSession(client_address, time.time())
+            Sessions[client_address] = session
+            ScheduleSession(session)
+
+    return session
+
+
+def ReleaseSession(session):
+    """Forgets a session once the client no longer owns anything, the caller holds SessionsLock."""
+    if session.IsEmpty() and Sessions.get(session.ClientAddress) is session:
+        del Sessions[session.ClientAddress]
+
+
+def DetachSubscription(client_address, pubkey):
+    """Takes a subscription out of the session of a client."""
+    with SessionsLock:
+        session = Sessions.get(client_address)
+        if session is not None:
+            session.Subscriptions.pop(pubkey, None)
+            ReleaseSession(session)
+
+
+def RemovePublisher(publisher, redirect=None):
+    """Removes a publisher from the mesh and tells all of its subscribers it is gone.  If redirect is the
+       address of another central node the publisher and its subscribers are sent there instead.  Returns
+       False if someone else already removed it."""
+    with Pubs.GetLock(publisher.Key):
+        if Pubs.Remove(publisher.Key, publisher) is None:
+            return False
+
+        if Journal is not None:
+            Journal.RemovePublisher(publisher.Key)
+
+        with TopicsLock:
+            PublisherTopics.Remove(publisher.Key, publisher.Key)
+
+        if redirect is not None:
+            payload = Command.PackNodeAddress(redirect, publisher.Key)
+            publisher.SendCommand(Command.REDIRECT, payload)
+
+        # A wildcard subscriber can't follow one publisher to another node, for it the publisher is gone.
+        for address, subscriber in publisher.Subs.items():
+            if redirect is None or subscriber.Pattern is not None:
+                subscriber.SendCommand(Command.PUBLISHER_REMOVED, publisher.Key)
+            else:
+                subscriber.SendCommand(Command.REDIRECT, payload)
+            DetachSubscription(address, publisher.Key)
+
+        with SessionsLock:
+            session = Sessions.get(publisher.ClientAddress)
+            if session is not None:
+                session.Publishers.pop(publisher.Key, None)
+                ReleaseSession(session)
+
+    Ports.Release(publisher.BroadcastPort)
+    return True
+
+
+def RemoveSubscriber(publisher, client_address):
+    """Removes a subscriber from a publisher, the publisher is told to stop once nobody is listening.
+       Returns False if the client was not subscribed to it."""
+    with Pubs.GetLock(publisher.Key):
+        if Pubs.Get(publisher.Key) is not publisher or not publisher.Subs.has_key(client_address):
+            return False
+
+        subscriber = publisher.Subs.pop(client_address)
+        DetachSubscription(client_address, publisher.Key)
+
+        # A wildcard subscription is journaled by its pattern, not by the publishers it matched.
+        if Journal is not None and subscriber.Pattern is None:
+            Journal.RemoveSubscriber(publisher.Key, client_address)
+
+        # if that was the last subscriber we send the stop publshing command.
+        if len(publisher.Subs) == 0:
+            Log.Info("Publisher %s no longer has any subscribers. Sending StopPublishing...", publisher.Key)
+            publisher.SendCommand(Command.STOP_PUBLISHING)
+
+    return True
+
+
+def AttachWildcard(publisher, subscriber, deferred=None):
+    """Adds the subscriber of a wildcard subscription to a publisher its pattern matches and sends it a
+       PUBLISHER_ADDED, the publisher is told to start if it was idle.  Returns False if the publisher or the
+       subscription is gone, or the client already subscribes to the publisher."""
+    with Pubs.GetLock(publisher.Key):
+        if Pubs.Get(publisher.Key) is not publisher or subscriber.Key in publisher.Subs:
+            return False
+
+        with TopicsLock:
+            if Patterns.Get(subscriber.Pattern).get(subscriber.Key) is not subscriber:
+                return False
+
+        if 0 == len(publisher.Subs):
+            publisher.SendCommand(Command.START_PUBLISHING, deferred=deferred)
+
+        publisher.Subs[subscriber.Key] = subscriber
+
+        with SessionsLock:
+            GetSession(subscriber.Key).Subscriptions[publisher.Key] = subscriber
+
+        payload = Command.PackPublisherAdded(publisher.BroadcastPort, publisher.DataEncoding, publisher.Key)
+        subscriber.SendCommand(Command.PUBLISHER_ADDED, payload, deferred)
+
+    return True
+
+
+def RemoveWildcard(subscriber):
+    """Removes a wildcard subscription and takes its subscriber off every publisher it was added to.  Returns
+       False if someone else already removed it."""
+    with TopicsLock:
+        if Patterns.Get(subscriber.Pattern).get(subscriber.Key) is not subscriber:
+            return False
 
-        # if we have timed out we need to send a pub removed to all subsribers.
-        if(pubvalue.TimeoutCount > TIMEOUT_LIMIT):
-            print "Publisher " + pubkey + " has timed out.  Removing subscribers..."
-            for subkey, subvalue in pubvalue.Subs.items():
-                subvalue.SendCommand(Command.PUBLISHER_REMOVED, pubvalue.Key)
+        Patterns.Remove(subscriber.Pattern, subscriber.Key)
+        publishers = PublisherTopics.Find(subscriber.Pattern)
 
-            # we actually have to delete the publisher, but we can't do it in the loop so we add it to a to be deleted list.
-            pubs_to_be_deleted.append(pubkey)
+        if Journal is not None:
+            Journal.RemoveSubscriber(subscriber.Pattern, subscriber.Key)
 
-        else: # Else the thing is okay, so now we add TimeoutCounts to the subscribers.
-            subs_to_be_deleted = []
+        # The client may subscribe to the same pattern again as soon as we let go, that one stays.
+        with SessionsLock:
+            session = Sessions.get(subscriber.Key)
+            if session is not None and session.Patterns.get(subscriber.Pattern) is subscriber:
+                del session.Patterns[subscriber.Pattern]
 
-            prev_sub_count = len(pubvalue.Subs)
+    for publisher in publishers:
+        if publisher.Subs.get(subscriber.Key) is subscriber:
+            RemoveSubscriber(publisher, subscriber.Key)
 
-            for subkey, subvalue in pubvalue.Subs.items():
-                # We have to make sure we have't already incrememnted this sub, since he might be on multiple publishers.
-                if subkey not in already_incremented_subs:
-                    subvalue.TimeoutCount = subvalue.TimeoutCount + 1
-                    already_incremented_subs.append(subkey)
+    with SessionsLock:
+        session = Sessions.get(subscriber.Key)
+        if session is not None:
+            ReleaseSession(session)
 
-                    # now we need to check if the subscriber has timed out if so we delete him.
-                    if subvalue.TimeoutCount > TIMEOUT_LIMIT:
-                        print "Subscriber " + subkey[0] + ":" + str(subkey[1])  + " has timed out."
-                        # we need to remove this subscriber, but can't do it in the loop so we add it to a list to be here.
-                        subs_to_be_deleted.append(subkey)
+    return True
 
-            # now we actually remove all of the subscribers who have timed out.
-            for sub in subs_to_be_deleted:
-                del pubvalue.Subs[sub]
 
-            # if that was the last subscriber we send the stop publshing command.
-            if len(pubvalue.Subs) == 0 and prev_sub_count != 0:
-                print "Publisher " + pubkey + " no longer has any subscribers. Sending StopPublishing..."
-                pubvalue.SendCommand(Command.STOP_PUBLISHING)
+def RemoveSession(client_address, session=None):
+    """Removes every publisher and subscriber a client owns in one go.  If session is given it is only
+       removed if it is still the session of that client."""
+    with SessionsLock:
+        current = Sessions.get(client_address)
+        if current is None or (session is not None and current is not session):
+            return
+
+        del Sessions[client_address]
+        publishers = current.Publishers.values()
+        pubkeys = current.Subscriptions.keys()
+        patterns = current.Patterns.values()
+
+    # The patterns go first so no new publisher is added to the client while we are at it.
+    for subscriber in patterns:
+        RemoveWildcard(subscriber)
 
-    # actually do the removal of stale publishers.
-    for pub in pubs_to_be_deleted:
-        del Pubs[pub]
+    for publisher in publishers:
+        RemovePublisher(publisher)
+
+    for pubkey in pubkeys:
+        publisher = Pubs.Get(pubkey)
+        if publisher is not None:
+            RemoveSubscriber(publisher, client_address)
 
 
 # RQ 11
 def GetNextTransactionID():
     """THis function generates a negative transaction ID.  All transaction ids that come from the central
-       node must have a negative number."""
+       node must have a negative number.  Each worker only uses the ids where -id % WorkerCount is its index."""
     global TransactionID
 
-    # Wrap the ID around.
-    if TransactionID <= -32767:
-        TransactionID = 0
+    with TransactionsLock:
+        # Decrement it.
+        TransactionID = TransactionID - WorkerCount
 
-    # Decrement it.
-    TransactionID = TransactionID - 1
+        # Wrap the ID around.
+        if TransactionID < -32767:
+            TransactionID = -(WorkerIndex or WorkerCount)
 
-    return TransactionID
+        return TransactionID
 
-# These globals are used to keep track of available ports on the publisher network.
-FirstTime = True
-AvailablePorts = []
 
-class SMPCentralNodeRequestHandler (BaseRequestHandler):
-    """This class is pretty much the whole server.  It does all the respose handling and all of the
-       data manipulation."""
+def SetWorker(index, count):
+    """Makes this process worker index of count.  It gets its own share of the transaction ids and the ports."""
+    global WorkerIndex, WorkerCount, TransactionID, Ports
 
-    def FirstTimePortSetup(self):
-        """We create a list of all possible ports we can use.  We do this os we can add or remove them."""
-        # RQ 5
-        for i in range(15002, 15555):
-            AvailablePorts.append(i);
+    WorkerIndex = index
+    WorkerCount = count
+    TransactionID = -(index or count) + count
+    Ports = Ports.Partition(index, count)
 
+def AnswersPattern(pattern):
+    """Returns True if this worker answers a command on a pattern.  Every worker carries out a pattern command for
+       its own publishers, only the worker the pattern hashes to answers it so the client gets a single response."""
+    return WorkerCount == 1 or ShardRouter.GetShard(pattern, WorkerCount) == WorkerIndex
+
+def FormatNode(address):
+    """Returns the name of a central node on the ring, like "127.0.0.1:15001"."""
+    return address[0] + ":" + str(address[1])
+
+
+def ParseNode(node):
+    """Returns the (ip, port) address of a central node from its name on the ring."""
+    ip, port = node.rsplit(":", 1)
+    return (ip, int(port))
 
-    def GetNextPort(self):
-        """ Returns the next port in the list.  Also creates the new list if this is the first time this is called."""
-        global FirstTime
 
+def SetCluster(local_address, peers):
+    """Makes this central node part of a cluster with the peers, a list of (ip, port) addresses."""
+    global Ring, LocalNode, Peers
 
-        # Only set up the dictionary once.
-        if(FirstTime):
-            self.FirstTimePortSetup()
-            FirstTime = False
+    LocalNode = FormatNode(local_address)
+    Peers = frozenset(FormatNode(peer) for peer in peers)
+    Ring = HashRing([LocalNode])
 
-        # Make sure a port is available before trying to add one.
-        if(len(AvailablePorts) > 0):
-            return AvailablePorts.pop(0)
 
+def GetOwnerNode(key):
+    """Returns the address of the central node that owns a publisher key, or None if it is this one."""
+    ring = Ring
+    if ring is None:
         return None
 
+    owner = ring.GetNode(key)
+    if owner == LocalNode:
+        return None
+
+    return ParseNode(owner)
+
+
+def AnnounceJoin(socket, nodes=None, reserved=0):
+    """Tells the other nodes of the cluster, every peer unless nodes names some, that we are here.  Each one
+       puts us on its ring, hands over the keys we now own and announces itself back to us.  The
+       announcements are transactions so they are resent until each node answers."""
+    payload = Command.PackNodeAddress(ParseNode(LocalNode))
+    for node in sorted(Peers if nodes is None else nodes):
+        TxId = GetNextTransactionID()
+        command = Command().CreateFromParams(Command.NODE_JOINED, TxId, 0, payload, reserved)
+        StoreTransaction(TxId, command, socket, ParseNode(node)).Send()
+
+
+def JoinNode(node):
+    """Puts a new node on the ring and hands it the publishers it now owns.  Returns False if we already
+       knew about it."""
+    global Ring
+
+    # Two nodes joining at once each have to see the ring the other one made.
+    with RingLock:
+        ring = Ring
+        if node in ring.Nodes:
+            return False
+
+        Ring = HashRing(ring.Nodes | set([node]), ring.Replicas)
+
+    # Only the keys that landed on the new node move, everything else stays where it is.
+    for key, publisher in Pubs.Items():
+        owner = GetOwnerNode(key)
+        if owner is not None:
+            Log.Info("Publisher %s now belongs to %s.  Redirecting its clients...", key, FormatNode(owner))
+            RemovePublisher(publisher, owner)
+
+    return True
+
+
+def GetCommandName(code):
+    """Returns the name of a command code for the stats, or the number if we don't know it."""
+    return Command().CreateFromParams(code, 0, 0, "").GetCommandString() or str(code)
+
+
+def GetSubscriberCounts():
+    """Returns a (labels, subscriber count) pair for every publisher for the stats."""
+    return [('key="%s"' % key, len(publisher.Subs)) for key, publisher in Pubs.Items()]
+
+
+# Keeps track of available ports on the publisher network.
+Ports = PortAllocator()
+
+class SMPCentralNodeRequestHandler (BaseRequestHandler):
+    """This class is pretty much the whole server.  It does all the respose handling and all of the
+       data manipulation."""
+
+    def GetNextPort(self):
+        """ Returns the next free broadcast port, or None if they are all in use."""
+        return Ports.Allocate()
+
 
     def handle(self):
         """This is the main function of the server.  It is called by the UDPServer whenever we recieve a request."""
+        start = time.time()
+        try:
+            self.HandleRequest(self.request[0])
+        finally:
+            HandlerLatency.Record((time.time() - start) * 1e6)
+
+
+    def HandleRequest(self, data):
+        """Checks a request and runs the handler for its command."""
 
-        data = self.request[0].strip()
-        #print "\nRecieved packet: " + Utility.PrintStringAsHex(data)
+        if Log.IsEnabled(Log.DEBUG):
+            Log.Debug("Recieved packet: %s", Utility.PrintStringAsHex(data))
+
+        # Clients over their rate limit are turned away before we spend anything on decoding.
+        admission = Admission
+        if admission is not None:
+            verdict = admission.Admit(data, self.client_address)
+            if verdict != admission.ADMIT:
+                self.HandleThrottled(data, verdict == admission.NOTIFY)
+                return
 
         # RQ 10
-        # all command packets should be in this range, if not i throw it out.
-        if len(data) < 13  or len(data) > 44:
+        # all command packets should be in this range, if not i throw it out.  Only a batch or a discover may be longer.
+        if len(data) < 13 or len(data) > self.MaxLengths.get(ord(data[0]), 44):
             return
 
-        command = Command()
+        # Commands the handlers send to clients that have to go out after our response.
+        self.Deferred = []
+
+        command, return_packet = self.DecodeCommand(data)
+        if command is not None:
+            return_packet = self.HandleCommand(command)
+
+        # There is a change that at this point no packet was constructed by the server so we
+        # make sure to check that one exists before trying to send it.
+        if return_packet:
+            self.request[1].sendto(return_packet, self.client_address)
+
+        for transaction in self.Deferred:
+            transaction.Send()
+
 
+    def DecodeCommand(self, data):
+        """Decodes a packet.  Returns the command and None, or None and the failure to send back if the packet
+           is no good."""
         try:
-            command.CreateFromPacket(data)
+            command = Command.Codec.Decode(data)
         except:
-            print "The client sent us a bad packet, returning generic failure message..."
-            packet = command.CreateFromParams(Command.FAILURE, GetNextTransactionID(), 0, Command.INVALID_COMMAND).GetPacket()
-            self.request[1].sendto(packet, self.client_address)
-            return
+            Log.Warning("The client sent us a bad packet, returning generic failure message...")
+            BadPackets.Increment()
+            return None, Command.Codec.Encode(Command.FAILURE, GetNextTransactionID(), 0, Command.INVALID_COMMAND)
 
         # RQ 9
         # RQ 13
-        if not command.IsCRCOkay:
-            print "We received a command, but the CRC is incorrect"
-            packet = command.CreateFromParams(Command.FAILURE, command.TransactionID, command.SensorType, Command.CRC_CHECK_FAILURE).GetPacket()
-            self.request[1].sendto(packet, self.client_address)
-            return
-
+        if not command.CRCOkay:
+            Log.Warning("We received a command, but the CRC is incorrect")
+            CRCFailures.Increment()
+            return None, Command.Codec.Encode(Command.FAILURE, command.TransactionID, command.SensorType, Command.CRC_CHECK_FAILURE)
+
+        return command, None
+
+
+    def HandleCommand(self, command):
+        """Runs the handler for a command that decoded fine.  Returns the packet to send back, if any."""
+        counter = PacketCounters.get(command.Code)
+        if counter is None:
+            counter = PacketCounters.setdefault(command.Code, Stats.GetCounter('packets_received{command="%s"}'
+                                                                               % GetCommandName(command.Code)))
+        counter.Increment()
+
+        # In a cluster only the node that owns a publisher key handles it, everyone else sends the client there.
+        # Patterns span every node, they are turned down by their handlers instead.
+        if command.Code in self.KeyedCommands and command.Payload:
+            owner = GetOwnerNode(command.Payload)
+            if owner is not None and not TopicTrie.IsPattern(command.Payload):
+                Redirects.Increment()
+                return Command.Codec.Encode(Command.REDIRECT, command.TransactionID, 0, Command.PackNodeAddress(owner))
+
+        # A client that did not hear back sends the same command with the same transaction id again, it gets
+        # the response we already sent.  A copy that arrives while the first one is still being handled is
+        # dropped, the client will hear back from the first.
+        responses = Responses
+        if responses is not None and command.Code in self.CachedCommands:
+            return_packet = responses.Begin(self.client_address, command)
+            if return_packet is not None:
+                DuplicateCommands.Increment()
+                Log.Debug("Command %d from %s is a duplicate.", command.TransactionID, self.client_address)
+                return return_packet if return_packet is not responses.IN_PROGRESS else None
+
+            try:
+                return_packet = self.RunHandler(command)
+            finally:
+                responses.Finish(self.client_address, command, return_packet)
+            return return_packet
+
+        return self.RunHandler(command)
+
+
+    def RunHandler(self, command):
+        """Runs the handler for a command and returns the packet to send back, if any."""
         # Otherwise hte packet seems to be okay so handle the command.
-        if command.Code == Command.KEEP_ALIVE :
-            return_packet = self.HandleKeepAlive(command)
-        elif command.Code == Command.ADD_PUBLISHER :
-            return_packet = self.HandleAddPublisher(command)
-        elif command.Code == Command.REMOVE_PUBLISHER :
-            return_packet = self.HandleRemovePublisher(command)
-        elif command.Code == Command.ADD_SUBSCRIBER :
-            return_packet = self.HandleAddSubscriber(command)
-        elif command.Code == Command.REMOVE_SUBSCRIBER :
-            return_packet = self.HandleRemoveSubscriber(command)
-        elif command.Code == Command.SUCCESS :
-            return_packet = self.HandleSuccess(command)
-        elif command.Code == Command.FAILURE :
-            return_packet = self.HandleFailure(command)
-        else:
-            return_packet = self.HandleUnknownCommand(command)
+        handler = self.CommandHandlers.get(command.Code)
+        if handler:
+            return handler(self, command)
+
+        return self.HandleUnknownCommand(command)
+
+    def HandleThrottled(self, data, notify):
+        """Drops a packet from a client that is over its rate limit.  If notify is set the client is told with
+           a THROTTLED failure, which only needs the transaction id so the packet is not decoded."""
+        self.CountThrottled(data, notify)
+
+        if notify:
+            return_packet = self.GetThrottledResponse(data)
+            if return_packet:
+                self.request[1].sendto(return_packet, self.client_address)
+
+
+    def CountThrottled(self, data, notify):
+        """Counts a packet dropped by the rate limits.  Only logs if notify is set, so a client that keeps going
+           does not flood the log."""
+        name = Admission.GetClass(data)
+        counter = ThrottledCounters.get(name)
+        if counter is None:
+            counter = ThrottledCounters.setdefault(name, Stats.GetCounter('throttled{class="%s"}' % name))
+        counter.Increment()
+
+        if notify:
+            Log.Warning("Client %s is over its %s rate limit, dropping its commands", self.client_address, name)
+
+
+    def GetThrottledResponse(self, data):
+        """Returns the THROTTLED failure for a packet, or None if it is too short to have a transaction id."""
+        if len(data) < 3:
+            return None
+
+        txid = unpack_from(">h", data, 1)[0]
+        return Command.Codec.Encode(Command.FAILURE, txid, 0, Command.THROTTLED)
 
-        # There is a change that at this point no packet was constructed by the server so we
-        # make sure to check that one exists before trying to send it.
-        if return_packet:
-            self.request[1].sendto(return_packet.GetPacket(), self.client_address)
 
     def HandleKeepAlive(self, command):
         """This function handles the case where the client sends a keep alive message.  All clients
            must send keep alive messages or they will be booted from the mesh."""
         
-        print "Keep alive was from " + str(self.client_address) + "."
+        Log.Debug("Keep alive was from %s.", self.client_address)
 
-        # There is no easy way to find everything so we do a brute force loop. 
-        for pubkey, pubvalue in Pubs.items():
-            # check to see who this message came from and reset all of the counts.
-            if pubvalue.ClientAddress == self.client_address:
-                pubvalue.TimeoutCount = 0
+        # The session covers every publisher and subscriber this client owns.
+        session = Sessions.get(self.client_address)
+        if session is not None:
+            session.LastSeen = time.time()
 
-            for subkey, subvalue in pubvalue.Subs.items():
-                # the subvalue's key is actually the client address.
-                if subvalue.Key == self.client_address:
-                    subvalue.TimeoutCount = 0
+        # Clients that number their keep alives get them back to time the round trip.
+        if command.TransactionID != 0:
+            return Command.Codec.Encode(Command.KEEP_ALIVE, command.TransactionID, command.SensorType, command.Payload)
 
 
     def HandleAddPublisher(self, command):
         """This function handles the case where the client wishes to add a publisher to the sensor mesh"""
 
-        print "Handling Add Publisher..."
+        Log.Debug("Handling Add Publisher...")
 
         # The client screwed up the packet do nothing, return failure.
         if not command.Payload or command.Payload == "":
-            print "Client tried to add a publisher, but did not provide an identifier."
-            return Command().CreateFromParams(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
+            Log.Warning("Client %s tried to add a publisher, but did not provide an identifier.", self.client_address)
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
+
+        # Wildcards are for subscribers, a publisher key can't have them.
+        if TopicTrie.IsPattern(command.Payload):
+            Log.Warning("Client %s tried to add publisher %s, which has a wildcard in it.", self.client_address, command.Payload)
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
 
         # RQ 15b
         # If the publisher already exists in the network.
-        if Pubs.has_key(command.Payload):
-            print "Client " + str(self.client_address) + " tried to add publisher that already exists."
-            return Command().CreateFromParams(Command.FAILURE, command.TransactionID, 0, Command.PUB_ALREADY_EXISTS)
+        if Pubs.Contains(command.Payload):
+            Log.Warning("Client %s tried to add publisher that already exists.", self.client_address)
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.PUB_ALREADY_EXISTS)
+
+        port = self.GetNextPort()
+        if port is None:
+            Log.Warning("Client %s tried to add a publisher, but there are no ports left.", self.client_address)
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.NO_PORTS_AVAILABLE)
 
-        # Actually add the publisher to the dictionary.
-        Pubs[command.Payload] = Publisher(command.Payload, self.request, self.client_address, self.GetNextPort(), command.SensorType)
-        print "Added publisher: ID=" + command.Payload + " from " + str(self.client_address)
+        # Actually add the publisher to the registry.
+        encoding = NegotiateDataEncoding(command.SensorType, command.Reserved)
+        publisher = Publisher(command.Payload, self.request, self.client_address, port, command.SensorType, encoding)
+
+        with Pubs.GetLock(command.Payload):
+            # Another client may have added the same publisher since we checked.
+            if not Pubs.Add(publisher):
+                Ports.Release(port)
+                Log.Warning("Client %s tried to add publisher that already exists.", self.client_address)
+                return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.PUB_ALREADY_EXISTS)
+
+            if Journal is not None:
+                Journal.AddPublisher(publisher)
+
+            with SessionsLock:
+                GetSession(self.client_address).Publishers[command.Payload] = publisher
+
+            with TopicsLock:
+                PublisherTopics.Add(command.Payload, command.Payload, publisher)
+                subscribers = Patterns.Match(command.Payload)
+
+        Log.Info("Added publisher: ID=%s from %s", command.Payload, self.client_address)
+
+        # The wildcard subscriptions it matches are added to it, which starts it.  The start goes out after
+        # our success so the publisher knows what it is starting.
+        for subscriber in subscribers:
+            if AttachWildcard(publisher, subscriber, self.Deferred):
+                Log.Info("Client %s subscribed to publisher=%s through %s.", subscriber.Key, command.Payload, subscriber.Pattern)
 
         # RQ 15c
-        # Return success.
-        return Command().CreateFromParams(Command.SUCCESS, command.TransactionID, 0, Pubs[command.Payload].BroadcastPort)
+        # Return success, the reserved byte tells the publisher which data encoding to use.
+        return Command.Codec.Encode(Command.SUCCESS, command.TransactionID, 0, publisher.BroadcastPort, encoding)
 
 
     def HandleRemovePublisher(self, command):
         """This function handles the case where a client wants to remove a publisher from the mesh."""
 
-        print "Handling RemovePubslisher..."
+        Log.Debug("Handling RemovePubslisher...")
+
+        publisher = Pubs.Get(command.Payload)
 
         # RQ 16d
         # The client screwed up the packet do nothing, return failure.
-        if (not command.Payload or command.Payload == "") or (not Pubs.has_key(command.Payload)):
-            print "Client " + str(self.client_address) + " tried to remove a publisher, but the identifier did not exist."
-            return Command().CreateFromParams(Command.FAILURE, command.TransactionID, 0, Command.PUB_DOES_NOT_EXIST)
+        if (not command.Payload or command.Payload == "") or publisher is None:
+            Log.Warning("Client %s tried to remove a publisher, but the identifier did not exist.", self.client_address)
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.PUB_DOES_NOT_EXIST)
 
         # RQ 16e
         # At this point we know we have the publisher so we need to check if the person trying to remove it actually owns it.
-        if Pubs[command.Payload].ClientAddress != self.client_address:
-            print "Client " + str(self.client_address) + " tried to remove a publisher owned by " + str(Pubs[command.Payload].ClientAddress) + "."
+        if publisher.ClientAddress != self.client_address:
+            Log.Warning("Client %s tried to remove a publisher owned by %s.", self.client_address, publisher.ClientAddress)
 
             # We don't think this client owns this publisher so we return permission error.
-            return Command().CreateFromParams(Command.FAILURE, command.TransactionID, 0, Command.PERMISSION_ERROR)
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.PERMISSION_ERROR)
 
         # RQ 16b
         # RQ 21a
         # RQ 21b
-        #finally we know that we can remove the publisher, but first we need to send a pub removed command to all of his subscribers
-        for subscriber in Pubs[command.Payload].Subs:
-            # this is a screwy lookup, the subscriber ends up actually being the key into our directory.
-            # we have to pass the name of the publisher "command.Payload" since the subscriber doesn't store a reference to
-            # the name of his publisher.
-            Pubs[command.Payload].Subs[subscriber].SendCommand(Command.PUBLISHER_REMOVED, command.Payload)
-            
-        #actually delete the publisher
-        del Pubs[command.Payload]
+        # finally we know that we can remove the publisher, this sends a pub removed command to all of his subscribers.
+        if not RemovePublisher(publisher):
+            # Somebody else removed it while we were looking at it.
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.PUB_DOES_NOT_EXIST)
 
         #Return success.
-        print "Removed publisher " + command.Payload + "."
+        Log.Info("Removed publisher %s.", command.Payload)
 
-        return Command().CreateFromParams(Command.SUCCESS, command.TransactionID, 0, self.client_address[1])
+        return Command.Codec.Encode(Command.SUCCESS, command.TransactionID, 0, self.client_address[1])
 
 
     def HandleAddSubscriber(self, command):
         """This function handles the case where the client wants to add a subscriber to the network"""
-        print "Handling Add Subscriber..."
+        Log.Debug("Handling Add Subscriber...")
+
+        if TopicTrie.IsPattern(command.Payload):
+            return self.HandleAddWildcard(command)
 
         # modifying global shared data so we need to protect this part.
-        # check if the requested publisher exists
-        if Pubs.has_key(command.Payload):
+        with Pubs.GetLock(command.Payload):
+            # check if the requested publisher exists
+            publisher = Pubs.Get(command.Payload)
+
+            if publisher is not None:
+                # if this is the first subscriber for this publisher then send the start publishing command to the publisher
+                if 0 == len(publisher.Subs):
+                    # RQ 19a
+                    # RQ 19b
+                    publisher.SendCommand(Command.START_PUBLISHING)
+
+                # add the subscriber to the publishers dictionary
+                subscriber = Subscriber(self.request, self.client_address)
+                publisher.Subs[self.client_address] = subscriber
 
-            publisher = Pubs[command.Payload]
+                if Journal is not None:
+                    Journal.AddSubscriber(command.Payload, self.client_address)
 
-            # if this is the first subscriber for this publisher then send the start publishing command to the publisher
-            if 0 == len(publisher.Subs):
-                # RQ 19a
-                # RQ 19b
-                publisher.SendCommand(Command.START_PUBLISHING)
+                with SessionsLock:
+                    GetSession(self.client_address).Subscriptions[command.Payload] = subscriber
 
-            # add the subscriber to the publishers dictionary
-            publisher.Subs[self.client_address] = Subscriber(self.request, self.client_address)
+        if publisher is not None:
 
-            print "Client " + self.GetClientString() + " added subscriber to publisher=" + command.Payload + "."
+            Log.Info("Client %s added subscriber to publisher=%s.", self.client_address, command.Payload)
 
             # RQ 17c
             # RQ 17d
             # RQ 17f
-            # build the success packet with the port number for the subscriber
-            return Command().CreateFromParams(Command.SUCCESS, command.TransactionID, 0, publisher.BroadcastPort)
+            # build the success packet with the port number and data encoding for the subscriber
+            return Command.Codec.Encode(Command.SUCCESS, command.TransactionID, 0, publisher.BroadcastPort, publisher.DataEncoding)
 
         else:
-            print "Client " + self.GetClientString() + " tried to add a subscriber to " \
-                  + command.Payload + " which does not exist"
+            Log.Warning("Client %s tried to add a subscriber to %s which does not exist", self.client_address, command.Payload)
 
             # RQ 17e
             # return the failure packet
-            return Command().CreateFromParams(Command.FAILURE, command.TransactionID, 0, Command.PUB_DOES_NOT_EXIST)
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.PUB_DOES_NOT_EXIST)
 
     def HandleRemoveSubscriber(self, command):
         """This function handles the case where we recieve a remove subscriber from the client."""
 
         rv = None
 
-        print "Handling Remove Subscriber..."
+        Log.Debug("Handling Remove Subscriber...")
 
-        # check if the requested publisher exists
-        if not Pubs.has_key(command.Payload):
-            # If it doesn't we send out a you are a naughty subscriber.
-            return Command().CreateFromParams(Command.FAILURE, command.TransactionID, 0, Command.PUB_DOES_NOT_EXIST)
+        if TopicTrie.IsPattern(command.Payload):
+            return self.HandleRemoveWildcard(command)
 
         # Get the publisher.
-        publisher = Pubs[command.Payload]
+        publisher = Pubs.Get(command.Payload)
 
-        # RQ 18c
-        # If this client actually owns a subscriber in this publisher...
-        if publisher.Subs.has_key(self.client_address):
-
-            print "Client " + self.GetClientString() + " removed subscriber from publisher=" + command.Payload + "."
+        # check if the requested publisher exists
+        if publisher is None:
+            # If it doesn't we send out a you are a naughty subscriber.
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.PUB_DOES_NOT_EXIST)
 
-            # remove the subscriber from the publishers dictionary
-            del publisher.Subs[self.client_address]
+        # RQ 18c
+        # RQ 20a
+        # RQ 20b
+        # If this client actually owns a subscriber in this publisher remove it from the publishers dictionary,
+        # this stops the publisher if it was the last one.
+        if RemoveSubscriber(publisher, self.client_address):
 
-            if len(publisher.Subs) <= 0:
-                # RQ 20a
-                # RQ 20b
-                publisher.SendCommand(Command.STOP_PUBLISHING)
+            Log.Info("Client %s removed subscriber from publisher=%s.", self.client_address, command.Payload)
 
             # return the success packet
-            return Command().CreateFromParams(Command.SUCCESS, command.TransactionID, 0, publisher.BroadcastPort)
+            return Command.Codec.Encode(Command.SUCCESS, command.TransactionID, 0, publisher.BroadcastPort)
 
         else:
 
-            print "Client " + self.GetClientString() + " either tried to remove a subscriber from " + command.Payload + " which did not exist" + \
-                  " or he was not subscribed to it."
+            Log.Warning("Client %s either tried to remove a subscriber from %s which did not exist"
+                        " or he was not subscribed to it.", self.client_address, command.Payload)
 
             # RQ 18d
             # build the failure packet
-            return Command().CreateFromParams(Command.FAILURE, command.TransactionID, 0, Command.PUB_DOES_NOT_EXIST)
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.PUB_DOES_NOT_EXIST)
+
+
+
+    def HandleAddWildcard(self, command):
+        """Subscribes a client to every publisher whose key matches a pattern, now or when it is added later.
+           The success carries the number of publishers the pattern matches right now, then the client gets a
+           PUBLISHER_ADDED with the broadcast port of each publisher it was added to.  With several workers the
+           count only covers the publishers of the worker that answers, the PUBLISHER_ADDED commands cover them all."""
 
+        # In a cluster the publishers a pattern matches are spread over every node.
+        if (Ring is not None and len(Ring.Nodes) > 1) or not TopicTrie.IsValidPattern(command.Payload):
+            Log.Warning("Client %s tried to subscribe to %s, which we can't serve.", self.client_address, command.Payload)
+            if not AnswersPattern(command.Payload):
+                return None
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
+
+        with TopicsLock:
+            # A client subscribing to the same pattern again keeps the subscription it has.
+            subscriber = Patterns.Get(command.Payload).get(self.client_address)
+            if subscriber is None:
+                subscriber = Subscriber(self.request, self.client_address, 0, command.Payload)
+                Patterns.Add(command.Payload, self.client_address, subscriber)
+
+                if Journal is not None:
+                    Journal.AddSubscriber(command.Payload, self.client_address)
+
+                with SessionsLock:
+                    GetSession(self.client_address).Patterns[command.Payload] = subscriber
+
+            publishers = PublisherTopics.Find(command.Payload)
+
+        # The PUBLISHER_ADDED commands go out after our success.
+        for publisher in publishers:
+            AttachWildcard(publisher, subscriber, self.Deferred)
+
+        Log.Info("Client %s subscribed to %s, which matches %d publishers.", self.client_address, command.Payload, len(publishers))
+
+        if not AnswersPattern(command.Payload):
+            return None
+        return Command.Codec.Encode(Command.SUCCESS, command.TransactionID, 0, len(publishers))
+
+
+    def HandleRemoveWildcard(self, command):
+        """Removes a wildcard subscription and the client from every publisher it was added to through it."""
+        with TopicsLock:
+            subscriber = Patterns.Get(command.Payload).get(self.client_address)
+
+        if subscriber is None or not RemoveWildcard(subscriber):
+            Log.Warning("Client %s tried to unsubscribe from %s, but was not subscribed to it.", self.client_address, command.Payload)
+            if not AnswersPattern(command.Payload):
+                return None
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.PUB_DOES_NOT_EXIST)
+
+        Log.Info("Client %s unsubscribed from %s.", self.client_address, command.Payload)
+
+        if not AnswersPattern(command.Payload):
+            return None
+        return Command.Codec.Encode(Command.SUCCESS, command.TransactionID, 0, 0)
 
 
     def HandleSuccess(self, command):
         """This function handles the case where the client responds to one of our messages with success.  The
             only thing we really need to do here is to remove the packet from the transaction queue."""
 
-        print "Handling Success..."
+        Log.Debug("Handling Success...")
 
         rv = None
 
-        #first we check our transaction list to see if they are responding to a logged transaction.
-        if Transactions.has_key(command.TransactionID):
-            #if it did, we remove the transaction from the list.
-            del Transactions[command.TransactionID]
-        else:
+        #first we check our transaction list to see if they are responding to a logged transaction,
+        # if it did, we remove the transaction from the list.
+        with TransactionsLock:
+            transaction = Transactions.pop(command.TransactionID, None)
+
+        if transaction is None:
             # otherwise, we send back a wtf are you talking about.
-            rv = Command().CreateFromParams(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
+            rv = Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
 
         return rv
 
@@ -394,26 +1057,237 @@ class SMPCentralNodeRequestHandler (BaseRequestHandler):
            corrupted."""
 
         #in the case that we got a failure, we retry the command, but we do not clear its resend count.
-        print "Handling Failure..."
+        Log.Debug("Handling Failure...")
+
+        transaction = Transactions.get(command.TransactionID)
+        if transaction is not None:
+            # Retry the send, the retransmit deadline stays the same.
+            transaction.Send()
+
+
+    def HandleNodeJoined(self, command):
+        """This function handles another central node joining our cluster, or one we joined announcing itself
+           back to us.  Either way it goes on our ring and takes over the keys that land on it."""
+        Log.Debug("Handling Node Joined...")
+
+        if Ring is None:
+            Log.Warning("Central node %s tried to join, but we are not in a cluster.", self.client_address)
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
+
+        try:
+            address, key = Command.UnpackNodeAddress(command.Payload)
+        except Exception:
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
+
+        # Anyone who can join can take our publishers away, so only a node we were configured with may join and
+        # only from its own address.
+        node = FormatNode(address)
+        if node not in Peers or FormatNode(self.client_address) != node:
+            Log.Warning("%s tried to join central node %s to the cluster, but only our peers may join and only "
+                        "from their own address.", self.client_address, node)
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.PERMISSION_ERROR)
 
-        if Transactions.has_key(command.TransactionID):
-            # stored the command in the zeroeth element of the tuple.
-            command = Transactions[command.TransactionID][0]
-            # stored the socket in the first element.
-            socket = Transactions[command.TransactionID][1]
-            # stored the address in the second element.
-            address = Transactions[command.TransactionID][2]
+        if JoinNode(node):
+            Log.Info("Central node %s joined the cluster.", node)
 
-            # Retry the send.
-            socket.sendto(command.GetPacket(), address)
+        # Every worker puts the node on its own ring, only the first one answers.
+        if WorkerIndex != 0:
+            return None
+
+        # A node that just started only has itself on its ring, so we tell it about us.  It does not answer
+        # our own announcement with another one.
+        if not command.Reserved & Command.NODE_JOINED_REPLY:
+            AnnounceJoin(self.request[1], [node], Command.NODE_JOINED_REPLY)
+
+        # The new node is waiting on this like any other transaction.
+        return Command.Codec.Encode(Command.SUCCESS, command.TransactionID, 0, 0)
+
+
+    def HandleStats(self, command):
+        """Sends back the stats, as many lines as fit in one response starting at the line the client asked for."""
+        Log.Debug("Handling Stats...")
+
+        try:
+            first = int(command.Payload)
+        except ValueError:
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
+
+        lines = Stats.GetLines()
+        text = ""
+        n = max(first, 0)
+        while n < len(lines) and len(text) + len(lines[n]) + 1 <= self.MAX_STATS_PAYLOAD:
+            text = text + lines[n] + "\n"
+            n = n + 1
+
+        # A line too long for a response on its own is cut short rather than stopping the client there.
+        if not text and n < len(lines):
+            text = lines[n][:self.MAX_STATS_PAYLOAD - 1] + "\n"
+            n = n + 1
+
+        more = 1 if n < len(lines) else 0
+        return Command.Codec.Encode(Command.STATS, command.TransactionID, 0, text, more)
+
+
+    def HandleDiscover(self, command):
+        """Sends back a page of the publishers whose key starts with the prefix the client asked for, only the ones
+           of one sensor type if it asked for that.  The page comes from the registry's sorted indexes so it costs
+           the publishers on it, not all of them.  The cursor at the front of the page is the last key on it, or
+           the next worker once this one has none left."""
+        Log.Debug("Handling Discover...")
+
+        try:
+            prefix, cursor = Command.UnpackDiscover(command.Payload)
+            worker, after = Command.UnpackDiscoverCursor(cursor)
+        except ValueError:
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
+
+        # The shard router sends every DISCOVER to the worker its cursor names.
+        if worker != WorkerIndex:
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
+
+        sensor_type = None
+        if command.Reserved & Command.DISCOVER_BY_SENSOR_TYPE:
+            sensor_type = command.SensorType
+
+        # No page holds more publishers than there are shortest entries in it.
+        limit = self.MAX_DISCOVER_PAYLOAD // (Command.DISCOVER_ENTRY_STRUCT.size + 1)
+        keys, more = Pubs.Discover(prefix, sensor_type, after, limit)
+
+        # Leave room for the cursor, a worker and a key with a length in front, the key being the last one that fits.
+        room = self.MAX_DISCOVER_PAYLOAD - 2 * Command.DISCOVER_LENGTH_STRUCT.size
+        entries = []
+        length = 0
+        last = after
+        for key in keys:
+            # A publisher removed since the index was read is skipped, but its key can still become the cursor.
+            publisher = Pubs.Get(key)
+            entry = ""
+            if publisher is not None:
+                entry = Command.PackDiscoverEntry(key, publisher.SensorType, publisher.BroadcastPort, len(publisher.Subs))
+
+            if length + len(entry) + len(key) > room:
+                more = True
+                break
+
+            if entry:
+                entries.append(entry)
+                length = length + len(entry)
+            last = key
+
+        if more:
+            cursor = Command.PackDiscoverCursor(worker, last)
+        elif worker + 1 < WorkerCount:
+            cursor = Command.PackDiscoverCursor(worker + 1)
+            more = True
+        else:
+            cursor = ""
+
+        payload = Command.PackDiscover(cursor) + "".join(entries)
+        return Command.Codec.Encode(Command.DISCOVER, command.TransactionID, 0, payload, 1 if more else 0)
+
+
+    def HandleBatch(self, command):
+        """Handles every command in a batch and sends back all of their responses in one BATCH.  Each command
+           goes through the same checks as one sent on its own, so in a cluster the ones for keys another node
+           owns get a REDIRECT."""
+        Log.Debug("Handling Batch...")
+
+        try:
+            packets = Command.UnpackBatch(command.Payload)
+        except ValueError:
+            Log.Warning("Client %s sent a batch that was cut short.", self.client_address)
+            return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
+
+        admission = Admission
+        responses = []
+        for data in packets:
+            # Every command pays for itself, a client can't get around its limits by batching.  It is waiting
+            # on the batch anyway so it always hears about the ones that were throttled.
+            if admission is not None:
+                verdict = admission.Admit(data, self.client_address)
+                if verdict != admission.ADMIT:
+                    self.CountThrottled(data, verdict == admission.NOTIFY)
+                    return_packet = self.GetThrottledResponse(data)
+                    if return_packet:
+                        responses.append(return_packet)
+                    continue
+
+            if len(data) < 13 or len(data) > 44:
+                BadPackets.Increment()
+                responses.append(Command.Codec.Encode(Command.FAILURE, GetNextTransactionID(), 0, Command.INVALID_COMMAND))
+                continue
+
+            batched, return_packet = self.DecodeCommand(data)
+            if batched is not None:
+                if batched.Code in self.UnbatchedCommands:
+                    return_packet = Command.Codec.Encode(Command.FAILURE, batched.TransactionID, 0, Command.INVALID_COMMAND)
+                else:
+                    return_packet = self.HandleCommand(batched)
+
+            if return_packet:
+                responses.append(return_packet)
+
+        Log.Debug("Handled a batch of %d commands from %s.", len(packets), self.client_address)
+
+        return Command.Codec.Encode(Command.BATCH, command.TransactionID, 0, Command.PackBatch(responses))
 
 
     def HandleUnknownCommand(self, command):
         """This handler runs if a client sends us a bad packet."""
-        print "Handling Unknown Command..."
-        return Command().CreateFromParams(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
+        Log.Debug("Handling Unknown Command...")
+        return Command.Codec.Encode(Command.FAILURE, command.TransactionID, 0, Command.INVALID_COMMAND)
 
 
     def GetClientString(self):
         """Returns the client address as a string."""
         return str(self.client_address)
+
+
+    # Transactions to send after the response, see HandleRequest().  None sends them right away.
+    Deferred = None
+
+    # Commands whose payload is a publisher key, in a cluster they go to the node that owns the key.
+    KeyedCommands = (Command.ADD_PUBLISHER, Command.REMOVE_PUBLISHER, Command.ADD_SUBSCRIBER, Command.REMOVE_SUBSCRIBER)
+
+    # Commands that change the registry, copies of them are answered from the response cache.
+    CachedCommands = KeyedCommands
+
+    # Commands that can't go in a batch, their responses would not fit.
+    UnbatchedCommands = (Command.STATS, Command.BATCH, Command.DISCOVER)
+
+    # The commands that may be longer than the 44 bytes of every other command, and how long they may be.
+    MaxLengths = {Command.BATCH: Command.MAX_BATCH_LENGTH, Command.DISCOVER: Command.MAX_DISCOVER_LENGTH}
+
+    # Most stats text in one STATS response, clients read responses into a 1024 byte buffer.
+    MAX_STATS_PAYLOAD = 1000
+
+    # Most cursor and publishers in one DISCOVER response, for the same reason.
+    MAX_DISCOVER_PAYLOAD = 1000
+
+    # Maps each command code to the function that handles it.
+    CommandHandlers = {
+        Command.KEEP_ALIVE: HandleKeepAlive,
+        Command.ADD_PUBLISHER: HandleAddPublisher,
+        Command.REMOVE_PUBLISHER: HandleRemovePublisher,
+        Command.ADD_SUBSCRIBER: HandleAddSubscriber,
+        Command.REMOVE_SUBSCRIBER: HandleRemoveSubscriber,
+        Command.SUCCESS: HandleSuccess,
+        Command.FAILURE: HandleFailure,
+        Command.NODE_JOINED: HandleNodeJoined,
+        Command.STATS: HandleStats,
+        Command.BATCH: HandleBatch,
+        Command.DISCOVER: HandleDiscover,
+    }
+
+
+Stats.SetGauge("publishers", lambda: len(Pubs))
+Stats.SetGauge("subscribers", lambda: sum(len(publisher.Subs) for publisher in Pubs.Values()))
+Stats.SetGauge("clients", lambda: len(Sessions))
+Stats.SetGauge("wildcard_subscriptions", lambda: len(Patterns))
+Stats.SetGauge("transactions_outstanding", lambda: len(Transactions))
+Stats.SetGauge("ports_free", lambda: Ports.GetFreeCount())
+Stats.SetGauge("publisher_subscribers", GetSubscriberCounts)
+Stats.SetGauge("log_records_dropped", lambda: Log.Dropped)
+Stats.SetGauge("admission_buckets", lambda: len(Admission) if Admission is not None else 0)
+Stats.SetGauge("response_cache_entries", lambda: len(Responses) if Responses is not None else 0)
+Stats.SetGauge("journal_bytes", lambda: Journal.Size if Journal is not None else 0)
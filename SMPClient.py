@@ -2,21 +2,104 @@
     and establish the command and data connection threads. """
 
 from Command import Command
+from Metrics import MetricsRegistry
+import DataPacket
 import random
 import collections
+import itertools
 import socket
 import threading
 import thread
+import time
 
 
 # positive transaction IDs are initialized from the client to the
-# central node, 16bit number
-MAX_RAND_16BIT_TRANSACTION_ID = (2 ** 8) - 1
+# central node, signed 16bit number
+MAX_RAND_16BIT_TRANSACTION_ID = (2 ** 15) - 1
 
 
 # RQ 12
+# a random transaction id for one off commands, clients number their
+# own commands with getTransactionId
 def GetTransactionId():
-    return random.randint(0, MAX_RAND_16BIT_TRANSACTION_ID)
+    return random.randint(1, MAX_RAND_16BIT_TRANSACTION_ID)
+
+
+# ask the central node at address, an (ip, port) pair, for its stats. the
+# stats come back a page at a time on a socket of our own, so the command
+# loops of running clients don't see the responses. returns the stats as
+# text, one "name value" per line, or None if the central node did not answer
+def GetCentralNodeStats(address):
+    statsSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    statsSocket.settimeout(SMPClient.SMP_CENTRAL_NODE_RESPONSE_TIMEOUT)
+    text = ""
+    try:
+        while True:
+            # the payload is the first line we want
+            request = Command.Codec.Encode(Command.STATS, GetTransactionId(), 0, str(text.count("\n")))
+            response = None
+            for attempt in range(SMPClient.NUM_TIMEOUTS):
+                statsSocket.sendto(request, address)
+                try:
+                    response = Command().CreateFromPacket(
+                        statsSocket.recvfrom(SMPClient.MAX_CENTRAL_NODE_CMD_PACKET_SIZE)[0])
+                    break
+                except socket.timeout:
+                    continue
+
+            if response is None or Command.STATS != response.Code:
+                return None
+
+            text = text + response.Payload
+            # the reserved byte is set while there are more lines
+            if not response.Reserved or not response.Payload:
+                return text
+    finally:
+        statsSocket.close()
+
+
+# ask the central node at address which publishers it has, only the ones
+# whose key starts with prefix and, if sensor_type is given, of that sensor
+# type. the publishers come back a page at a time like the stats. returns a
+# list of (key, sensor type, broadcast port, subscriber count) in key order,
+# or None if the central node did not answer. in a cluster every node only
+# knows its own publishers
+def DiscoverPublishers(address, prefix="", sensor_type=None):
+    discoverSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    discoverSocket.settimeout(SMPClient.SMP_CENTRAL_NODE_RESPONSE_TIMEOUT)
+    reserved = 0 if sensor_type is None else Command.DISCOVER_BY_SENSOR_TYPE
+    cursor = ""
+    publishers = []
+    try:
+        while True:
+            # the cursor of the last page says where the next one starts
+            request = Command.Codec.Encode(Command.DISCOVER, GetTransactionId(), sensor_type or 0,
+                                           Command.PackDiscover(prefix, cursor), reserved)
+            response = None
+            for attempt in range(SMPClient.NUM_TIMEOUTS):
+                discoverSocket.sendto(request, address)
+                try:
+                    response = Command().CreateFromPacket(
+                        discoverSocket.recvfrom(SMPClient.MAX_CENTRAL_NODE_CMD_PACKET_SIZE)[0])
+                    break
+                except socket.timeout:
+                    continue
+
+            if response is None or Command.DISCOVER != response.Code:
+                return None
+
+            cursor, entries = Command.UnpackDiscoverResponse(response.Payload)
+            publishers.extend(entries)
+            # the reserved byte is set while there are more pages
+            if not response.Reserved:
+                return publishers
+    finally:
+        discoverSocket.close()
+
+
+# central node that owns each publisher key in a cluster, learned from
+# redirects and shared by every client in this process
+CentralNodeCache = dict()
 
 
 class SMPClient:
@@ -29,15 +112,29 @@ class SMPClient:
     NUM_TIMEOUTS = 3
     SMP_CENTRAL_NODE_RESPONSE_TIMEOUT = 1  # 1 sec
     MAX_CENTRAL_NODE_CMD_PACKET_SIZE = 1024
+    # a BATCH response can be a little longer than the batch we sent
+    MAX_BATCH_RESPONSE_SIZE = 4096
+    # transaction ids are signed 16 bit, ours are the positive ones
+    MAX_TRANSACTION_ID = 2 ** 15
     DEFAULT_DATA_QUEUE_MAX_SIZE = 4096
+    # redirects followed for one command before giving up
+    MAX_REDIRECTS = 3
+    # resends of a command the central node throttled, and the seconds we wait before the first one
+    MAX_THROTTLE_RETRIES = 3
+    THROTTLE_BACKOFF = 1
+    # tries to register with a new central node after our key moved
+    MAX_MOVE_ATTEMPTS = 20
+    # keep alives are numbered 1 to this, the central node echoes numbered ones
+    MAX_KEEP_ALIVE_ID = (2 ** 15) - 1
 
     """ constructor takes the Central node ip address and data queue size """
     def __init__(self, smp_central_node_address, client_type, publisher_key, sensor_type,
                  command_loop, data_loop, queue_size=DEFAULT_DATA_QUEUE_MAX_SIZE):
 
-        # ip address for the central node
-        self.SMPCentralNodeAddress = \
-            (smp_central_node_address, SMPClient.SMP_CENTRAL_NODE_PORT)
+        # ip address for the central node, in a cluster start with the node
+        # we already know owns the key
+        self.SMPCentralNodeAddress = CentralNodeCache.get(
+            publisher_key, (smp_central_node_address, SMPClient.SMP_CENTRAL_NODE_PORT))
         # SMP client socket for command node communication
         # bind the client socket to an available port
         # RQ 3
@@ -65,6 +162,28 @@ class SMPClient:
         self.PublisherSensorType = sensor_type
         # data port
         self.DataPort = None
+        # data plane encoding, a publisher asks for one and the central node
+        # tells both publishers and subscribers which one is in use
+        self.DataEncoding = DataPacket.ENCODING_PLAIN
+        # number and send time of the last keep alive, to time its echo
+        self.KeepAliveID = 0
+        self.KeepAliveSentAt = None
+        # transaction ids of this client count up from a random start, so they
+        # don't repeat for a long time and are unlikely to match the ones of a
+        # client that used our address before
+        self.TransactionIds = itertools.count(GetTransactionId())
+        # commands the central node sent us while we were waiting on a response,
+        # the command loop handles them next
+        self.PendingCommands = collections.deque()
+        # client stats, see getStats
+        self.Stats = MetricsRegistry("smp_client_")
+        self.PacketsSent = self.Stats.GetCounter("packets_sent")
+        self.PacketsReceived = self.Stats.GetCounter("packets_received")
+        self.DataPacketsSent = self.Stats.GetCounter("data_packets_sent")
+        self.DataPacketsReceived = self.Stats.GetCounter("data_packets_received")
+        self.QueueDrops = self.Stats.GetCounter("queue_drops")
+        self.KeepAliveRTT = self.Stats.GetHistogram("keep_alive_rtt_us")
+        self.Stats.SetGauge("queue_length", lambda: len(self.DataQueue))
 
     # RQ 15a
     """ Send the addClient request using the publisher key and sensor type.
@@ -87,9 +206,10 @@ class SMPClient:
         # RQ 17b
         # send the central node the addPub command, True flag waits for response
         commandResponse = self.sendCentralNodeCommand(addCommandCode,
-                                                      GetTransactionId(),
+                                                      self.getTransactionId(),
                                                       self.PublisherKey,
-                                                      True)
+                                                      True,
+                                                      self.DataEncoding)
 
         """ STATEFUL - Transition to the Idle or Start state """
         if commandResponse is not None and Command.SUCCESS == commandResponse.Code:
@@ -109,6 +229,9 @@ class SMPClient:
             # extract the broadcast port from the command response payload
             self.BroadcastPort = int(command_response.Payload)
 
+            # the reserved byte has the data encoding the publisher will use
+            self.DataEncoding = command_response.Reserved
+
             # set the is registered flag for the caller API
             self.IsSMPClientRegistered = True
 
@@ -138,9 +261,13 @@ class SMPClient:
         else:
             raise Exception("call to processAddPubResponse with response code != SUCCESS")
 
+    """ returns the next transaction id of this client """
+    def getTransactionId(self):
+        return next(self.TransactionIds) % SMPClient.MAX_TRANSACTION_ID
+
     """ helper function to send the central node a command request. returns the response
         if the flag is True and is received before the defined timeout """
-    def sendCentralNodeCommand(self, command_code, transaction_id, payload=None, receiveFlag=False):
+    def sendCentralNodeCommand(self, command_code, transaction_id, payload=None, receiveFlag=False, reserved=0):
 
         # if no payload is provided use the publisher key
         if payload is None:
@@ -150,14 +277,18 @@ class SMPClient:
         commandPDU = Command().CreateFromParams(command_code,
                                                 transaction_id,
                                                 self.PublisherSensorType,
-                                                payload).GetPacket()
+                                                payload,
+                                                reserved).GetPacket()
 
         # loop breaks
         responseTimeouts = 0
+        redirects = 0
+        throttles = 0
         cmdResponse = None
 
         # send the command to the central node
         self.ClientSocket.sendto(commandPDU, self.SMPCentralNodeAddress)
+        self.PacketsSent.Increment()
 
         # get the command response if the flag is set
         while receiveFlag and SMPClient.NUM_TIMEOUTS > responseTimeouts:
@@ -168,12 +299,58 @@ class SMPClient:
 
                 # get the command response packet and exit the loop
                 if response is not None:
+                    self.PacketsReceived.Increment()
                     cmdResponse = Command().CreateFromPacket(response[0])
                     receiveFlag = False
 
+                    # the echo of a keep alive the command loop sent, keep waiting
+                    if cmdResponse is not None and Command.KEEP_ALIVE == cmdResponse.Code:
+                        self.processKeepAliveEcho(cmdResponse)
+                        cmdResponse = None
+                        receiveFlag = True
+                        continue
+
+                    # a command of the central node's own, like a start publishing
+                    # or a publisher added, is not our response. save it for the
+                    # command loop and keep waiting
+                    if cmdResponse is not None and 0 > cmdResponse.TransactionID \
+                            and cmdResponse.Code not in (Command.SUCCESS, Command.FAILURE):
+                        self.PendingCommands.append(cmdResponse)
+                        cmdResponse = None
+                        receiveFlag = True
+                        continue
+
+                    # in a cluster the node may not own our key, send the
+                    # command again to the node it pointed us to
+                    if cmdResponse is not None and Command.REDIRECT == cmdResponse.Code \
+                            and SMPClient.MAX_REDIRECTS > redirects:
+                        self.followRedirect(cmdResponse)
+                        self.ClientSocket.sendto(commandPDU, self.SMPCentralNodeAddress)
+                        self.PacketsSent.Increment()
+                        redirects += 1
+                        responseTimeouts = 0
+                        receiveFlag = True
+
+                    # the central node is rate limiting us, back off and try again
+                    elif cmdResponse is not None and Command.FAILURE == cmdResponse.Code \
+                            and Command.THROTTLED == cmdResponse.Payload \
+                            and SMPClient.MAX_THROTTLE_RETRIES > throttles:
+                        time.sleep(SMPClient.THROTTLE_BACKOFF * (2 ** throttles))
+                        self.ClientSocket.sendto(commandPDU, self.SMPCentralNodeAddress)
+                        self.PacketsSent.Increment()
+                        throttles += 1
+                        responseTimeouts = 0
+                        cmdResponse = None
+                        receiveFlag = True
+
             except socket.timeout:
-                # timeout, increment the count
+                # timeout, increment the count and send the same command again,
+                # the central node answers a copy it already handled with the
+                # response it sent before instead of handling it twice
                 responseTimeouts += 1
+                if SMPClient.NUM_TIMEOUTS > responseTimeouts:
+                    self.ClientSocket.sendto(commandPDU, self.SMPCentralNodeAddress)
+                    self.PacketsSent.Increment()
             except socket.error:
                 return None
 
@@ -182,6 +359,246 @@ class SMPClient:
         # return the command response, this will be None for receiveFlag False and timeouts
         return cmdResponse
 
+    """ send several commands to the central node with one call. commands is
+        a list of (command code, payload) pairs, or (command code, payload,
+        sensor type[, reserved]) to override our own sensor type and a
+        reserved byte of 0. they go out packed into as few BATCH datagrams as they
+        fit in. returns a list with the response
+        to each command in the same order, None for the ones that got no
+        response. in a cluster the commands for keys another central node
+        owns are sent on to it, and throttled commands are sent again after
+        a while """
+    def sendCentralNodeBatch(self, commands):
+        responses = [None] * len(commands)
+
+        # the indexes of the commands to send to each central node
+        pending = collections.defaultdict(list)
+        for index, command in enumerate(commands):
+            pending[CentralNodeCache.get(command[1], self.SMPCentralNodeAddress)].append(index)
+
+        for attempt in range(SMPClient.MAX_REDIRECTS + 1):
+            retries = collections.defaultdict(list)
+            throttled = False
+
+            for address, indexes in pending.items():
+                self.sendBatch(address, commands, indexes, responses)
+
+                for index in indexes:
+                    response = responses[index]
+                    if response is None:
+                        continue
+
+                    if Command.REDIRECT == response.Code:
+                        nodeAddress, key = Command.UnpackNodeAddress(response.Payload)
+                        CentralNodeCache[commands[index][1]] = nodeAddress
+                        retries[nodeAddress].append(index)
+
+                    elif Command.FAILURE == response.Code and Command.THROTTLED == response.Payload:
+                        throttled = True
+                        retries[address].append(index)
+
+            if not retries or attempt == SMPClient.MAX_REDIRECTS:
+                break
+
+            # the central node is rate limiting us, back off before trying again
+            if throttled:
+                time.sleep(SMPClient.THROTTLE_BACKOFF)
+            pending = retries
+
+        return responses
+
+    """ helper for sendCentralNodeBatch, sends the commands at indexes to the
+        central node at address and stores the responses that come back in
+        responses. every command has its own transaction id so its response
+        can be found in whichever BATCH response it comes back in """
+    def sendBatch(self, address, commands, indexes, responses):
+
+        # the index of each command waiting for a response by the
+        # transaction id of its batch and then its own
+        outstanding = dict()
+        batchPDUs = dict()
+
+        # number every command and pack them into batches that fit in a datagram
+        batches = [[]]
+        batchLength = Command.HEADER_LENGTH
+        for index in indexes:
+            command = commands[index]
+            commandCode, payload = command[0], command[1]
+            sensorType = command[2] if len(command) > 2 else self.PublisherSensorType
+            reserved = command[3] if len(command) > 3 else 0
+            transactionId = self.getTransactionId()
+            commandPDU = Command.Codec.Encode(commandCode, transactionId, sensorType, payload, reserved)
+
+            entryLength = Command.BATCH_ENTRY_STRUCT.size + len(commandPDU)
+            if batches[-1] and batchLength + entryLength > Command.MAX_BATCH_LENGTH:
+                batches.append([])
+                batchLength = Command.HEADER_LENGTH
+
+            batches[-1].append((transactionId, index, commandPDU))
+            batchLength += entryLength
+
+        # send every batch before waiting on any of them
+        for batch in batches:
+            if not batch:
+                continue
+
+            transactionId = self.getTransactionId()
+            batchPDU = Command.Codec.Encode(Command.BATCH,
+                                            transactionId,
+                                            self.PublisherSensorType,
+                                            Command.PackBatch([commandPDU for txid, index, commandPDU in batch]))
+            outstanding[transactionId] = dict((txid, index) for txid, index, commandPDU in batch)
+            batchPDUs[transactionId] = batchPDU
+            self.ClientSocket.sendto(batchPDU, address)
+            self.PacketsSent.Increment()
+
+        # collect the responses, in a central node with several workers each
+        # one answers its share of a batch on its own
+        responseTimeouts = 0
+        while outstanding and SMPClient.NUM_TIMEOUTS > responseTimeouts:
+
+            try:
+                packet = self.ClientSocket.recvfrom(SMPClient.MAX_BATCH_RESPONSE_SIZE)[0]
+            except socket.timeout:
+                # send the batches we are still waiting on again, the commands
+                # in them that were handled already are answered from the cache
+                responseTimeouts += 1
+                if SMPClient.NUM_TIMEOUTS > responseTimeouts:
+                    for transactionId in outstanding:
+                        self.ClientSocket.sendto(batchPDUs[transactionId], address)
+                        self.PacketsSent.Increment()
+                continue
+            except socket.error:
+                break
+
+            self.PacketsReceived.Increment()
+            cmdResponse = Command().CreateFromPacket(packet)
+            if cmdResponse is None:
+                continue
+
+            # the echo of a keep alive the command loop sent
+            if Command.KEEP_ALIVE == cmdResponse.Code:
+                self.processKeepAliveEcho(cmdResponse)
+                continue
+
+            waiting = outstanding.get(cmdResponse.TransactionID)
+            if waiting is None:
+                continue
+
+            # the whole batch failed, most likely it was throttled
+            if Command.FAILURE == cmdResponse.Code:
+                for index in waiting.values():
+                    responses[index] = cmdResponse
+                del outstanding[cmdResponse.TransactionID]
+                continue
+
+            if Command.BATCH != cmdResponse.Code:
+                continue
+
+            try:
+                packets = Command.UnpackBatch(cmdResponse.Payload)
+            except ValueError:
+                continue
+
+            for packet in packets:
+                response = Command().CreateFromPacket(packet)
+                if response is not None and response.TransactionID in waiting:
+                    responses[waiting.pop(response.TransactionID)] = response
+
+            if not waiting:
+                del outstanding[cmdResponse.TransactionID]
+
+    """ send a numbered keep alive to the central node. the central node
+        echoes it back so receiveCommand can time the round trip """
+    def sendKeepAlive(self, payload):
+        self.KeepAliveID = self.KeepAliveID % SMPClient.MAX_KEEP_ALIVE_ID + 1
+        keepAlive = Command.Codec.Encode(Command.KEEP_ALIVE,
+                                         self.KeepAliveID,
+                                         self.PublisherSensorType,
+                                         payload)
+        self.KeepAliveSentAt = time.time()
+        self.ClientSocket.sendto(keepAlive, self.SMPCentralNodeAddress)
+        self.PacketsSent.Increment()
+
+    """ record the round trip time of a keep alive echo. echoes of older keep
+        alives and extra echoes from a central node running several workers
+        are ignored """
+    def processKeepAliveEcho(self, command):
+        if command.TransactionID == self.KeepAliveID and self.KeepAliveSentAt is not None:
+            self.KeepAliveRTT.Record((time.time() - self.KeepAliveSentAt) * 1e6)
+            self.KeepAliveSentAt = None
+
+    """ wait for the next command from the central node, keep alive echoes
+        are timed and skipped. commands saved while waiting on a response come
+        first. raises socket.timeout if none arrives """
+    def receiveCommand(self):
+        if self.PendingCommands:
+            return self.PendingCommands.popleft()
+
+        while True:
+            packet = self.ClientSocket.recvfrom(SMPClient.MAX_CENTRAL_NODE_CMD_PACKET_SIZE)[0]
+            self.PacketsReceived.Increment()
+
+            command = Command().CreateFromPacket(packet)
+            if command is None or Command.KEEP_ALIVE != command.Code:
+                return command
+
+            self.processKeepAliveEcho(command)
+
+    """ returns the client stats as text, one "name value" per line """
+    def getStats(self):
+        return self.Stats.Format()
+
+    """ ask the central node for its stats. returns them as text, one
+        "name value" per line, or None if the central node did not answer """
+    def getCentralNodeStats(self):
+        return GetCentralNodeStats(self.SMPCentralNodeAddress)
+
+    """ ask the central node which publishers it has, see DiscoverPublishers """
+    def discover(self, prefix="", sensor_type=None):
+        return DiscoverPublishers(self.SMPCentralNodeAddress, prefix, sensor_type)
+
+    """ switch to the central node a redirect command points to and remember
+        it for the publisher key """
+    def followRedirect(self, command):
+        address, key = Command.UnpackNodeAddress(command.Payload)
+        self.SMPCentralNodeAddress = address
+        CentralNodeCache[key or self.PublisherKey] = address
+
+    """ the cluster handed our publisher key to another central node.
+        acknowledge the old node, then register again with the new one
+        without restarting the client threads. returns the add response,
+        None or a failure if we could not register """
+    def moveCentralNode(self, command):
+
+        # the old node is waiting for a success on the redirect
+        self.sendCentralNodeCommand(Command.SUCCESS, command.TransactionID, 0)
+        self.followRedirect(command)
+
+        if SMPClient.SMP_CLIENT_TYPE_PUBLISHER == self.ClientType:
+            addCommandCode = Command.ADD_PUBLISHER
+        else:
+            addCommandCode = Command.ADD_SUBSCRIBER
+
+        commandResponse = None
+        for attempt in range(SMPClient.MAX_MOVE_ATTEMPTS):
+            commandResponse = self.sendCentralNodeCommand(addCommandCode,
+                                                          self.getTransactionId(),
+                                                          self.PublisherKey,
+                                                          True,
+                                                          self.DataEncoding)
+
+            if commandResponse is not None and Command.SUCCESS == commandResponse.Code:
+                # the new node hands out its own broadcast port
+                self.BroadcastPort = int(commandResponse.Payload)
+                self.DataEncoding = commandResponse.Reserved
+                break
+
+            # subscribers can get here before their publisher did
+            time.sleep(SMPClient.SMP_CENTRAL_NODE_RESPONSE_TIMEOUT)
+
+        return commandResponse
+
     """ to string method to print the SMP client info """
     def __str__(self):
         if SMPClient.SMP_CLIENT_TYPE_PUBLISHER == self.ClientType:
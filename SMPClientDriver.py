@@ -27,10 +27,13 @@
             OutputFile argument is provided, the client process will
             write the received data to the output file. If no OutputFile
             argument is provided, then the subscriber will print the
-            received data to the console. """
+            received data to the console. The StringID can be a pattern
+            like plant3/*/temperature or plant3/#, the subscriber then
+            receives the data of every publisher whose key matches. """
 
 from SMPPublisherClient import SMPPublisherClient
 from SMPSubscriberClient import SMPSubscriberClient
+import SMPClient
 import sys
 import re
 import os
@@ -39,8 +42,8 @@ import threading
 import signal
 import socket
 from Command import Command
+import DataPacket
 import time
-import struct
 
 # dictionary of publishers and subscribers
 Pubs = {}
@@ -215,6 +218,45 @@ def lsSubs():
     return True
 
 
+def stats(id):
+    print " ".join([stats.__name__, id])
+    id = str(id)
+    if id in Pubs:
+        print Pubs[id].getStats()
+    elif id in Subs:
+        print Subs[id].getStats()
+    else:
+        print "id<" + id + "> not in Pubs or Subs"
+    return True
+
+
+def nodeStats():
+    print nodeStats.__name__
+    text = SMPClient.GetCentralNodeStats((SMP_CENTRAL_NODE_ADDR, SMPClient.SMPClient.SMP_CENTRAL_NODE_PORT))
+    if text is None:
+        print NO_RESPONSE
+    else:
+        print text
+    return True
+
+
+# a prefix of * lists every publisher
+def discover(prefix, sensor_type=None):
+    print " ".join([discover.__name__, prefix, str(sensor_type)])
+    if prefix == "*":
+        prefix = ""
+    if sensor_type is not None:
+        sensor_type = int(sensor_type)
+    publishers = SMPClient.DiscoverPublishers((SMP_CENTRAL_NODE_ADDR, SMPClient.SMPClient.SMP_CENTRAL_NODE_PORT),
+                                              prefix, sensor_type)
+    if publishers is None:
+        print NO_RESPONSE
+    else:
+        for key, sensorType, port, subscribers in publishers:
+            print "%s sensorType=%d port=%d subscribers=%d" % (key, sensorType, port, subscribers)
+    return True
+
+
 def addSub(id, sensor_type=0):
     global SMP_CENTRAL_NODE_ADDR
     id = str(id)
@@ -319,9 +361,14 @@ def subscribePipeToFile(subscriber, outputFile, event):
     while event.isSet():
         data = subscriber.getData()
         if data is not None:
-            timeout, data = struct.unpack('>Q%ds' % (len(data) - 8), data)
+            # a pattern subscriber tells us which publisher sent each sample
+            publisher = ""
+            if subscriber.IsWildcard:
+                key, data = data
+                publisher = " PUBLISHER[" + key + "]"
+            timeout, data = DataPacket.UnpackSample(data)
             # write the data to the file
-            f.write("\nPACKET[" + str(packet) + "] TIME[" + str(timeout) + "]\n" \
+            f.write("\nPACKET[" + str(packet) + "] TIME[" + str(timeout) + "]" + publisher + "\n" \
                     "DATA ---------------------------------------------------\n" \
 						  + data + 
                        "\n---------------------------------------------------\n")
@@ -417,6 +464,9 @@ def createCommandListDict():
     addCommand(getSubscriberData, [ID, "OuputFile=None"])
     addCommand(lsPubs, [])
     addCommand(lsSubs, [])
+    addCommand(stats, [ID])
+    addCommand(nodeStats, [])
+    addCommand(discover, ["Prefix", "SensorType=None"])
     addCommand(myQuit, [], "quit")
     addCommand(myHelp, [], "help")
 
@@ -2,19 +2,34 @@
     once the addPub command returns success. The user instantiates an SMPPublisherClient
     object and then calls the addPub function. If the command object returned from
     addPub has a command code of SUCCESS, the user can call the other SMP publisher
-    functions. The SMPPublisherClient uses a circular queue to publish data using
-    non-blocking locks to acquire the queue for producing and consuming data between
-    the parent thread and data publishing thread. This is done so that the most recent
-    data is always in the queue or being broadcasted from the queue. """
+    functions. The SMPPublisherClient hands data to the data publishing thread through
+    a PublishQueue, and the thread sleeps until there is data and the central node
+    told it to start. By default a full queue pushes out the oldest data so that the
+    most recent data is always in the queue or being broadcasted from the queue.
+    Pass queue_policy to drop the newest data instead, to make publishData block for
+    up to queue_timeout seconds, or to make it raise PublishQueue.QueueFull right away.
+
+    Publishers of many tiny samples can opt in to framing by passing a frame_mtu.
+    Samples are then packed into one datagram until it is full or the oldest sample
+    has waited max_linger seconds.
+
+    Periodic numeric sensors can ask for data_encoding=DataPacket.ENCODING_COMPACT.
+    If the central node agrees for the sensor type, integer samples are sent as
+    delta encoded varints in compact frames.
+
+    Publishers of text that barely changes from sample to sample can pass
+    compress=True. Datagrams are compressed with the dictionary registered for the
+    sensor type with DataPacket.RegisterDictionary, when that makes them smaller. """
 
 import SMPClient
+import DataPacket
+import PublishQueue
+import Log
 from Command import Command
 import socket
 import threading
 import time
 import sys
-from struct import *
-import ctypes
 
 
 class SMPPublisherClient(SMPClient.SMPClient):
@@ -23,7 +38,13 @@ class SMPPublisherClient(SMPClient.SMPClient):
                  smp_central_node_address,
                  publisher_key,
                  sensor_type,
-                 queue_size=SMPClient.SMPClient.DEFAULT_DATA_QUEUE_MAX_SIZE):
+                 queue_size=SMPClient.SMPClient.DEFAULT_DATA_QUEUE_MAX_SIZE,
+                 frame_mtu=None,
+                 max_linger=DataPacket.DEFAULT_MAX_LINGER,
+                 data_encoding=DataPacket.ENCODING_PLAIN,
+                 compress=False,
+                 queue_policy=PublishQueue.DROP_OLDEST,
+                 queue_timeout=PublishQueue.DEFAULT_BLOCK_TIMEOUT):
 
         # call the base class constructor passing in the data loop and command loop
         SMPClient.SMPClient.__init__(self,
@@ -42,6 +63,18 @@ class SMPPublisherClient(SMPClient.SMPClient):
         # removePub flag used for the parent thread to gain control
         # of the command socket if needed
         self.RemovePubEvent = threading.Event()
+        # max datagram size when framing samples, None sends one datagram per sample
+        self.FrameMTU = frame_mtu
+        # max seconds a sample waits in a partially filled frame
+        self.MaxLinger = max_linger
+        # data encoding to ask the central node for in addPub
+        self.DataEncoding = data_encoding
+        # compress data datagrams with the sensor type dictionary
+        self.Compress = compress
+        # the data loop compressor, keeps the compression statistics
+        self.Compressor = None
+        # data waiting for the data loop, a full queue is handled by the policy
+        self.DataQueue = PublishQueue.PublishQueue(queue_size, queue_policy, queue_timeout, self.Stats)
 
     """ send the addPub command to the central node to register this publisher.
         returns the central node command response object. """
@@ -64,7 +97,7 @@ class SMPPublisherClient(SMPClient.SMPClient):
 
         # send the central node the removePub command, True flag waits for response
         commandResponse = self.sendCentralNodeCommand(Command.REMOVE_PUBLISHER,
-                                                      SMPClient.GetTransactionId(),
+                                                      self.getTransactionId(),
                                                       self.PublisherKey,
                                                       True)
 
@@ -74,6 +107,7 @@ class SMPPublisherClient(SMPClient.SMPClient):
             # release the thread locks so that the child threads exit the loops
             self.CommandLoopLock.release()
             self.DataLoopLock.release()
+            self.DataQueue.wake()
             self.IsSMPClientRegistered = False
             self.IsPublishing = False
 
@@ -88,78 +122,115 @@ class SMPPublisherClient(SMPClient.SMPClient):
         dataPublisherLoop to broadcast. If the start publishing command
         was not received from the central node, then the data just sits in
         the queue. The caller is advised to check the IsPublishing attribute
-        to save processing on publishData. data argument must be an iterable """
+        to save processing on publishData. data argument must be an iterable.
+        returns the number of samples queued, raises PublishQueue.QueueFull
+        if the queue policy is BLOCK or FAIL_FAST and the queue is full """
     def publishData(self, data):
-        for x in data:
-            self.DataQueue.append(x)
+        return self.DataQueue.extend(data)
 
     """ loop forever until the removePub command flag is set.
-        in each loop iteration check the startPublishing flag
-        and the removePub flag set by the commandLoop thread
+        in each loop iteration sleep on the data queue until there is
+        data and the startPublishing flag set by the commandLoop thread
+        is set, then send what was taken from the queue
     """
     def dataPublisherLoop(self):
 
-        destAddr = (SMPClient.SMPClient.SMP_MULTICAST_GROUP, self.BroadcastPort)
-
         # RQ 3
         # create a broadcast socket
         dataSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         dataSocket.bind(('', 0))
         dataSocket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
 
+        # samples waiting to be sent together when framing is on,
+        # compact samples are always framed
+        frame = None
+        if DataPacket.ENCODING_COMPACT == self.DataEncoding:
+            frame = DataPacket.CompactFrame(self.FrameMTU or DataPacket.DEFAULT_FRAME_MTU)
+        elif self.FrameMTU is not None:
+            frame = DataPacket.DataFrame(self.FrameMTU)
+
+        if self.Compress:
+            self.Compressor = DataPacket.DataCompressor(
+                DataPacket.Dictionaries.get(self.PublisherSensorType, b""))
+
         # non-blocking semaphore returns true if acquired
         # parent thread will release the lock if the caller uses the removePub API
         """ STATEFUL - Publisher Registered State """
         while not self.DataLoopLock.acquire(False):
 
-            # check if the startPublishing flag is set
+            # sleep until there is data and the startPublishing flag is set, or
+            # until a partly filled frame has lingered long enough to be sent
             """ STATEFUL - Determine if the publisher is in the Active or Registered state """
-            if self.StartPublishingEvent.isSet():
-
-                # send any data in the queue over the broadcast network address
-                # do not continuously send data that is queued up by the parent thread
-                # must periodically check the removePub
-                packets = self.DataQueue.maxlen
-                while packets > 0:
-                    try:
-                        # RQ 6
-                        # create an SMP data packet with data from the deque
-                        stamp = round(time.time() * 1000) # ms
-                        data = self.DataQueue.popleft()
-                        mystamp = ctypes.c_ulonglong(int(stamp)).value
-                        packet = pack('>Q%ds' % len(data), mystamp, data)
-                        dataSocket.sendto(packet, destAddr)
-
-                        # count down because another thread may be enqueuing packets
-                        # and we don't want to stay in this inner loop forever
-                        packets -= 1
-                    except IndexError:
-                        # normal to have an error if popping an empty deque
-                        None
-                    except socket.error:
-                        # deque is empty or socket took a None data arg
-                        print "error sending data in the publisher loop"
-                    except Exception:
-                        print "exception " + sys.exc_info()
-                        self.exc_info = "pub data loop " +  str(self) + " " + str(sys.exc_info())
+            timeout = None
+            if frame is not None and frame.count() > 0 and self.StartPublishingEvent.isSet():
+                timeout = frame.lingerLeft(self.MaxLinger)
+
+            # take no more than a queue full at a time so the removePub flag is checked
+            samples = self.DataQueue.take(self.DataQueue.maxlen, timeout)
+
+            # the port changes if a cluster moves us to another central node
+            destAddr = (SMPClient.SMPClient.SMP_MULTICAST_GROUP, self.BroadcastPort)
+
+            # don't hold samples in a partial frame longer than the linger time
+            if frame is not None and self.StartPublishingEvent.isSet() and frame.isExpired(self.MaxLinger):
+                try:
+                    self.sendFrame(dataSocket, destAddr, frame)
+                except socket.error:
+                    Log.Warning("error sending data in the publisher loop")
+
+            # send the data taken from the queue over the broadcast network address
+            for data in samples:
+                try:
+                    # RQ 6
+                    # create an SMP data packet with data from the queue
+                    mystamp = DataPacket.GetTimestamp()
+
+                    if frame is None:
+                        self.sendDatagram(dataSocket, destAddr, DataPacket.PackSample(mystamp, data))
+                    elif not frame.add(mystamp, data):
+                        # the frame is full, send it and start the next one with this sample
+                        if frame.count() > 0:
+                            self.sendFrame(dataSocket, destAddr, frame)
+                        # samples too big for any frame are sent on their own
+                        if not frame.add(mystamp, data):
+                            self.sendDatagram(dataSocket, destAddr, DataPacket.PackSample(mystamp, data))
+
+                except socket.error:
+                    # socket took a None data arg
+                    Log.Warning("error sending data in the publisher loop")
+                except Exception:
+                    Log.Exception("exception in the publisher data loop")
+                    self.exc_info = "pub data loop " +  str(self) + " " + str(sys.exc_info())
 
         # end outer while
 
         # close the data socket
         dataSocket.close()
 
+    """ send a data packet to the broadcast address, compressing it if enabled """
+    def sendDatagram(self, dataSocket, destAddr, packet, samples=1):
+        if self.Compressor is not None:
+            packet = self.Compressor.compressDatagram(packet, samples)
+        dataSocket.sendto(packet, destAddr)
+        self.DataPacketsSent.Increment()
+
+    """ send the samples collected in a frame and empty it """
+    def sendFrame(self, dataSocket, destAddr, frame):
+        samples = frame.count()
+        self.sendDatagram(dataSocket, destAddr, frame.getPacket(), samples)
+
+    """ returns the compression ratio and cost per sample, None if not compressing """
+    def getCompressionStats(self):
+        if self.Compressor is None:
+            return None
+        return self.Compressor.getStats()
+
     """ loop forever until the removePub command flag is set.
         in each loop iteration send the Keep Alive packet to
         the central node and check for commands to start/stop publishing
     """
     def commandLoop(self):
 
-        # build the Keep Alive packet for reuse
-        keepAlive = Command().CreateFromParams(Command.KEEP_ALIVE,
-                                               0,
-                                               self.PublisherSensorType,
-                                               self.PublisherKey).GetPacket()
-
         # non-blocking semaphore returns true if acquired
         # parent thread will release the lock if the caller uses the removePub API
         """ STATEFUL - Publisher Registered State """
@@ -176,11 +247,13 @@ class SMPPublisherClient(SMPClient.SMPClient):
                     time.sleep(0.2) # 200 ms delay
                     continue
 
-                # check for commands from the central node start/stop publishing
-                command = self.ClientSocket.recvfrom(SMPClient.SMPClient.MAX_CENTRAL_NODE_CMD_PACKET_SIZE)
+                # RQ 7
+                # send the Keep Alive Packet to the central node, its echo
+                # comes back while we wait for commands
+                self.sendKeepAlive(self.PublisherKey)
 
-                # get the SMP command from the response packet
-                cmdResponse = Command().CreateFromPacket(command[0])
+                # check for commands from the central node start/stop publishing
+                cmdResponse = self.receiveCommand()
 
                 """ STATEFUL - Transition to Idle 2 """
                 # check for start publishing command
@@ -191,6 +264,7 @@ class SMPPublisherClient(SMPClient.SMPClient):
                     """ STATEFUL - Transition to Active """
                     self.sendCentralNodeCommand(Command.SUCCESS, cmdResponse.TransactionID, 0)
                     self.StartPublishingEvent.set()
+                    self.DataQueue.setEnabled(True)
                     self.IsPublishing = True
 
                 # check for stop publishing command
@@ -200,12 +274,25 @@ class SMPPublisherClient(SMPClient.SMPClient):
                     self.sendCentralNodeCommand(Command.SUCCESS, cmdResponse.TransactionID, 0)
                     # blocking, once acquired, stops the dataPublisherLoop from broadcast
                     self.StartPublishingEvent.clear()
+                    self.DataQueue.setEnabled(False)
                     # acquire the startPublishing lock and set the class flag
                     self.IsPublishing = False
 
+                # a resend of a start or stop we already acted on, our success got lost
+                elif cmdResponse.Code in (Command.START_PUBLISHING, Command.STOP_PUBLISHING):
+                    self.sendCentralNodeCommand(Command.SUCCESS, cmdResponse.TransactionID, 0)
+
+                # the cluster moved our key to another central node, we
+                # register there and wait for it to tell us to start again
+                elif Command.REDIRECT == cmdResponse.Code:
+                    self.StartPublishingEvent.clear()
+                    self.DataQueue.setEnabled(False)
+                    self.IsPublishing = False
+                    self.moveCentralNode(cmdResponse)
+
                 # not a start or stop command
                 else:
-                    print "pub client command received not start/stop: " + cmdResponse[0]
+                    Log.Warning("pub client command received not start/stop: %s", cmdResponse)
                     # acquire the lock first so that the socket isn't being used on both threads
                     self.sendCentralNodeCommand(Command.FAILURE, cmdResponse.TransactionID, Command.INVALID_COMMAND)
 
@@ -213,15 +300,10 @@ class SMPPublisherClient(SMPClient.SMPClient):
                 # socket timeouts are normal, no command received from the central node
                 None
             except socket.error:
-                # print "socket error in the publisher command loop"
-                None
+                Log.Debug("socket error in the publisher command loop")
             except Exception:
                 self.exc_info = "pub command loop " + str(self) + " " + str(sys.exc_info())
 
-            # RQ 7
-            # send the Keep Alive Packet to the central node
-            self.ClientSocket.sendto(keepAlive, self.SMPCentralNodeAddress)
-
         # end while
 
 
@@ -0,0 +1,449 @@
+""" The SMPPublisherGateway hosts any number of publishers in one process with
+    one control socket, one data socket and one thread. A field gateway with
+    thousands of sensors would otherwise need an SMPPublisherClient, a control
+    socket and two threads for every one of them.
+
+    Publishers are registered with addPubs, in as few BATCH datagrams as they fit
+    in, and then fed with publishData. The central node keeps one session per
+    client address, so a single keep alive to each central node the gateway uses
+    keeps every one of its publishers alive. START_PUBLISHING and STOP_PUBLISHING
+    name the publisher key they are for, so the event loop can route them to the
+    right stream.
+
+    Streams can frame their samples like an SMPPublisherClient with a frame_mtu,
+    and compact encoding is negotiated the same way. Compression is not offered,
+    a compressor per stream costs more memory than the gateway saves. """
+
+import SMPClient
+import DataPacket
+import Log
+from Command import Command
+import collections
+import errno
+import select
+import socket
+import threading
+import time
+
+
+class GatewayStream(object):
+    """ the state of one publisher hosted by the gateway """
+
+    __slots__ = ("Key", "SensorType", "DataEncoding", "BroadcastPort", "IsPublishing",
+                 "DataQueue", "Frame", "IsReady")
+
+    def __init__(self, publisher_key, sensor_type, data_encoding, queue_size):
+        self.Key = publisher_key
+        self.SensorType = sensor_type
+        self.DataEncoding = data_encoding
+        self.BroadcastPort = None
+        self.IsPublishing = False
+        self.DataQueue = collections.deque(maxlen=queue_size)
+        # samples waiting to be sent together when framing is on
+        self.Frame = None
+        # set while the stream is on the ready list of the event loop
+        self.IsReady = False
+
+
+class SMPPublisherGateway(SMPClient.SMPClient):
+
+    # seconds between the keep alives to each central node
+    KEEP_ALIVE_INTERVAL = 5
+
+    # most control datagrams read in one go before the data gets a turn
+    MAX_CONTROL_DRAIN = 256
+
+    def __init__(self,
+                 smp_central_node_address,
+                 name="gateway",
+                 queue_size=SMPClient.SMPClient.DEFAULT_DATA_QUEUE_MAX_SIZE,
+                 frame_mtu=None,
+                 max_linger=DataPacket.DEFAULT_MAX_LINGER):
+
+        # the gateway has no key of its own, its name is the keep alive payload
+        SMPClient.SMPClient.__init__(self,
+                                     smp_central_node_address,
+                                     SMPClient.SMPClient.SMP_CLIENT_TYPE_PUBLISHER,
+                                     name,
+                                     0,
+                                     self.eventLoop,
+                                     None,
+                                     queue_size)
+
+        # data queue size of each stream
+        self.QueueSize = queue_size
+        # max datagram size when framing samples, None sends one datagram per sample
+        self.FrameMTU = frame_mtu
+        # max seconds a sample waits in a partially filled frame
+        self.MaxLinger = max_linger
+
+        # the hosted streams by publisher key, and the ones with data to send
+        self.Streams = dict()
+        self.ReadyStreams = collections.deque()
+        # streams with samples waiting in a partially filled frame
+        self.LingeringStreams = set()
+
+        # the event loop and callers registering publishers take turns reading the control socket
+        self.SocketLock = threading.RLock()
+        self.DataSocket = None
+
+        # publishData wakes the event loop through this pair while it sleeps
+        self.WakeReceiver, self.WakeSender = socket.socketpair()
+        self.WakeReceiver.setblocking(0)
+        self.WakeSender.setblocking(0)
+        self.IsSleeping = False
+
+        self.LoopThread = None
+        self.IsRunning = False
+
+        self.Stats.SetGauge("streams", lambda: len(self.Streams))
+        self.Stats.SetGauge("streams_publishing",
+                            lambda: sum(1 for stream in self.Streams.values() if stream.IsPublishing))
+        self.Stats.SetGauge("queue_length",
+                            lambda: sum(len(stream.DataQueue) for stream in self.Streams.values()))
+
+    """ register one publisher, see addPubs. returns the central node
+        response, None if there was none """
+    def addPub(self, publisher_key, sensor_type, data_encoding=DataPacket.ENCODING_PLAIN):
+        return self.addPubs([(publisher_key, sensor_type, data_encoding)])[0]
+
+    """ register many publishers with the central node. publishers is a list
+        of (publisher key, sensor type) or (publisher key, sensor type, data
+        encoding). the event loop is started with the first one that is
+        registered. returns the central node response for each publisher in
+        the same order, None for the ones that got no response """
+    def addPubs(self, publishers):
+        commands = []
+        for publisher in publishers:
+            dataEncoding = publisher[2] if len(publisher) > 2 else DataPacket.ENCODING_PLAIN
+            commands.append((Command.ADD_PUBLISHER, publisher[0], publisher[1], dataEncoding))
+
+        with self.SocketLock:
+            responses = self.sendCentralNodeBatch(commands)
+
+        for (commandCode, publisherKey, sensorType, dataEncoding), response in zip(commands, responses):
+            if response is not None and Command.SUCCESS == response.Code:
+                stream = GatewayStream(publisherKey, sensorType, dataEncoding, self.QueueSize)
+                self.processAddPubResponse(stream, response)
+                self.Streams[publisherKey] = stream
+
+        if self.Streams and not self.IsRunning:
+            self.IsSMPClientRegistered = True
+            self.IsRunning = True
+            self.LoopThread = threading.Thread(target=self.eventLoop, name="SMPPublisherGateway")
+            self.LoopThread.daemon = True
+            self.LoopThread.start()
+
+        return responses
+
+    """ set up a stream with the port and data encoding the central node
+        gave it in its add publisher response """
+    def processAddPubResponse(self, stream, command_response):
+        stream.BroadcastPort = int(command_response.Payload)
+        stream.DataEncoding = command_response.Reserved
+        stream.IsPublishing = False
+
+        if DataPacket.ENCODING_COMPACT == stream.DataEncoding:
+            stream.Frame = DataPacket.CompactFrame(self.FrameMTU or DataPacket.DEFAULT_FRAME_MTU)
+        elif self.FrameMTU is not None:
+            stream.Frame = DataPacket.DataFrame(self.FrameMTU)
+        else:
+            stream.Frame = None
+
+    """ unregister one publisher, see removePubs. returns the central node
+        response, None if there was none """
+    def removePub(self, publisher_key):
+        return self.removePubs([publisher_key])[0]
+
+    """ unregister many publishers from the central node. returns the central
+        node response for each publisher key in the same order, None for the
+        ones that got no response """
+    def removePubs(self, publisher_keys):
+        with self.SocketLock:
+            responses = self.sendCentralNodeBatch([(Command.REMOVE_PUBLISHER, key) for key in publisher_keys])
+
+        for publisherKey, response in zip(publisher_keys, responses):
+            if response is not None and Command.SUCCESS == response.Code:
+                stream = self.Streams.pop(publisherKey, None)
+                if stream is not None:
+                    stream.IsPublishing = False
+                    self.LingeringStreams.discard(stream)
+
+        return responses
+
+    """ publish data for one of our publishers. data must be an iterable of
+        samples, they wait in the queue of the stream until the central node
+        tells it to start publishing """
+    def publishData(self, publisher_key, data):
+        stream = self.Streams[publisher_key]
+        queue = stream.DataQueue
+        for x in data:
+            # a full queue pushes out the oldest sample
+            if len(queue) == queue.maxlen:
+                self.QueueDrops.Increment()
+            queue.append(x)
+
+        if stream.IsPublishing and not stream.IsReady:
+            stream.IsReady = True
+            self.ReadyStreams.append(stream)
+
+            # the event loop checks the ready streams after it says it sleeps
+            if self.IsSleeping:
+                self.wakeEventLoop()
+
+    """ returns True if the central node told the publisher to start """
+    def isPublishing(self, publisher_key):
+        stream = self.Streams.get(publisher_key)
+        return stream is not None and stream.IsPublishing
+
+    """ stop the event loop, the publishers stay registered until they time
+        out on the central node """
+    def stop(self):
+        self.IsRunning = False
+        self.wakeEventLoop()
+        if self.LoopThread is not None and self.LoopThread is not threading.current_thread():
+            self.LoopThread.join()
+            self.LoopThread = None
+
+    """ wake the event loop up from its select """
+    def wakeEventLoop(self):
+        try:
+            self.WakeSender.send(b"\0")
+        except socket.error:
+            # the pipe is full, the event loop is awake already
+            None
+
+    """ the one thread of the gateway. sends the keep alives, handles the
+        commands from the central node and sends the data of the streams
+        that are publishing """
+    def eventLoop(self):
+
+        # RQ 3
+        # create a broadcast socket shared by every stream
+        self.DataSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.DataSocket.bind(('', 0))
+        self.DataSocket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+
+        nextKeepAlive = time.time()
+        sockets = [self.ClientSocket, self.WakeReceiver]
+
+        while self.IsRunning:
+            try:
+                now = time.time()
+
+                # RQ 7
+                # one keep alive to each central node covers every publisher we have there
+                if now >= nextKeepAlive:
+                    self.sendKeepAlives()
+                    nextKeepAlive = now + self.KEEP_ALIVE_INTERVAL
+
+                # sleep until the next keep alive or the oldest frame is due, unless data is waiting
+                timeout = nextKeepAlive - now
+                if self.LingeringStreams:
+                    timeout = min(timeout, self.MaxLinger)
+
+                self.IsSleeping = True
+                if self.ReadyStreams:
+                    timeout = 0
+
+                try:
+                    readable = select.select(sockets, [], [], max(timeout, 0))[0]
+                finally:
+                    self.IsSleeping = False
+
+                if self.WakeReceiver in readable:
+                    self.drainWakeups()
+
+                if self.ClientSocket in readable:
+                    self.drainCommands()
+
+                self.sendReadyStreams()
+                self.sendLingeringFrames()
+
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    Log.Exception("select failed in the gateway event loop")
+            except Exception:
+                Log.Exception("exception in the gateway event loop")
+
+        self.DataSocket.close()
+
+    """ send one numbered keep alive to every central node we have
+        publishers on, they all echo it back so we can time one of them """
+    def sendKeepAlives(self):
+        nodes = set(SMPClient.CentralNodeCache.get(key, self.SMPCentralNodeAddress) for key in list(self.Streams))
+        if not nodes:
+            return
+
+        self.KeepAliveID = self.KeepAliveID % SMPClient.SMPClient.MAX_KEEP_ALIVE_ID + 1
+        keepAlive = Command.Codec.Encode(Command.KEEP_ALIVE, self.KeepAliveID, 0, self.PublisherKey)
+        self.KeepAliveSentAt = time.time()
+        for node in nodes:
+            self.ClientSocket.sendto(keepAlive, node)
+            self.PacketsSent.Increment()
+
+    """ empty the wake up pipe """
+    def drainWakeups(self):
+        try:
+            while self.WakeReceiver.recv(4096):
+                None
+        except socket.error:
+            None
+
+    """ handle the commands waiting on the control socket. a caller that is
+        registering publishers holds the socket, we get the ones it skipped
+        again when the central node resends them """
+    def drainCommands(self):
+        if not self.SocketLock.acquire(False):
+            return
+
+        try:
+            # read without waiting, a socket with a timeout would wait for one
+            # more datagram after the last one
+            commands = []
+            self.ClientSocket.setblocking(0)
+            try:
+                for n in range(self.MAX_CONTROL_DRAIN):
+                    try:
+                        packet, address = self.ClientSocket.recvfrom(SMPClient.SMPClient.MAX_CENTRAL_NODE_CMD_PACKET_SIZE)
+                    except socket.error as e:
+                        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                            break
+                        raise
+
+                    self.PacketsReceived.Increment()
+                    command = Command().CreateFromPacket(packet)
+                    if command is not None:
+                        commands.append((command, address))
+            finally:
+                self.ClientSocket.settimeout(SMPClient.SMPClient.SMP_CENTRAL_NODE_RESPONSE_TIMEOUT)
+
+            for command, address in commands:
+                self.processCommand(command, address)
+        finally:
+            self.SocketLock.release()
+
+    """ act on one command from the central node at address """
+    def processCommand(self, command, address):
+
+        # the echo of one of our keep alives
+        if Command.KEEP_ALIVE == command.Code:
+            self.processKeepAliveEcho(command)
+            return
+
+        # answers to commands we stopped waiting for
+        if command.Code in (Command.SUCCESS, Command.FAILURE):
+            return
+
+        if Command.REDIRECT == command.Code:
+            self.moveStream(command, address)
+            return
+
+        stream = self.Streams.get(command.Payload)
+        if stream is None or command.Code not in (Command.START_PUBLISHING, Command.STOP_PUBLISHING):
+            Log.Warning("gateway command received not start/stop: %s", command)
+            self.sendCommandTo(address, Command.FAILURE, command.TransactionID, Command.INVALID_COMMAND)
+            return
+
+        # RQ 19c
+        # RQ 20c
+        # resends of a start or stop we already acted on are acknowledged again
+        self.sendCommandTo(address, Command.SUCCESS, command.TransactionID, 0)
+
+        """ STATEFUL - Transition to Active """
+        if Command.START_PUBLISHING == command.Code:
+            if not stream.IsPublishing:
+                stream.IsPublishing = True
+                if stream.DataQueue and not stream.IsReady:
+                    stream.IsReady = True
+                    self.ReadyStreams.append(stream)
+
+        # STATEFUL - Transition to the Registered state
+        elif stream.IsPublishing:
+            stream.IsPublishing = False
+
+    """ the cluster handed a publisher key to another central node.
+        acknowledge the old node and register the stream with the new one """
+    def moveStream(self, command, address):
+        self.sendCommandTo(address, Command.SUCCESS, command.TransactionID, 0)
+
+        nodeAddress, key = Command.UnpackNodeAddress(command.Payload)
+        stream = self.Streams.get(key)
+        if stream is None:
+            return
+
+        SMPClient.CentralNodeCache[key] = nodeAddress
+        stream.IsPublishing = False
+
+        response = self.sendCentralNodeBatch([(Command.ADD_PUBLISHER, key, stream.SensorType, stream.DataEncoding)])[0]
+        if response is not None and Command.SUCCESS == response.Code:
+            # the new node hands out its own broadcast port
+            self.processAddPubResponse(stream, response)
+        else:
+            Log.Warning("gateway could not move publisher %s to %s: %s", key, nodeAddress, response)
+
+    """ send a command with a number payload to a central node """
+    def sendCommandTo(self, address, command_code, transaction_id, payload):
+        self.ClientSocket.sendto(Command.Codec.Encode(command_code, transaction_id, 0, payload), address)
+        self.PacketsSent.Increment()
+
+    """ send the data queued on every ready stream """
+    def sendReadyStreams(self):
+        ready = self.ReadyStreams
+        while ready:
+            stream = ready.popleft()
+            stream.IsReady = False
+            if not stream.IsPublishing:
+                continue
+
+            # the port changes if a cluster moves the stream to another central node
+            destAddr = (SMPClient.SMPClient.SMP_MULTICAST_GROUP, stream.BroadcastPort)
+            queue = stream.DataQueue
+            frame = stream.Frame
+            try:
+                # RQ 6
+                # only what is queued now, publishData may be adding more
+                for n in range(len(queue)):
+                    data = queue.popleft()
+                    mystamp = DataPacket.GetTimestamp()
+
+                    if frame is None:
+                        self.sendDatagram(destAddr, DataPacket.PackSample(mystamp, data))
+                    elif not frame.add(mystamp, data):
+                        # the frame is full, send it and start the next one with this sample
+                        if frame.count() > 0:
+                            self.sendFrame(destAddr, frame)
+                        # samples too big for any frame are sent on their own
+                        if not frame.add(mystamp, data):
+                            self.sendDatagram(destAddr, DataPacket.PackSample(mystamp, data))
+
+                if frame is not None and frame.count() > 0:
+                    self.LingeringStreams.add(stream)
+            except socket.error:
+                Log.Warning("error sending data for %s in the gateway", stream.Key)
+
+    """ send the frames whose oldest sample has waited long enough """
+    def sendLingeringFrames(self):
+        for stream in list(self.LingeringStreams):
+            frame = stream.Frame
+            if frame is None or frame.count() == 0 or not stream.IsPublishing:
+                self.LingeringStreams.discard(stream)
+            elif frame.isExpired(self.MaxLinger):
+                self.LingeringStreams.discard(stream)
+                try:
+                    self.sendFrame((SMPClient.SMPClient.SMP_MULTICAST_GROUP, stream.BroadcastPort), frame)
+                except socket.error:
+                    Log.Warning("error sending data for %s in the gateway", stream.Key)
+
+    """ send a data packet to the broadcast address """
+    def sendDatagram(self, destAddr, packet):
+        self.DataSocket.sendto(packet, destAddr)
+        self.DataPacketsSent.Increment()
+
+    """ send the samples collected in a frame and empty it """
+    def sendFrame(self, destAddr, frame):
+        self.sendDatagram(destAddr, frame.getPacket())
+
+    """ to string method to print the gateway info """
+    def __str__(self):
+        return "Gateway: Name=" + self.PublisherKey + " Streams=" + str(len(self.Streams))
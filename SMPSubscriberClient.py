@@ -6,10 +6,22 @@
     variable to determine if the retrieveData function should be called. The
     retrieveData function can optionally be a blocking call until data arrives
     at the subscriber node within a given timeout.
+    Framed datagrams from the publisher are unpacked so that the data queue
+    always holds one timestamped sample per entry.
+
+    A subscriber can be given a pattern instead of a publisher key, with a
+    level of "*" for any one level and a last level of "#" for any number of
+    levels, like "plant3/line2/#". It listens to every publisher whose key
+    matches, including the ones added later, and each entry in its data
+    queue is a (publisher key, sample) pair.
 """
 
 import SMPClient
+import DataPacket
+import TopicTrie
+import Log
 from Command import Command
+import select
 import socket
 import sys
 import threading
@@ -47,6 +59,12 @@ class SMPSubscriberClient(SMPClient.SMPClient):
         self.StartDataLoopEvent = threading.Event()
         # removeSub event flag for allowing the parent thread to use the command socket
         self.RemoveSubEvent = threading.Event()
+        # subscribed to a pattern instead of one publisher
+        self.IsWildcard = TopicTrie.IsPattern(publisher_key)
+        # the broadcast port and data encoding of every publisher a pattern
+        # matched by key. the command loop replaces the whole dictionary so the
+        # data loop can use the one it has without locking
+        self.Streams = dict()
 
     """ addSub command sent to the SMP central node server.
         If the central node returns success, then kick off the command loop and
@@ -67,7 +85,7 @@ class SMPSubscriberClient(SMPClient.SMPClient):
         # RQ 18b
         # send the central node the removePub command, True flag waits for response
         commandResponse = self.sendCentralNodeCommand(Command.REMOVE_SUBSCRIBER,
-                                                      SMPClient.GetTransactionId(),
+                                                      self.getTransactionId(),
                                                       self.PublisherKey,
                                                       True)
 
@@ -86,7 +104,8 @@ class SMPSubscriberClient(SMPClient.SMPClient):
 	return commandResponse
 
 
-    """ return data from the data queue """
+    """ return data from the data queue, a (publisher key, sample) pair
+        if we subscribed to a pattern """
     def getData(self):
         try:
             return self.DataQueue.popleft()
@@ -94,6 +113,11 @@ class SMPSubscriberClient(SMPClient.SMPClient):
             # normal to have an empty data queue, return None to the caller
             return None
 
+    """ returns the keys of the publishers a pattern subscription is
+        listening to """
+    def getPublishers(self):
+        return sorted(self.Streams)
+
     def commandLoop(self):
 
         # immediately acquire the pubRemovedLock so that the data loop can run
@@ -101,12 +125,6 @@ class SMPSubscriberClient(SMPClient.SMPClient):
         # set the thread event for the data loop to run
         self.StartDataLoopEvent.set()
 
-        # build the Keep Alive packet for reuse
-        keepAlive = Command().CreateFromParams(Command.KEEP_ALIVE,
-                                               0,
-                                               self.PublisherSensorType,
-                                               " ").GetPacket()
-
         # non-blocking semaphore returns true if acquired
         # parent thread will release the lock if the caller uses the removePub API
         """ STATEFUL - Subscriber Listening State """
@@ -122,27 +140,18 @@ class SMPSubscriberClient(SMPClient.SMPClient):
                     time.sleep(0.2) # 200 ms delay
                     continue
 
-                # check for commands from the central node for pub removed
-                command = self.ClientSocket.recvfrom(SMPClient.SMPClient.MAX_CENTRAL_NODE_CMD_PACKET_SIZE)
-
-                # get the SMP command from the response packet
-                cmdResponse = Command().CreateFromPacket(command[0])
-
-                # RQ 16c
-                # RQ 21c
-                # check for publisher removed command
-                """ STATEFUL - Transition to the Finished State """
-                if Command.PUBLISHER_REMOVED == cmdResponse.Code:
-                    # respond to the central node with success command
-                    self.sendCentralNodeCommand(Command.SUCCESS, cmdResponse.TransactionID, 0)
-                    # release the pub removed lock to force the data loop to exit
-                    self.PubRemovedLock.release()
-                    self.IsPublishing = False
-                    self.IsSMPClientRegistered = False
+                # RQ 7
+                # send the Keep Alive Packet to the central node, its echo
+                # comes back while we wait for commands
+                self.sendKeepAlive(" ")
 
-                # not a publisher removed command
-                else:
-                    self.sendCentralNodeCommand(Command.FAILURE, cmdResponse.TransactionID, Command.INVALID_COMMAND)
+                # check for commands from the central node for pub removed, a
+                # pattern can be told about many publishers at once so handle
+                # every command waiting until the socket times out
+                while self.IsPublishing and not self.RemoveSubEvent.isSet():
+                    cmdResponse = self.receiveCommand()
+                    if cmdResponse is not None:
+                        self.processCommand(cmdResponse)
 
             except socket.timeout:
                 # socket timeouts are normal, no commands received from the command node
@@ -151,12 +160,56 @@ class SMPSubscriberClient(SMPClient.SMPClient):
                 # save off the exception in a class variable for the caller
                 self.exc_info = "sub command loop " + str(self) + " " + str(sys.exc_info())
 
-            # RQ 7
-            # send the Keep Alive Packet to the central node
-            self.ClientSocket.sendto(keepAlive, self.SMPCentralNodeAddress)
-
         # end while
 
+    """ handle a command from the central node """
+    def processCommand(self, cmdResponse):
+
+        # a publisher matching our pattern was added, listen to its port
+        if Command.PUBLISHER_ADDED == cmdResponse.Code and self.IsWildcard:
+            self.sendCentralNodeCommand(Command.SUCCESS, cmdResponse.TransactionID, 0)
+            port, encoding, key = Command.UnpackPublisherAdded(cmdResponse.Payload)
+            streams = dict(self.Streams)
+            streams[key] = (port, encoding)
+            self.Streams = streams
+
+        # a publisher matching our pattern is gone, the pattern stays
+        elif Command.PUBLISHER_REMOVED == cmdResponse.Code and self.IsWildcard:
+            self.sendCentralNodeCommand(Command.SUCCESS, cmdResponse.TransactionID, 0)
+            streams = dict(self.Streams)
+            streams.pop(cmdResponse.Payload, None)
+            self.Streams = streams
+
+        # RQ 16c
+        # RQ 21c
+        # check for publisher removed command
+        elif Command.PUBLISHER_REMOVED == cmdResponse.Code:
+            """ STATEFUL - Transition to the Finished State """
+            # respond to the central node with success command
+            self.sendCentralNodeCommand(Command.SUCCESS, cmdResponse.TransactionID, 0)
+            # release the pub removed lock to force the data loop to exit
+            self.PubRemovedLock.release()
+            self.IsPublishing = False
+            self.IsSMPClientRegistered = False
+
+        # the cluster moved our publisher to another central node
+        elif Command.REDIRECT == cmdResponse.Code:
+            commandResponse = self.moveCentralNode(cmdResponse)
+
+            # the publisher never showed up on the new node, same as removed
+            if commandResponse is None or Command.SUCCESS != commandResponse.Code:
+                self.PubRemovedLock.release()
+                self.IsPublishing = False
+                self.IsSMPClientRegistered = False
+
+        # answers to commands we stopped waiting for
+        elif cmdResponse.Code in (Command.SUCCESS, Command.FAILURE):
+            return
+
+        # not a publisher removed command
+        else:
+            self.sendCentralNodeCommand(Command.FAILURE, cmdResponse.TransactionID, Command.INVALID_COMMAND)
+
     """ Enter the data subscriber loop. push data into the queue as it is
         received from the published broadcast port. If the pub removed command
         is received, then the parent thread will release the locks to exit this
@@ -168,20 +221,11 @@ class SMPSubscriberClient(SMPClient.SMPClient):
         while not self.StartDataLoopEvent.isSet():
             None
 
-        # create a data receiving socket
-        # RQ 3
-        dataSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            dataSocket.bind(('', self.BroadcastPort))
-        except:
-            print "You tried to add a subscriber that already exists on this machine... Please don't do that."
+        if self.IsWildcard:
+            return self.wildcardDataLoop()
 
-        dataSocket.settimeout(1)
-
-        #create the multicast group.
-        group = socket.inet_aton(SMPClient.SMPClient.SMP_MULTICAST_GROUP)
-        mreq = struct.pack('4sL', group, socket.INADDR_ANY)
-        dataSocket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        boundPort = self.BroadcastPort
+        dataSocket = self.openDataSocket(boundPort)
 
         # RQ 16c
         # non-blocking semaphore returns true if acquired
@@ -191,22 +235,110 @@ class SMPSubscriberClient(SMPClient.SMPClient):
         """ STATEFUL - Check to remain in the Listening state or transition to Finished """
         while not self.DataLoopLock.acquire(False) and not self.PubRemovedLock.acquire(False):
 
+            # the publisher moved to another central node and got a new port
+            if boundPort != self.BroadcastPort:
+                dataSocket.close()
+                boundPort = self.BroadcastPort
+                dataSocket = self.openDataSocket(boundPort)
+
             try:
                 # receive data from the broadcast port and put it in the data queue
-                self.DataQueue.append(
+                # framed datagrams are split back into one packet per sample
+                samples = DataPacket.UnpackDatagram(
                     dataSocket.recvfrom(SMPSubscriberClient.SMP_DATA_PACKET_MAX_LENGTH)[0])
+                self.DataPacketsReceived.Increment()
+
+                # a full queue pushes out the oldest samples
+                overflow = len(self.DataQueue) + len(samples) - self.DataQueue.maxlen
+                if overflow > 0:
+                    self.QueueDrops.Increment(overflow)
+                self.DataQueue.extend(samples)
 
             except socket.timeout:
                 # normal to have a socket timeout, no data in the socket
                 None
+            except (struct.error, ValueError):
+                # truncated frame or data we can't decompress, drop it
+                Log.Warning("malformed data packet received in the subscriber loop")
             except (socket.error, IndexError):
                 # full deque or socket error
-                print "error receiving data in the subscriber loop"
+                Log.Warning("error receiving data in the subscriber loop")
             except Exception:
-                print "unknown error in the subscriber data loop"
+                Log.Exception("unknown error in the subscriber data loop")
                 self.exc_info = "sub data loop " + str(self) + " " + str(sys.exc_info())
 
         # close the data socket
         dataSocket.close()
 
+    """ the data subscriber loop of a pattern subscription. listens to the
+        broadcast port of every publisher the pattern matched, opening and
+        closing data sockets as the command loop learns about publishers coming
+        and going, and tags each sample with the key of its publisher """
+    def wildcardDataLoop(self):
+
+        # the publisher key and data socket of every port we listen to
+        sockets = dict()
+
+        while not self.DataLoopLock.acquire(False) and not self.PubRemovedLock.acquire(False):
+
+            ports = dict((port, key) for key, (port, encoding) in self.Streams.items())
+            for port in [port for port in sockets if port not in ports]:
+                sockets.pop(port)[1].close()
+            for port, key in ports.items():
+                if port not in sockets:
+                    sockets[port] = (key, self.openDataSocket(port))
+
+            if not sockets:
+                time.sleep(0.1)
+                continue
+
+            try:
+                readable = select.select([dataSocket for key, dataSocket in sockets.values()], [], [], 1)[0]
+
+                for key, dataSocket in sockets.values():
+                    if dataSocket not in readable:
+                        continue
+
+                    samples = DataPacket.UnpackDatagram(
+                        dataSocket.recvfrom(SMPSubscriberClient.SMP_DATA_PACKET_MAX_LENGTH)[0])
+                    self.DataPacketsReceived.Increment()
+
+                    # a full queue pushes out the oldest samples
+                    overflow = len(self.DataQueue) + len(samples) - self.DataQueue.maxlen
+                    if overflow > 0:
+                        self.QueueDrops.Increment(overflow)
+                    self.DataQueue.extend([(key, sample) for sample in samples])
+
+            except (struct.error, ValueError):
+                # truncated frame or data we can't decompress, drop it
+                Log.Warning("malformed data packet received in the subscriber loop")
+            except (select.error, socket.error):
+                Log.Warning("error receiving data in the subscriber loop")
+            except Exception:
+                Log.Exception("unknown error in the subscriber data loop")
+                self.exc_info = "sub data loop " + str(self) + " " + str(sys.exc_info())
+
+        # close the data sockets
+        for key, dataSocket in sockets.values():
+            dataSocket.close()
+
+    """ create a data receiving socket on a broadcast port and join the multicast group """
+    def openDataSocket(self, port):
+
+        # RQ 3
+        dataSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            dataSocket.bind(('', port))
+        except:
+            Log.Error("You tried to add a subscriber that already exists on this machine... Please don't do that.")
+
+        dataSocket.settimeout(1)
+
+        #create the multicast group.
+        group = socket.inet_aton(SMPClient.SMPClient.SMP_MULTICAST_GROUP)
+        mreq = struct.pack('4sL', group, socket.INADDR_ANY)
+        dataSocket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+        return dataSocket
+
 
@@ -0,0 +1,186 @@
+# ShardRouter.py
+# Routes control commands between the worker processes of a multi process central node.  Every
+# worker owns a shard of the publisher keys, commands that land on the wrong worker are forwarded
+# to the owner over a local datagram socket.
+
+import errno
+import socket
+import struct
+import zlib
+from Command import Command
+import TopicTrie
+
+class ShardRouter(object):
+    """Decides which worker owns a command and forwards it there.  Publisher keys are sharded by CRC so
+       every process agrees on the owner, and the central node transaction ids of worker n are the ones
+       where -id % count == n so responses to them can be routed too."""
+
+    # Client address in front of every forwarded datagram.
+    FORWARD_HEADER = struct.Struct(">4sH")
+
+    # Biggest forwarded datagram we will read.
+    MAX_DATAGRAM_SIZE = 65535 + 6
+
+    # Commands whose payload is the publisher key.
+    KEYED_COMMANDS = (Command.ADD_PUBLISHER, Command.REMOVE_PUBLISHER, Command.ADD_SUBSCRIBER, Command.REMOVE_SUBSCRIBER)
+
+    # First byte of a BATCH datagram, batches are split between the workers that own their commands.
+    BATCH_CODE = chr(Command.BATCH)
+
+    # First byte of a KEEP_ALIVE, the only command every worker sees that stays with us in a batch.
+    KEEP_ALIVE_CODE = chr(Command.KEEP_ALIVE)
+
+    def __init__(self, index, channels):
+        """Public constructor.  channels is a list with a (receive, send) socket pair for every worker,
+           this worker reads from its own receive socket and writes to the send socket of the others."""
+        self.Index = index
+        self.Count = len(channels)
+        self.Channel = channels[index][0]
+        self.Peers = [send for receive, send in channels]
+        self.Forwarded = 0
+        self.Dropped = 0
+
+        self.Channel.setblocking(0)
+        for peer in self.Peers:
+            peer.setblocking(0)
+
+
+    @staticmethod
+    def CreateChannels(count):
+        """Creates the sockets the workers talk over, call this before forking."""
+        channels = []
+        for n in range(count):
+            receive, send = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            channels.append((receive, send))
+        return channels
+
+
+    @staticmethod
+    def GetShard(key, count):
+        """Returns the worker that owns a publisher key."""
+        return (zlib.crc32(key) & 0xFFFFFFFF) % count
+
+
+    def GetOwner(self, data):
+        """Returns the worker that should handle a datagram, or None if every worker has to see it."""
+        try:
+            command = Command.Codec.Decode(data)
+        except Exception:
+            # Let the local handler send back the error.
+            return self.Index
+
+        if not command.CRCOkay:
+            return self.Index
+
+        if command.Code == Command.KEEP_ALIVE:
+            # The client may own publishers and subscribers on any worker.
+            return None
+
+        if command.Code == Command.NODE_JOINED:
+            # Every worker has keys the new node may take over.
+            return None
+
+        if command.Code in self.KEYED_COMMANDS and command.Payload:
+            # A pattern matches publishers on every worker, each one adds the subscriber to its own.
+            if TopicTrie.IsPattern(command.Payload):
+                return None
+            return self.GetShard(command.Payload, self.Count)
+
+        if command.Code == Command.DISCOVER:
+            # Every worker pages through its own publishers, the cursor says which one the client is up to.
+            try:
+                worker = Command.UnpackDiscoverCursor(Command.UnpackDiscover(command.Payload)[1])[0]
+            except ValueError:
+                return self.Index
+            return worker if worker < self.Count else self.Index
+
+        if command.Code in (Command.SUCCESS, Command.FAILURE) and command.TransactionID < 0:
+            return -command.TransactionID % self.Count
+
+        return self.Index
+
+
+    def Dispatch(self, data, client_address):
+        """Forwards a datagram from a client to the workers that need it.  Returns True if this worker
+           has to handle it as well."""
+        if data[:1] == self.BATCH_CODE:
+            return self.DispatchBatch(data, client_address)
+
+        owner = self.GetOwner(data)
+        if owner == self.Index:
+            return True
+
+        if owner is None:
+            for index in range(self.Count):
+                if index != self.Index:
+                    self.Forward(index, data, client_address)
+            return True
+
+        self.Forward(owner, data, client_address)
+        return False
+
+
+    def DispatchBatch(self, data, client_address):
+        """Splits a BATCH between the workers that own its commands.  Each one gets a BATCH of its own commands
+           and sends back its own response, the client matches them up by transaction id.  Returns True if
+           this worker owns every command and should handle the datagram as it is."""
+        try:
+            command = Command.Codec.Decode(data)
+            packets = Command.UnpackBatch(command.Payload)
+        except Exception:
+            return True
+
+        if not command.CRCOkay:
+            return True
+
+        # Keep alives in a batch only reach this worker, clients send their keep alives on their own anyway.
+        shards = dict()
+        for packet in packets:
+            owner = self.GetOwner(packet)
+            if owner is not None:
+                shards.setdefault(owner, []).append(packet)
+            elif packet[:1] == self.KEEP_ALIVE_CODE:
+                shards.setdefault(self.Index, []).append(packet)
+            else:
+                for index in range(self.Count):
+                    shards.setdefault(index, []).append(packet)
+
+        if not shards or list(shards) == [self.Index]:
+            return True
+
+        if len(shards) == 1:
+            self.Forward(list(shards)[0], data, client_address)
+            return False
+
+        # Our own share comes back to us through our channel like any other forwarded datagram.
+        for index, shard in shards.items():
+            self.Forward(index, Command.Codec.Encode(Command.BATCH, command.TransactionID, command.SensorType,
+                                                     Command.PackBatch(shard), command.Reserved), client_address)
+
+        return False
+
+
+    def Forward(self, index, data, client_address):
+        """Sends a datagram to another worker along with the address of the client it came from."""
+        header = self.FORWARD_HEADER.pack(socket.inet_aton(client_address[0]), client_address[1])
+        try:
+            self.Peers[index].send(header + data)
+            self.Forwarded = self.Forwarded + 1
+        except socket.error as e:
+            # Just like UDP, if the other worker is swamped the datagram is lost.
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                raise
+            self.Dropped = self.Dropped + 1
+
+
+    def Receive(self):
+        """Returns the next (data, client_address) another worker forwarded to us, or None if there is none."""
+        try:
+            message = self.Channel.recv(self.MAX_DATAGRAM_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            raise
+
+        ip, port = self.FORWARD_HEADER.unpack_from(message)
+        return message[self.FORWARD_HEADER.size:], (socket.inet_ntoa(ip), port)
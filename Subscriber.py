@@ -5,28 +5,35 @@
 
 from Command import Command
 import SMPCentralNodeRequestHandler
+import Log
 
 class Subscriber(object):
     """Data structure representing a single subscriber in the CentralNode."""
 
-    def __init__(self, request, client_address, sensor_type=0):
-        """Public constructor sets up all important variables."""
+    def __init__(self, request, client_address, sensor_type=0, pattern=None):
+        """Public constructor sets up all important variables.  A wildcard subscription has its pattern, the
+           same Subscriber is added to every publisher that matches it."""
         self.Key = client_address
         self.Socket = request[1]
         self.SensorType = sensor_type
-        self.TimeoutCount = 0
+        self.Pattern = pattern
 
-    def SendCommand(self, cmd_code, pub_name):
-        """Sends a command to the subscriber over the network. """
+    def SendCommand(self, cmd_code, pub_name, deferred=None):
+        """Sends a command to the subscriber over the network.  If deferred is a list the transaction is put
+           on it instead, for the caller to send after its response."""
 
         # Get the transaction id and create the command structure.
         TxId = SMPCentralNodeRequestHandler.GetNextTransactionID()
         command = Command().CreateFromParams(cmd_code, TxId, self.SensorType, pub_name)
 
         #log the transaction, the Key is the client address in this case.
-        SMPCentralNodeRequestHandler.StoreTransaction(TxId, command, self.Socket, self.Key)
+        transaction = SMPCentralNodeRequestHandler.StoreTransaction(TxId, command, self.Socket, self.Key)
 
-        print "Sending: " + command.GetCommandString() + " <" + str(command) + ">"
+        Log.Debug("Sending: <%s>", command)
 
-        # In a happy accident the subscribers key is actually the client address, so we just pass that into the send call.
-        self.Socket.sendto(command.GetPacket(), self.Key)
\ No newline at end of file
+        if deferred is not None:
+            deferred.append(transaction)
+            return
+
+        # Actually do the sending, the transaction sent it to the subscribers key which is its client address.
+        transaction.Send()
\ No newline at end of file
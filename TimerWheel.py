@@ -0,0 +1,57 @@
+# TimerWheel.py
+# Hashed timer wheel.  Scheduling is O(1) and advancing the clock only touches the slots that
+# came due, so the cost of a tick depends on how many timers fire and not on how many exist.
+
+import math
+import time
+
+class TimerWheel(object):
+    """Hashed timer wheel.  Timers are not cancelled, the owner ignores the ones it no longer cares about."""
+
+    def __init__(self, tick=0.1, slot_count=512, now=None):
+        """Public constructor.  tick is the resolution in seconds, slot_count * tick should be longer than
+           most timeouts so timers don't have to wait out extra revolutions of the wheel."""
+        if now is None:
+            now = time.time()
+
+        self.Tick = tick
+        self.Slots = [[] for n in range(slot_count)]
+        self.CurrentTick = int(now / tick)
+        self.Count = 0
+
+
+    def Schedule(self, deadline, item):
+        """Adds item to the wheel, it comes back out of Advance() once the clock passes deadline."""
+        tick = max(int(math.ceil(deadline / self.Tick)), self.CurrentTick + 1)
+        self.Slots[tick % len(self.Slots)].append((tick, item))
+        self.Count = self.Count + 1
+
+
+    def Advance(self, now=None):
+        """Moves the clock forward to now and returns the list of items that came due."""
+        if now is None:
+            now = time.time()
+
+        target = int(now / self.Tick)
+        due = []
+
+        # after one revolution every slot has been looked at so there is no point going further.
+        last = min(target, self.CurrentTick + len(self.Slots))
+        for tick in range(self.CurrentTick + 1, last + 1):
+            index = tick % len(self.Slots)
+            slot = self.Slots[index]
+            if not slot:
+                continue
+
+            # timers that hash here but are due on a later revolution stay put.
+            later = []
+            for entry in slot:
+                if entry[0] <= target:
+                    due.append(entry[1])
+                else:
+                    later.append(entry)
+            self.Slots[index] = later
+
+        self.CurrentTick = max(target, self.CurrentTick)
+        self.Count = self.Count - len(due)
+        return due
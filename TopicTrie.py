@@ -0,0 +1,181 @@
+# TopicTrie.py
+# Trie of slash separated topic names, used to find the wildcard subscriptions that match a publisher key
+# and the publisher keys that match a wildcard subscription without looking at every one of them.
+
+# Topics are split into levels at the separator, like "plant3/line2/temperature".
+SEPARATOR = "/"
+
+# A level of "*" matches any one level, a last level of "#" matches any number of levels, none included.
+ONE_LEVEL = "*"
+ALL_LEVELS = "#"
+
+
+def IsPattern(topic):
+    """Returns True if a topic has a wildcard level in it."""
+    # Most keys don't have a wildcard character anywhere, so don't split them.
+    if ONE_LEVEL not in topic and ALL_LEVELS not in topic:
+        return False
+
+    for level in topic.split(SEPARATOR):
+        if level == ONE_LEVEL or level == ALL_LEVELS:
+            return True
+
+    return False
+
+
+def IsValidPattern(pattern):
+    """Returns True if a pattern only has "#" as its last level."""
+    levels = pattern.split(SEPARATOR)
+    return ALL_LEVELS not in levels[:-1]
+
+
+class TopicNode(object):
+    """One level of the trie.  Values maps a name to whatever was added for the topic that ends here."""
+
+    __slots__ = ("Children", "Values")
+
+    def __init__(self):
+        """Public constructor."""
+        self.Children = dict()
+        self.Values = dict()
+
+
+class TopicTrie(object):
+    """Named values filed under topics.  Keep patterns in one to Match() them against a publisher key, keep
+       publisher keys in one to Find() the ones a pattern matches.  Either costs the length of the topic
+       plus whatever matches, not the number of topics in the trie.  Not thread safe, the owner locks."""
+
+    def __init__(self):
+        """Public constructor."""
+        self.Root = TopicNode()
+        self.Count = 0
+
+
+    def Add(self, topic, name, value):
+        """Files value under topic with a name, replacing the one with the same name if there is one."""
+        node = self.Root
+        for level in topic.split(SEPARATOR):
+            child = node.Children.get(level)
+            if child is None:
+                child = node.Children[level] = TopicNode()
+            node = child
+
+        if name not in node.Values:
+            self.Count = self.Count + 1
+        node.Values[name] = value
+
+
+    def Remove(self, topic, name):
+        """Takes the value with a name out of topic and returns it, or None if it was not there.  Levels
+           nothing is filed under anymore are pruned."""
+        path = [self.Root]
+        levels = topic.split(SEPARATOR)
+        for level in levels:
+            child = path[-1].Children.get(level)
+            if child is None:
+                return None
+            path.append(child)
+
+        value = path[-1].Values.pop(name, None)
+        if value is None:
+            return None
+        self.Count = self.Count - 1
+
+        # Walk back up dropping the levels that are empty now.
+        for n in range(len(levels), 0, -1):
+            node = path[n]
+            if node.Values or node.Children:
+                break
+            del path[n - 1].Children[levels[n - 1]]
+
+        return value
+
+
+    def Get(self, topic):
+        """Returns the name to value dictionary of exactly this topic, empty if there is none.  Don't change it."""
+        node = self.Root
+        for level in topic.split(SEPARATOR):
+            node = node.Children.get(level)
+            if node is None:
+                return dict()
+
+        return node.Values
+
+
+    def Match(self, topic):
+        """Returns the values filed under every pattern that matches a topic, with no wildcards in it."""
+        matches = []
+        nodes = [self.Root]
+        for level in topic.split(SEPARATOR):
+            following = []
+            for node in nodes:
+                children = node.Children
+
+                # "#" takes this level and everything after it.
+                child = children.get(ALL_LEVELS)
+                if child is not None:
+                    matches.extend(child.Values.values())
+
+                child = children.get(level)
+                if child is not None:
+                    following.append(child)
+
+                child = children.get(ONE_LEVEL)
+                if child is not None:
+                    following.append(child)
+
+            nodes = following
+            if not nodes:
+                return matches
+
+        for node in nodes:
+            matches.extend(node.Values.values())
+
+            # "a/#" matches "a" as well.
+            child = node.Children.get(ALL_LEVELS)
+            if child is not None:
+                matches.extend(child.Values.values())
+
+        return matches
+
+
+    def Find(self, pattern):
+        """Returns the values filed under every topic a pattern matches.  The topics in the trie are taken
+           literally, only the wildcards of the pattern count."""
+        matches = []
+        nodes = [self.Root]
+        for level in pattern.split(SEPARATOR):
+            if level == ALL_LEVELS:
+                # Everything at or below the nodes we got to.
+                while nodes:
+                    node = nodes.pop()
+                    matches.extend(node.Values.values())
+                    nodes.extend(node.Children.values())
+                return matches
+
+            following = []
+            for node in nodes:
+                if level == ONE_LEVEL:
+                    following.extend(node.Children.values())
+                else:
+                    child = node.Children.get(level)
+                    if child is not None:
+                        following.append(child)
+
+            nodes = following
+            if not nodes:
+                return matches
+
+        for node in nodes:
+            matches.extend(node.Values.values())
+
+        return matches
+
+
+    def Values(self):
+        """Returns every value in the trie."""
+        return self.Find(ALL_LEVELS)
+
+
+    def __len__(self):
+        return self.Count
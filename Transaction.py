@@ -0,0 +1,36 @@
+# Transaction.py
+# Data structure representing a command the central node sent that is waiting on a response.
+
+import random
+
+class Transaction(object):
+    """A command the central node is waiting for a SUCCESS on.  The packet is encoded once and kept
+       so retransmits just resend the same bytes."""
+
+    # Seconds before the first retransmit, each one after waits BACKOFF times longer.
+    INITIAL_TIMEOUT = 1.0
+    BACKOFF = 2.0
+    # Spread retransmits by up to this fraction so they don't all go out on the same tick.
+    JITTER = 0.2
+    # Retransmits before we give up on the transaction.
+    MAX_RETRANSMITS = 2
+
+    def __init__(self, transaction_id, packet, socket, address):
+        """Public constructor sets up all important variables."""
+        self.ID = transaction_id
+        self.Packet = packet
+        self.Socket = socket
+        self.Address = address
+        self.Retransmits = 0
+        self.Deadline = 0
+
+
+    def GetTimeout(self):
+        """Seconds to wait for a response to the most recent send."""
+        timeout = self.INITIAL_TIMEOUT * (self.BACKOFF ** self.Retransmits)
+        return timeout * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+
+
+    def Send(self):
+        """Sends the packet to the client."""
+        self.Socket.sendto(self.Packet, self.Address)